@@ -10,11 +10,27 @@ from python_lib.weight import (
     load_gemma_state,
     load_mistral_state,
     load_llama_state,
+    load_sharded_state,
+    load_weight_cache,
+    load_quantized_weights,
+    iter_state,
+    next_state_key,
+)
+from python_lib.store import (
+    WeightStore,
+    load_stored_state,
 )
 from python_lib.trainer import (
     train_simple_auto_encoder,
     step_simple_auto_encoder,
 )
+from python_lib.nlp.batch import predict_batch
+from python_lib.nlp.embeddings import embed
+from python_lib.nlp.capture import load_activations
+from python_lib.nlp.registry import (
+    unload_model,
+    set_memory_budget,
+)
 from python_lib.nlp.gemma2.generate import (
     load_gemma2_tokenizer,
     encode_gemma2,
@@ -22,6 +38,7 @@ from python_lib.nlp.gemma2.generate import (
 )
 from python_lib.nlp.mistral.generate import (
     predict_mistral,
+    capture_mistral,
     load_mistral_tokenizer,
     encode_mistral,
     decode_mistral,
@@ -48,12 +65,25 @@ __all__ = [
     "load_gemma_state",
     "load_mistral_state",
     "load_llama_state",
+    "load_sharded_state",
+    "load_weight_cache",
+    "load_quantized_weights",
+    "iter_state",
+    "next_state_key",
+    "WeightStore",
+    "load_stored_state",
     "train_simple_auto_encoder",
     "step_simple_auto_encoder",
+    "predict_batch",
+    "embed",
+    "load_activations",
+    "unload_model",
+    "set_memory_budget",
     "load_gemma2_tokenizer",
     "encode_gemma2",
     "decode_gemma2",
     "predict_mistral",
+    "capture_mistral",
     "load_mistral_tokenizer",
     "encode_mistral",
     "decode_mistral",
@@ -0,0 +1,232 @@
+import torch
+import numpy as np
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from python_lib.nlp.generate import export_logits
+from python_lib.nlp.mistral.generate import (
+    load_mistral_model,
+    load_mistral_tokenizer,
+    encode_mistral,
+)
+from python_lib.nlp.llama2.generate import (
+    load_llama2_model,
+    load_llama2_tokenizer,
+    encode_llama2,
+)
+from python_lib.nlp.llama3.generate import (
+    load_llama3_model,
+    load_llama3_formatter,
+    encode_llama3,
+)
+from python_lib.nlp.gemma2.generate import (
+    load_gemma2_model,
+    load_gemma2_tokenizer,
+    encode_gemma2,
+)
+
+
+# Tokenizer loader, prompt encoder and model loader of each model type.
+MODEL_TYPES: Dict[str, Tuple[Callable, Callable, Callable]] = {
+    "mistral": (load_mistral_tokenizer, encode_mistral, load_mistral_model),
+    "llama2": (load_llama2_tokenizer, encode_llama2, load_llama2_model),
+    "llama3": (load_llama3_formatter, encode_llama3, load_llama3_model),
+    "gemma2": (load_gemma2_tokenizer, encode_gemma2, load_gemma2_model),
+}
+
+
+def make_batches(
+    lengths: List[int],
+    max_batch_tokens: int,
+) -> List[List[int]]:
+    """
+    Group sequences in batches of similar lengths.
+
+    The sequences are sorted by decreasing length and a batch is closed
+    when its padded size (number of sequences times the length of the
+    longest one) would exceed the token budget. A sequence longer than
+    the budget is alone in its batch.
+
+    Parameters
+    ----------
+    lengths: [int]
+        Length of each sequence.
+    max_batch_tokens: int
+        Maximal number of tokens, padding included, in a batch.
+
+    Returns
+    -------
+    batches: [[int]]
+        Indices of the sequences of each batch.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches = []
+    for i in order:
+        if len(batches) > 0 and \
+           (len(batches[-1]) + 1) * lengths[batches[-1][0]] <= \
+           max_batch_tokens:
+            batches[-1].append(i)
+        else:
+            batches.append([i])
+    return batches
+
+
+def make_packs(
+    lengths: List[int],
+    max_batch_tokens: int,
+) -> List[List[int]]:
+    """
+    Group sequences to pack in rows of at most `max_batch_tokens` tokens.
+
+    The sequences are placed by decreasing length in the first row with
+    enough room left (first fit decreasing). A sequence longer than the
+    budget is alone in its row.
+
+    Parameters
+    ----------
+    lengths: [int]
+        Length of each sequence.
+    max_batch_tokens: int
+        Maximal number of tokens in a row.
+
+    Returns
+    -------
+    packs: [[int]]
+        Indices of the sequences of each row.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    packs = []
+    sizes = []
+    for i in order:
+        for e, size in enumerate(sizes):
+            if size + lengths[i] <= max_batch_tokens:
+                packs[e].append(i)
+                sizes[e] += lengths[i]
+                break
+        else:
+            packs.append([i])
+            sizes.append(lengths[i])
+    return packs
+
+
+def pad_batch(
+    sequences: List[List[int]],
+    device: torch.device,
+    pad_id: int = 0,
+) -> torch.Tensor:
+    """
+    Right pad sequences of tokens in one tensor.
+
+    With a causal mask, the positions of a sequence never attend to the
+    padding that follows them: the outputs of the real tokens do not
+    depend on the padding.
+
+    Parameters
+    ----------
+    sequences: [[int]]
+        The sequences of tokens.
+    device: torch.device
+        Device of the tensor.
+    pad_id: int
+        Token used for padding.
+
+    Returns
+    -------
+    _: torch.Tensor
+        The tokens of shape (batch, longest sequence).
+    """
+    max_len = max(len(sequence) for sequence in sequences)
+    x = torch.full((len(sequences), max_len), pad_id, dtype=torch.long)
+    for e, sequence in enumerate(sequences):
+        x[e, :len(sequence)] = torch.tensor(sequence, dtype=torch.long)
+    return x.to(device)
+
+
+def predict_batch(
+    prompts: List[str],
+    model_path: str,
+    model_type: str = "mistral",
+    n_layers: Optional[int] = None,
+    max_batch_tokens: int = 4096,
+    last_only: bool = False,
+    top_k: Optional[int] = None,
+    packed: bool = False,
+    dtype: torch.dtype = torch.float32,
+    device: str = "mps",
+) -> List[Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]]:
+    """
+    Predict the logits of many prompts with one model load.
+
+    The prompts are formatted like in the `generate` function of their
+    model type, sorted by length and run in right padded batches or,
+    with `packed`, concatenated in rows without padding. The output layer
+    is only applied to the positions that are returned.
+
+    Parameters
+    ----------
+    prompts: [str]
+        The input prompts.
+    model_path: str
+        Path to the model on the disk.
+    model_type: str
+        "mistral", "llama2", "llama3" or "gemma2".
+    n_layers: int
+        Modifier of the number of Transformer blocks.
+    max_batch_tokens: int
+        Maximal number of tokens, padding included, in a forward pass.
+    last_only: bool
+        Whether to only return the logits of the last position.
+    top_k: int
+        Number of best tokens to return per position, None for all.
+    packed: bool
+        Whether to pack the prompts in rows with a block diagonal causal
+        mask instead of padding them.
+    dtype: torch.dtype
+        Precision type of the weights and activations.
+    device: str
+        Device of the model.
+
+    Returns
+    -------
+    _: [np.ndarray | (np.ndarray, np.ndarray)]
+        For each prompt, in the input order, the output of
+        `export_logits`.
+    """
+    load_tokenizer, encode, load_model = MODEL_TYPES[model_type]
+    tokenizer = load_tokenizer(model_path)
+    sequences = [encode(prompt, tokenizer) for prompt in prompts]
+    model = load_model(model_path, dtype=dtype, device=device)
+
+    lengths = [len(sequence) for sequence in sequences]
+    results = [None] * len(sequences)
+
+    def export(h: torch.Tensor) -> Union[np.ndarray, Tuple]:
+        # The output layer is only applied to the returned positions.
+        if last_only:
+            h = h[:, -1:]
+        return export_logits(model.output(h).float(), top_k=top_k)
+
+    if packed:
+        for pack in make_packs(lengths, max_batch_tokens):
+            x = torch.tensor(
+                [sum([sequences[i] for i in pack], [])],
+                dtype=torch.long, device=device,
+            )
+            with torch.no_grad():
+                h, _ = model.features(
+                    x, [lengths[i] for i in pack], n_layers=n_layers
+                )
+
+                start = 0
+                for i in pack:
+                    results[i] = export(h[:, start:start + lengths[i]])
+                    start += lengths[i]
+        return results
+
+    for batch in make_batches(lengths, max_batch_tokens):
+        x = pad_batch([sequences[i] for i in batch], device)
+        with torch.no_grad():
+            h, _ = model.features(x, n_layers=n_layers)
+
+            for e, i in enumerate(batch):
+                results[i] = export(h[e:e + 1, :lengths[i]])
+    return results
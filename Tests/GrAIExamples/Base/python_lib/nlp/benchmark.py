@@ -0,0 +1,330 @@
+import sys
+import copy
+import math
+import time
+import torch
+import resource
+import numpy as np
+from typing import Callable, Dict, Optional
+
+from python_lib.nlp.generate import generate_with_cache
+from python_lib.nlp.quantize import quantize_model
+from python_lib.nlp.registry import model_nbytes
+from python_lib.nlp.scoring import score_tokens
+
+
+def perplexity(model: torch.nn.Module, tokens: torch.Tensor) -> float:
+    """
+    Compute the perplexity of a model on a sequence of tokens.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model to evaluate.
+    tokens: torch.Tensor
+        The sequence of tokens.
+
+    Returns
+    -------
+    _: float
+        The perplexity.
+    """
+    logprobs = score_tokens(model, tokens.tolist())
+    return math.exp(-logprobs.mean(dtype=np.float64))
+
+
+def throughput(
+    model: torch.nn.Module,
+    prompt: torch.Tensor,
+    n_tokens: int = 32,
+) -> float:
+    """
+    Measure the number of tokens generated per second.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model to use for generation.
+    prompt: torch.Tensor
+        The input prompt.
+    n_tokens: int
+        Number of tokens to generate.
+
+    Returns
+    -------
+    _: float
+        Tokens per second, prefill included.
+    """
+    with torch.no_grad():
+        start_time = time.time()
+        for _, _ in zip(generate_with_cache(prompt, model), range(n_tokens)):
+            pass
+        elapsed_time = time.time() - start_time
+    return n_tokens / elapsed_time
+
+
+def parity(
+    reference: torch.nn.Module,
+    model: torch.nn.Module,
+    tokens: torch.Tensor,
+) -> Dict[str, float]:
+    """
+    Compare the logits of a model against a reference one.
+
+    Parameters
+    ----------
+    reference: Transformer
+        The reference model.
+    model: Transformer
+        The model to compare.
+    tokens: torch.Tensor
+        The sequence of tokens.
+
+    Returns
+    -------
+    _: Dict[str, float]
+        Maximal absolute error of the logits and ratio of positions where
+        both models predict the same token.
+    """
+    with torch.no_grad():
+        logits_reference, _ = reference(tokens[None])
+        logits, _ = model(tokens[None])
+    logits_reference = logits_reference.float()
+    logits = logits.float()
+    return {
+        "logits_max_error": float(
+            (logits - logits_reference).abs().max()
+        ),
+        "argmax_agreement": float(
+            (logits.argmax(-1) == logits_reference.argmax(-1)).float().mean()
+        ),
+    }
+
+
+def check_parity(
+    reference: torch.nn.Module,
+    model: torch.nn.Module,
+    tokens: torch.Tensor,
+    atol: float = 0.5,
+    min_argmax_agreement: float = 0.95,
+) -> Dict[str, float]:
+    """
+    Check that the logits of a model match the ones of a reference model.
+
+    Parameters
+    ----------
+    reference: Transformer
+        The reference model.
+    model: Transformer
+        The model to check.
+    tokens: torch.Tensor
+        The sequence of tokens.
+    atol: float
+        Maximal absolute error of the logits.
+    min_argmax_agreement: float
+        Minimal ratio of positions where both models predict the same
+        token.
+
+    Returns
+    -------
+    _: Dict[str, float]
+        The metrics of `parity`.
+    """
+    metrics = parity(reference, model, tokens)
+    if metrics["logits_max_error"] > atol or \
+       metrics["argmax_agreement"] < min_argmax_agreement:
+        raise AssertionError(f"Parity check failed: {metrics}.")
+    return metrics
+
+
+def check_bf16_parity(
+    model: torch.nn.Module,
+    tokens: torch.Tensor,
+    atol: float = 0.5,
+    min_argmax_agreement: float = 0.95,
+) -> Dict[str, float]:
+    """
+    Check that the bfloat16 copy of a float32 model predicts the same
+    logits, see `check_parity`.
+
+    Parameters
+    ----------
+    model: Transformer
+        The float32 model, left unchanged.
+    tokens: torch.Tensor
+        The sequence of tokens.
+    atol: float
+        Maximal absolute error of the logits.
+    min_argmax_agreement: float
+        Minimal ratio of positions where both models predict the same
+        token.
+
+    Returns
+    -------
+    _: Dict[str, float]
+        The metrics of `parity`.
+    """
+    return check_parity(
+        model,
+        copy.deepcopy(model).to(torch.bfloat16),
+        tokens,
+        atol=atol,
+        min_argmax_agreement=min_argmax_agreement,
+    )
+
+
+def compare_models(
+    reference: torch.nn.Module,
+    model: torch.nn.Module,
+    tokens: torch.Tensor,
+    n_tokens: int = 32,
+) -> Dict[str, float]:
+    """
+    Report the parity, the perplexity and the throughput of a model against
+    a reference one (typically the float32 model).
+
+    Parameters
+    ----------
+    reference: Transformer
+        The reference model.
+    model: Transformer
+        The model to compare.
+    tokens: torch.Tensor
+        The sequence of tokens used for perplexity and as prompt.
+    n_tokens: int
+        Number of tokens to generate.
+
+    Returns
+    -------
+    _: Dict[str, float]
+        The metrics of both models.
+    """
+    ppl_reference = perplexity(reference, tokens)
+    ppl_model = perplexity(model, tokens)
+    return {
+        **parity(reference, model, tokens),
+        "perplexity_reference": ppl_reference,
+        "perplexity": ppl_model,
+        "perplexity_delta": ppl_model - ppl_reference,
+        "tokens_per_s_reference": throughput(reference, tokens, n_tokens),
+        "tokens_per_s": throughput(model, tokens, n_tokens),
+    }
+
+
+def compare_quantization(
+    model: torch.nn.Module,
+    tokens: torch.Tensor,
+    bits: int = 8,
+    group_size: Optional[int] = None,
+    cache_weight: bool = False,
+    n_tokens: int = 32,
+) -> Dict[str, float]:
+    """
+    Report the parity, the perplexity and the throughput of a quantized
+    copy of a model against the model.
+
+    Parameters
+    ----------
+    model: Transformer
+        The reference model, left unchanged.
+    tokens: torch.Tensor
+        The sequence of tokens used for perplexity and as prompt.
+    bits: int
+        Number of bits per value: 8 or 4.
+    group_size: int
+        Number of consecutive input features sharing a scale.
+    cache_weight: bool
+        Whether the quantized layers keep their dequantized weight, see
+        `QuantizedLinear`.
+    n_tokens: int
+        Number of tokens to generate.
+
+    Returns
+    -------
+    _: Dict[str, float]
+        The metrics of both models, see `compare_models`, and their
+        number of bytes of parameters and buffers.
+    """
+    quantized = quantize_model(
+        copy.deepcopy(model), bits, group_size, cache_weight=cache_weight
+    )
+    return {
+        **compare_models(model, quantized, tokens, n_tokens),
+        "nbytes_reference": model_nbytes(model),
+        "nbytes": model_nbytes(quantized),
+    }
+
+
+def measure_loading(
+    load_model: Callable[[], torch.nn.Module]
+) -> Dict[str, float]:
+    """
+    Measure the time and the memory needed to load a model.
+
+    The peak resident set size is the one of the whole process:
+    compare loading strategies in separate processes.
+
+    Parameters
+    ----------
+    load_model: Callable
+        Function loading the model.
+
+    Returns
+    -------
+    _: Dict[str, float]
+        Loading time in seconds and peak resident set size in MB.
+    """
+    start_time = time.time()
+    load_model()
+    elapsed_time = time.time() - start_time
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes on Linux.
+    if sys.platform != "darwin":
+        peak *= 1024
+    return {
+        "load_time_s": elapsed_time,
+        "peak_rss_mb": peak / 2 ** 20,
+    }
+
+
+if __name__ == "__main__":
+    from python_lib.nlp import model as model_lib
+    from python_lib.nlp.gemma2 import model as gemma2_model_lib
+
+    torch.manual_seed(0)
+    tokens = torch.randint(0, 1000, (64,))
+    dims = dict(
+        dim=256, n_layers=4, head_dim=32, hidden_dim=512,
+        n_heads=8, n_kv_heads=4, norm_eps=1e-5, vocab_size=1000,
+    )
+    print(check_bf16_parity(
+        model_lib.Transformer(model_lib.TransformerArgs(**dims)).eval(),
+        tokens,
+    ))
+    print(check_bf16_parity(
+        gemma2_model_lib.Transformer(gemma2_model_lib.TransformerArgs(
+            **dims,
+            attn_logit_softcapping=50.0,
+            final_logit_softcapping=30.0,
+        )).eval(),
+        tokens,
+    ))
+
+    if len(sys.argv) > 1:
+        from python_lib.nlp.mistral.generate import (
+            load_mistral_model,
+            load_mistral_tokenizer,
+            encode_mistral,
+        )
+
+        model_path = sys.argv[1]
+        tokenizer = load_mistral_tokenizer(model_path)
+        tokens = torch.tensor(
+            encode_mistral("How do you do?", tokenizer), device="mps"
+        )
+        print(check_parity(
+            load_mistral_model(model_path),
+            load_mistral_model(model_path, dtype=torch.bfloat16),
+            tokens,
+        ))
@@ -0,0 +1,529 @@
+import os
+import shutil
+import tempfile
+import threading
+import torch
+import numpy as np
+from pathlib import Path
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+
+def rotate_positions(
+    x: torch.Tensor,
+    deltas: torch.Tensor,
+    rope_theta: float,
+) -> torch.Tensor:
+    """
+    Shift the RoPE positions of already rotated keys.
+
+    RoPE rotations compose: R(p + delta) = R(delta) R(p). Applying R(delta)
+    to a key that was encoded at position p re-encodes it at p + delta
+    without having to keep the raw keys around.
+
+    Parameters
+    ----------
+    x: torch.Tensor
+        Rotated keys of shape (batch, heads, sequence, head_dim).
+    deltas: torch.Tensor
+        Position shift of each element of the sequential axis.
+    rope_theta: float
+        RoPE theta.
+
+    Returns
+    -------
+    _: torch.Tensor
+        The keys encoded at their new positions.
+    """
+    embedding_dim = x.shape[-1]
+    slice_i = torch.arange(0, embedding_dim // 2, device=x.device)
+    theta = rope_theta ** (-2.0 * (slice_i.float()) / embedding_dim)
+    m_theta = deltas.float().unsqueeze(1) * theta
+
+    cos_values = torch.cos(m_theta)
+    sin_values = torch.sin(m_theta)
+
+    x_even = x[..., 0::2].float()
+    x_odd = x[..., 1::2].float()
+
+    output = torch.empty_like(x)
+    output[..., 0::2] = cos_values * x_even - sin_values * x_odd
+    output[..., 1::2] = sin_values * x_even + cos_values * x_odd
+    return output
+
+
+class EvictionPolicy(ABC):
+    """
+    Eviction policy of the KV cache of one Transformer block.
+
+    A policy is stateful: one instance has to be created per Transformer
+    block and per generation session. After each attention step the policy
+    selects the cache entries to keep, the other ones are dropped and the
+    kept keys are re-encoded at contiguous positions so that the next token
+    position, derived from the cache length, stays consistent with RoPE.
+
+    Parameters
+    ----------
+    budget: int
+        Maximal number of tokens kept in the cache.
+    """
+
+    def __init__(self, budget: int):
+        assert budget > 0
+        self.budget = budget
+
+    def reset(self):
+        """
+        Reset the internal state before a new generation session.
+        """
+        pass
+
+    def observe(self, scores: torch.Tensor):
+        """
+        Accumulate statistics from the attention probabilities.
+
+        Parameters
+        ----------
+        scores: torch.Tensor
+            Attention probabilities of shape (batch, heads, queries, keys).
+        """
+        pass
+
+    @abstractmethod
+    def select(self, context_len: int) -> Optional[torch.Tensor]:
+        """
+        Select the cache entries to keep.
+
+        Parameters
+        ----------
+        context_len: int
+            Current number of tokens in the cache.
+
+        Returns
+        -------
+        _: torch.Tensor
+            Sorted indices of the tokens to keep or None to keep them all.
+        """
+
+    def __call__(
+        self,
+        keys: torch.Tensor,
+        values: torch.Tensor,
+        scores: torch.Tensor,
+        rope_theta: float,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Evict entries from the cache of one Transformer block.
+
+        Parameters
+        ----------
+        keys: torch.Tensor
+            Rotated keys of shape (batch, heads, sequence, head_dim).
+        values: torch.Tensor
+            Values of shape (batch, heads, sequence, head_dim).
+        scores: torch.Tensor
+            Attention probabilities of the current step.
+        rope_theta: float
+            RoPE theta.
+
+        Returns
+        -------
+        (keys, values): (torch.Tensor, torch.Tensor)
+            The cache for keys and values after eviction.
+        """
+        self.observe(scores)
+
+        keep = self.select(keys.shape[2])
+        if keep is None:
+            return keys, values
+
+        keep = keep.to(keys.device)
+        deltas = torch.arange(len(keep), device=keys.device) - keep
+
+        keys = rotate_positions(
+            keys[:, :, keep], deltas=deltas, rope_theta=rope_theta
+        )
+        values = values[:, :, keep]
+        return keys, values
+
+
+class SinkEvictionPolicy(EvictionPolicy):
+    """
+    Keep the first "sink" tokens and a window of the most recent ones
+    (StreamingLLM).
+
+    Parameters
+    ----------
+    n_sinks: int
+        Number of tokens kept at the beginning of the sequence.
+    window: int
+        Number of recent tokens kept.
+    """
+
+    def __init__(self, n_sinks: int, window: int):
+        super().__init__(budget=n_sinks + window)
+        self.n_sinks = n_sinks
+        self.window = window
+
+    def select(self, context_len: int) -> Optional[torch.Tensor]:
+        """
+        Select the cache entries to keep.
+
+        Parameters
+        ----------
+        context_len: int
+            Current number of tokens in the cache.
+
+        Returns
+        -------
+        _: torch.Tensor
+            Sorted indices of the tokens to keep or None to keep them all.
+        """
+        if context_len <= self.budget:
+            return None
+        return torch.cat([
+            torch.arange(0, self.n_sinks),
+            torch.arange(context_len - self.window, context_len),
+        ])
+
+
+class HeavyHitterEvictionPolicy(EvictionPolicy):
+    """
+    Keep the tokens that received the most attention so far along with
+    a window of the most recent ones (H2O).
+
+    Parameters
+    ----------
+    n_heavy: int
+        Number of heavy hitter tokens kept.
+    window: int
+        Number of recent tokens kept.
+    """
+
+    def __init__(self, n_heavy: int, window: int):
+        super().__init__(budget=n_heavy + window)
+        self.n_heavy = n_heavy
+        self.window = window
+        self.mass: Optional[torch.Tensor] = None
+
+    def reset(self):
+        """
+        Reset the internal state before a new generation session.
+        """
+        self.mass = None
+
+    def observe(self, scores: torch.Tensor):
+        """
+        Accumulate the attention mass received by each token.
+
+        Parameters
+        ----------
+        scores: torch.Tensor
+            Attention probabilities of shape (batch, heads, queries, keys).
+        """
+        mass = scores.float().sum(dim=(0, 1, 2))
+        if self.mass is not None:
+            mass[:len(self.mass)] += self.mass.to(mass.device)
+        self.mass = mass
+
+    def select(self, context_len: int) -> Optional[torch.Tensor]:
+        """
+        Select the cache entries to keep.
+
+        Parameters
+        ----------
+        context_len: int
+            Current number of tokens in the cache.
+
+        Returns
+        -------
+        _: torch.Tensor
+            Sorted indices of the tokens to keep or None to keep them all.
+        """
+        if context_len <= self.budget:
+            return None
+
+        n_old = context_len - self.window
+        heavy = torch.topk(self.mass[:n_old], self.n_heavy).indices
+        keep = torch.cat([
+            torch.sort(heavy.cpu()).values,
+            torch.arange(n_old, context_len),
+        ])
+        self.mass = self.mass[keep.to(self.mass.device)]
+        return keep
+
+
+@dataclass
+class OffloadStats:
+    """
+    Statistics of an offloaded cache.
+
+    Parameters
+    ----------
+    hot_hits: int
+        Number of accesses served from memory only.
+    cold_hits: int
+        Number of accesses to cold blocks already paged in by readahead.
+    cold_misses: int
+        Number of accesses that had to wait for cold blocks to be read.
+    bytes_written: int
+        Number of bytes spilled to the disk.
+    bytes_read: int
+        Number of bytes paged back from the disk.
+    """
+    hot_hits: int = 0
+    cold_hits: int = 0
+    cold_misses: int = 0
+    bytes_written: int = 0
+    bytes_read: int = 0
+
+    @property
+    def hot_rate(self) -> float:
+        """
+        Ratio of accesses served from memory only.
+        """
+        total = self.hot_hits + self.cold_hits + self.cold_misses
+        return self.hot_hits / total if total > 0 else 0.0
+
+    @property
+    def cold_hit_rate(self) -> float:
+        """
+        Ratio of cold accesses served by readahead without waiting.
+        """
+        total = self.cold_hits + self.cold_misses
+        return self.cold_hits / total if total > 0 else 0.0
+
+
+class OffloadedCache:
+    """
+    Cache for keys and values that spills cold blocks to memory-mapped
+    files.
+
+    The cache behaves like the list of per layer caches used by
+    `Transformer.forward`. The most recent `hot_size` tokens of each layer
+    stay in memory, older tokens are written to the disk by blocks of
+    `block_size` tokens and paged back when the attention of the layer
+    needs them. Reading the cold blocks of the next layer is done
+    asynchronously, on a background thread, while the current layer
+    computes.
+
+    The cache bounds the resident memory, not the I/O: as the attention
+    of a layer reads the whole history, every access to a layer with cold
+    blocks pages all of them back, so that the bytes read per generated
+    token grow with the length of the sequence. Only the cold blocks of
+    the layer being computed and of the next one, read ahead, are in
+    memory at once.
+
+    The cold tokens are expected to stay unchanged once spilled: this cache
+    is not meant to be combined with an `EvictionPolicy`.
+
+    Parameters
+    ----------
+    n_layers: int
+        Number of Transformer blocks.
+    directory: str
+        Directory where to write the cold blocks, a temporary directory
+        is created when None.
+    hot_size: int
+        Number of recent tokens kept in memory for each layer.
+    block_size: int
+        Number of tokens spilled to the disk at once.
+    """
+
+    def __init__(
+        self,
+        n_layers: int,
+        directory: Optional[str] = None,
+        hot_size: int = 512,
+        block_size: int = 256,
+    ):
+        self.n_layers = n_layers
+        self.hot_size = hot_size
+        self.block_size = block_size
+
+        self._own_directory = directory is None
+        self.directory = Path(
+            tempfile.mkdtemp(prefix="kv_cache_")
+            if directory is None else directory
+        )
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.stats = OffloadStats()
+        # The readahead thread also updates the statistics.
+        self._stats_lock = threading.Lock()
+
+        self._hot: List[Optional[Tuple[torch.Tensor, torch.Tensor]]] = \
+            [None] * n_layers
+        self._cold: List[List[Tuple[Path, Tuple[int, ...]]]] = \
+            [[] for _ in range(n_layers)]
+        self._cold_len: List[int] = [0] * n_layers
+        self._paged: Dict[int, Tuple[torch.Tensor, torch.Tensor]] = {}
+        self._readahead: Dict[int, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+        self._dtype: Optional[torch.dtype] = None
+        self._device: Optional[torch.device] = None
+
+    def __len__(self) -> int:
+        return self.n_layers
+
+    @property
+    def seq_len(self) -> int:
+        """
+        Number of tokens in the cache, read without paging blocks in.
+        """
+        hot = self._hot[0]
+        return self._cold_len[0] + (hot[0].shape[2] if hot is not None else 0)
+
+    def __getitem__(
+        self, layer: int
+    ) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        if layer in self._paged:
+            return self._paged[layer]
+
+        hot = self._hot[layer]
+        if len(self._cold[layer]) == 0:
+            with self._stats_lock:
+                self.stats.hot_hits += 1
+            return hot
+
+        future = self._readahead.pop(layer, None)
+        with self._stats_lock:
+            if future is not None and future.done():
+                self.stats.cold_hits += 1
+            else:
+                self.stats.cold_misses += 1
+        if future is None:
+            future = self._submit(layer)
+
+        keys, values = future.result()
+        keys = keys.to(self._device)
+        values = values.to(self._device)
+        if hot is not None:
+            keys = torch.concat([keys, hot[0]], dim=2)
+            values = torch.concat([values, hot[1]], dim=2)
+
+        self._paged[layer] = (keys, values)
+        self._prefetch((layer + 1) % self.n_layers)
+        return keys, values
+
+    def __setitem__(
+        self, layer: int, cache: Tuple[torch.Tensor, torch.Tensor]
+    ):
+        self._paged.pop(layer, None)
+
+        keys, values = cache
+        self._dtype = keys.dtype
+        self._device = keys.device
+
+        # The cold tokens are the first ones of the sequential axis.
+        n_cold = self._cold_len[layer]
+        keys = keys[:, :, n_cold:]
+        values = values[:, :, n_cold:]
+
+        while keys.shape[2] >= self.hot_size + self.block_size:
+            self._spill(
+                layer,
+                keys[:, :, :self.block_size],
+                values[:, :, :self.block_size],
+            )
+            keys = keys[:, :, self.block_size:]
+            values = values[:, :, self.block_size:]
+
+        # Clone so that paged in blocks are released.
+        self._hot[layer] = (keys.clone(), values.clone())
+
+    def spill(self):
+        """
+        Spill the whole cache to the disk, for instance when the sequence
+        becomes idle.
+        """
+        self._paged.clear()
+        for layer in range(self.n_layers):
+            hot = self._hot[layer]
+            if hot is not None and hot[0].shape[2] > 0:
+                self._spill(layer, hot[0], hot[1])
+            self._hot[layer] = None
+
+    def close(self):
+        """
+        Release the background thread and the files written on the disk.
+        """
+        self._executor.shutdown(wait=True)
+        self._readahead.clear()
+        self._paged.clear()
+        if self._own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        else:
+            for blocks in self._cold:
+                for path, _ in blocks:
+                    if path.exists():
+                        os.remove(path)
+
+    def _spill(self, layer: int, keys: torch.Tensor, values: torch.Tensor):
+        """
+        Write a block of keys and values to a memory-mapped file.
+        """
+        block = torch.stack([keys, values]).detach().cpu()
+        if block.dtype == torch.bfloat16:
+            block = block.view(torch.int16)
+        block = block.contiguous().numpy()
+
+        path = self.directory / \
+            f"layer{layer}_block{len(self._cold[layer])}.bin"
+        array = np.memmap(
+            path, dtype=block.dtype, mode="w+", shape=block.shape
+        )
+        array[:] = block
+        array.flush()
+        del array
+
+        self._cold[layer].append((path, block.shape))
+        self._cold_len[layer] += keys.shape[2]
+        with self._stats_lock:
+            self.stats.bytes_written += block.nbytes
+        self._readahead.pop(layer, None)
+
+    def _read(
+        self,
+        blocks: List[Tuple[Path, Tuple[int, ...]]],
+        dtype: torch.dtype,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Page cold blocks back in memory.
+        """
+        np_dtype = np.int16 if dtype == torch.bfloat16 else \
+            torch.empty(0, dtype=dtype).numpy().dtype
+
+        arrays = []
+        for path, shape in blocks:
+            array = np.memmap(path, dtype=np_dtype, mode="r", shape=shape)
+            arrays.append(torch.from_numpy(np.array(array)))
+            del array
+
+        nbytes = sum(array.numel() * array.element_size() for array in arrays)
+        with self._stats_lock:
+            self.stats.bytes_read += nbytes
+
+        block = torch.concat(arrays, dim=3)
+        if dtype == torch.bfloat16:
+            block = block.view(torch.bfloat16)
+        return block[0], block[1]
+
+    def _submit(self, layer: int) -> Future:
+        """
+        Read the cold blocks of a layer on the background thread.
+        """
+        return self._executor.submit(
+            self._read, list(self._cold[layer]), self._dtype
+        )
+
+    def _prefetch(self, layer: int):
+        """
+        Schedule readahead of the cold blocks of a layer.
+        """
+        if len(self._cold[layer]) > 0 and \
+           layer not in self._readahead and layer not in self._paged:
+            self._readahead[layer] = self._submit(layer)
@@ -0,0 +1,258 @@
+import os
+import json
+import torch
+import numpy as np
+from pathlib import Path
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from python_lib.nlp import model as model_lib
+from python_lib.nlp.gemma2 import model as gemma2_model_lib
+
+
+CAPTURED_MODULES = (
+    model_lib.TransformerBlock,
+    model_lib.RMSNorm,
+    model_lib.Attention,
+    gemma2_model_lib.TransformerBlock,
+    gemma2_model_lib.RMSNorm,
+    gemma2_model_lib.Attention,
+)
+
+
+def _archive_file(path: Path, suffix: str) -> Path:
+    """
+    Get the path of a file of an archive.
+
+    Parameters
+    ----------
+    path: Path
+        Path to the archive, without suffix.
+    suffix: str
+        Suffix of the file.
+
+    Returns
+    -------
+    _: Path
+        Path to the file.
+    """
+    return path.parent / (path.name + suffix)
+
+
+class ActivationCapture:
+    """
+    Write the activations of a Transformer to a memory-mappable archive
+    during one forward pass.
+
+    Forward hooks are registered on every Transformer block, RMS norm
+    and attention. Their outputs are written to `<path>.bin` as they are
+    computed, so that the activations of all the depths are not held in
+    memory at once. The `<path>.json` manifest has the same layout as the
+    one of the weight cache: the precision type and, for each activation,
+    its key (the module name), its offset in bytes and its shape.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model.
+    path: str
+        Path to the archive, without suffix.
+    dtype: str
+        Precision of the archive: "float32", "float16" or "bfloat16".
+    logits: bool
+        Whether to also write the logits the model would output if it was
+        cut after each block, as `layers.<i>.logits`.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        path: str,
+        dtype: str = "float32",
+        logits: bool = False,
+    ):
+        assert dtype in ["float32", "float16", "bfloat16"]
+        self.model = model
+        self.path = Path(path)
+        self.dtype = dtype
+        self.logits = logits
+
+        self._file = None
+        self._offset = 0
+        self._tensors: List[Dict] = []
+        self._handles = []
+        self._paused = False
+
+    def _write(self, key: str, x: torch.Tensor):
+        """
+        Append an activation to the archive.
+
+        Parameters
+        ----------
+        key: str
+            Name of the activation.
+        x: torch.Tensor
+            The activation.
+        """
+        x = x.detach()
+        if self.dtype == "bfloat16":
+            data = x.to(torch.bfloat16).view(torch.int16).cpu().numpy()
+            data = data.view("<u2")
+        elif self.dtype == "float16":
+            data = x.half().cpu().numpy().astype("<f2")
+        else:
+            data = x.float().cpu().numpy().astype("<f4")
+
+        self._file.write(data.tobytes())
+        self._tensors.append({
+            "key": key,
+            "offset": self._offset,
+            "shape": list(x.shape),
+        })
+        self._offset += data.nbytes
+
+    def _hook(
+        self,
+        name: str,
+        module: torch.nn.Module,
+        inputs: Tuple,
+        output,
+    ):
+        """
+        Forward hook writing the output of a module.
+
+        Parameters
+        ----------
+        name: str
+            Name of the module.
+        module: torch.nn.Module
+            The module.
+        inputs: Tuple
+            Inputs of the module.
+        output: torch.Tensor | (torch.Tensor, cache)
+            Output of the module.
+        """
+        if self._paused:
+            return
+        # Blocks and attentions also return their cache.
+        if isinstance(output, tuple):
+            output = output[0]
+        self._write(name, output)
+
+        if self.logits and name.startswith("layers.") and \
+           name.count(".") == 1:
+            self._paused = True
+            try:
+                logits = self.model.output(self.model.norm(output)).float()
+            finally:
+                self._paused = False
+            self._write(name + ".logits", logits)
+
+    def __enter__(self) -> "ActivationCapture":
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(_archive_file(self.path, ".tmp"), "wb")
+        self._offset = 0
+        self._tensors = []
+        for name, module in self.model.named_modules():
+            if isinstance(module, CAPTURED_MODULES):
+                self._handles.append(
+                    module.register_forward_hook(partial(self._hook, name))
+                )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._file.close()
+
+        if exc_type is not None:
+            os.remove(_archive_file(self.path, ".tmp"))
+            return
+
+        os.replace(
+            _archive_file(self.path, ".tmp"),
+            _archive_file(self.path, ".bin"),
+        )
+        manifest = {
+            "dtype": self.dtype,
+            "tensors": self._tensors,
+        }
+        with open(_archive_file(self.path, ".json"), "w") as f:
+            json.dump(manifest, f, indent=1)
+
+
+def capture_activations(
+    model: torch.nn.Module,
+    x: torch.Tensor,
+    path: str,
+    dtype: str = "float32",
+    logits: bool = False,
+    n_layers: Optional[int] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Run the model once and get the activations of all its blocks,
+    RMS norms and attentions.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model.
+    x: torch.Tensor
+        The input tokens of shape (batch, sequence).
+    path: str
+        Path to the archive, without suffix.
+    dtype: str
+        Precision of the archive: "float32", "float16" or "bfloat16".
+    logits: bool
+        Whether to also write the logits the model would output if it was
+        cut after each block, as `layers.<i>.logits`.
+    n_layers: int
+        Modifier of the number of Transformer blocks.
+
+    Returns
+    -------
+    _: Dict[str, np.ndarray]
+        Views of the activations in the archive.
+    """
+    with torch.no_grad(), ActivationCapture(model, path, dtype, logits):
+        model(x, n_layers=n_layers)
+    return load_activations(path)
+
+
+def load_activations(path: str) -> Dict[str, np.ndarray]:
+    """
+    Get memory-mapped views of the activations of an archive.
+
+    Parameters
+    ----------
+    path: str
+        Path to the archive, without suffix.
+
+    Returns
+    -------
+    _: Dict[str, np.ndarray]
+        Views of the activations, with their shape. The bfloat16
+        activations are returned as uint16.
+    """
+    path = Path(path)
+    with open(_archive_file(path, ".json"), "r") as f:
+        manifest = json.load(f)
+    if len(manifest["tensors"]) == 0:
+        return {}
+
+    data = np.memmap(
+        _archive_file(path, ".bin"),
+        dtype={
+            "float32": "<f4", "float16": "<f2", "bfloat16": "<u2"
+        }[manifest["dtype"]],
+        mode="r",
+    )
+    itemsize = data.dtype.itemsize
+
+    activations = {}
+    for tensor in manifest["tensors"]:
+        start = tensor["offset"] // itemsize
+        end = start + int(np.prod(tensor["shape"]))
+        activations[tensor["key"]] = data[start:end].reshape(tensor["shape"])
+    return activations
@@ -0,0 +1,183 @@
+import torch
+import numpy as np
+from typing import List, Optional, Sequence
+
+from python_lib.nlp.batch import MODEL_TYPES, make_batches, pad_batch
+
+
+def pool(
+    h: torch.Tensor,
+    lengths: torch.Tensor,
+    pooling: str = "mean",
+) -> torch.Tensor:
+    """
+    Pool the hidden states of right padded sequences.
+
+    Parameters
+    ----------
+    h: torch.Tensor
+        Hidden states of shape (batch, sequence, dim).
+    lengths: torch.Tensor
+        Length of each sequence, of shape (batch,).
+    pooling: str
+        "mean" of the tokens, hidden state of the "last" token, or
+        "weighted" mean where the weight of a token is its position, so
+        that the tokens having seen more context weigh more.
+
+    Returns
+    -------
+    _: torch.Tensor
+        The float32 embeddings of shape (batch, dim).
+    """
+    h = h.float()
+    if pooling == "last":
+        return h[torch.arange(h.shape[0], device=h.device), lengths - 1]
+
+    positions = torch.arange(1, h.shape[1] + 1, device=h.device)
+    mask = positions[None] <= lengths[:, None]
+    if pooling == "mean":
+        weights = mask.float()
+    elif pooling == "weighted":
+        weights = mask * positions[None].float()
+    else:
+        raise ValueError(f"Unknown pooling: {pooling}.")
+
+    weights = weights / weights.sum(dim=1, keepdim=True)
+    return torch.einsum("bl,bld->bd", weights, h)
+
+
+def embed_sequences(
+    model: torch.nn.Module,
+    sequences: Sequence[List[int]],
+    n_layers: Optional[int] = None,
+    pooling: str = "mean",
+    normalize: bool = True,
+    max_batch_tokens: int = 4096,
+    buffer_size: int = 4096,
+    output_path: Optional[str] = None,
+) -> np.ndarray:
+    """
+    Compute one embedding per sequence of tokens.
+
+    The sequences are read `buffer_size` at a time, grouped by length in
+    right padded batches of at most `max_batch_tokens` tokens and run up
+    to the `n_layers` block. The hidden states, normalized by the last
+    RMS norm of the model, are then pooled.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model.
+    sequences: Sequence[[int]]
+        The sequences of tokens.
+    n_layers: int
+        Modifier of the number of Transformer blocks.
+    pooling: str
+        "mean", "last" or "weighted", see `pool`.
+    normalize: bool
+        Whether to L2 normalize the embeddings.
+    max_batch_tokens: int
+        Maximal number of tokens, padding included, in a forward pass.
+    buffer_size: int
+        Number of sequences grouped by length at once.
+    output_path: str
+        Path to a .npy file receiving the embeddings through a memory
+        map, None to return them in memory.
+
+    Returns
+    -------
+    embeddings: np.ndarray
+        The float32 embeddings of shape (len(sequences), dim), memory
+        mapped when `output_path` is given.
+    """
+    device = next(model.parameters()).device
+    shape = (len(sequences), model.args.dim)
+    if output_path is not None:
+        embeddings = np.lib.format.open_memmap(
+            output_path, mode="w+", dtype=np.float32, shape=shape
+        )
+    else:
+        embeddings = np.empty(shape, dtype=np.float32)
+
+    for begin in range(0, len(sequences), buffer_size):
+        buffer = [
+            sequences[i]
+            for i in range(begin, min(begin + buffer_size, len(sequences)))
+        ]
+        for batch in make_batches(
+            [len(sequence) for sequence in buffer], max_batch_tokens
+        ):
+            x = pad_batch([buffer[i] for i in batch], device)
+            lengths = torch.tensor(
+                [len(buffer[i]) for i in batch], device=device
+            )
+            with torch.no_grad():
+                h, _ = model.features(x, n_layers=n_layers)
+                e = pool(h, lengths, pooling)
+                if normalize:
+                    e = torch.nn.functional.normalize(e, dim=-1)
+            embeddings[[begin + i for i in batch]] = e.cpu().numpy()
+
+    if output_path is not None:
+        embeddings.flush()
+    return embeddings
+
+
+def embed(
+    prompts: List[str],
+    model_path: str,
+    model_type: str = "mistral",
+    n_layers: Optional[int] = None,
+    pooling: str = "mean",
+    normalize: bool = True,
+    max_batch_tokens: int = 4096,
+    output_path: Optional[str] = None,
+    dtype: torch.dtype = torch.float32,
+    device: str = "mps",
+) -> np.ndarray:
+    """
+    Compute the embeddings of texts with a resident model.
+
+    The texts are encoded like the prompts of `predict_batch`.
+
+    Parameters
+    ----------
+    prompts: [str]
+        The input texts.
+    model_path: str
+        Path to the model on the disk.
+    model_type: str
+        "mistral", "llama2", "llama3" or "gemma2".
+    n_layers: int
+        Modifier of the number of Transformer blocks.
+    pooling: str
+        "mean", "last" or "weighted", see `pool`.
+    normalize: bool
+        Whether to L2 normalize the embeddings.
+    max_batch_tokens: int
+        Maximal number of tokens, padding included, in a forward pass.
+    output_path: str
+        Path to a .npy file receiving the embeddings through a memory
+        map, None to return them in memory.
+    dtype: torch.dtype
+        Precision type of the weights and activations.
+    device: str
+        Device of the model.
+
+    Returns
+    -------
+    _: np.ndarray
+        The float32 embeddings of shape (len(prompts), dim).
+    """
+    load_tokenizer, encode, load_model = MODEL_TYPES[model_type]
+    tokenizer = load_tokenizer(model_path)
+    model = load_model(model_path, dtype=dtype, device=device)
+    return embed_sequences(
+        model,
+        [encode(prompt, tokenizer) for prompt in prompts],
+        n_layers=n_layers,
+        pooling=pooling,
+        normalize=normalize,
+        max_batch_tokens=max_batch_tokens,
+        output_path=output_path,
+    )
@@ -1,6 +1,18 @@
+import math
 import torch
+from functools import partial
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import Hashable, List, Optional, Tuple
+
+from python_lib.nlp.cache import EvictionPolicy
+from python_lib.nlp.model import (
+    RestrictedOutput,
+    cache_length,
+    _fuse_state_dict,
+    _split_state_dict,
+)
+from python_lib.nlp.quantize import linear_into
+from python_lib.nlp.workspace import DecodeWorkspace
 
 
 @dataclass
@@ -28,6 +40,11 @@ class TransformerArgs:
         Vocabulary size.
     rope_theta: float
         Coefficient used to initialize rotation matrix.
+    fuse_projections: bool
+        Whether to run the queries, keys and values projections as one
+        matrix multiplication (and the gate and up projections as another
+        one). The weights are concatenated when loading the state dict,
+        which keeps checkpoints compatible.
     """
     dim: int
     n_layers: int
@@ -40,6 +57,7 @@ class TransformerArgs:
     attn_logit_softcapping: float
     final_logit_softcapping: float
     rope_theta: float = 10000
+    fuse_projections: bool = False
 
 
 class RMSNorm(torch.nn.Module):
@@ -52,11 +70,24 @@ class RMSNorm(torch.nn.Module):
         Embedding dimension.
     eps: float
         Epsilon value to avoid 0 division.
+    device: torch.device
+        Device on which the parameters are allocated. On "meta", no
+        memory is allocated until the weights are assigned.
+    dtype: torch.dtype
+        Precision type of the parameters.
     """
 
-    def __init__(self, dims: int, eps: float = 1e-5):
+    def __init__(
+        self,
+        dims: int,
+        eps: float = 1e-5,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ):
         super().__init__()
-        self.weight = torch.nn.Parameter(torch.ones(dims))
+        self.weight = torch.nn.Parameter(
+            torch.ones(dims, device=device, dtype=dtype)
+        )
         self.eps = eps
 
     def _norm(self, x):
@@ -80,6 +111,36 @@ class RMSNorm(torch.nn.Module):
         output = output * (1 + self.weight.float())
         return output.type_as(x)
 
+    def decode(
+        self,
+        x: torch.Tensor,
+        out: torch.Tensor,
+        workspace: DecodeWorkspace,
+    ):
+        """
+        Forward pass of one token in preallocated buffers.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The input tensor of shape (batch, dim).
+        out: torch.Tensor
+            The output tensor, may be the same as the input one.
+        workspace: DecodeWorkspace
+            Preallocated buffers.
+        """
+        x_float = workspace.x_float
+        x_float.copy_(x)
+        torch.square(x_float, out=workspace.x_square)
+        torch.mean(
+            workspace.x_square, dim=-1, keepdim=True, out=workspace.stats
+        )
+        workspace.stats.add_(self.eps).rsqrt_()
+        x_float.mul_(workspace.stats)
+        torch.mul(x_float, self.weight, out=workspace.x_square)
+        x_float.add_(workspace.x_square)
+        out.copy_(x_float)
+
 
 class Attention(torch.nn.Module):
     """
@@ -89,10 +150,21 @@ class Attention(torch.nn.Module):
     ----------
     args: TransformerArgs
         Model parameters.
+    device: torch.device
+        Device on which the parameters are allocated. On "meta", no
+        memory is allocated until the weights are assigned.
+    dtype: torch.dtype
+        Precision type of the parameters.
     """
 
-    def __init__(self, args: TransformerArgs):
+    def __init__(
+        self,
+        args: TransformerArgs,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ):
         super().__init__()
+        factory_kwargs = {"device": device, "dtype": dtype}
         self.args = args
 
         self.n_heads: int = args.n_heads
@@ -102,17 +174,43 @@ class Attention(torch.nn.Module):
 
         self.scale = self.args.head_dim**-0.5
 
-        self.q_proj = torch.nn.Linear(
-            args.dim, args.n_heads * args.head_dim, bias=False
-        )
-        self.k_proj = torch.nn.Linear(
-            args.dim, args.n_kv_heads * args.head_dim, bias=False
-        )
-        self.v_proj = torch.nn.Linear(
-            args.dim, args.n_kv_heads * args.head_dim, bias=False
-        )
+        self.projection_sizes = {
+            "qkv_proj": [
+                args.n_heads * args.head_dim,
+                args.n_kv_heads * args.head_dim,
+                args.n_kv_heads * args.head_dim,
+            ]
+        }
+        if args.fuse_projections:
+            self.qkv_proj = torch.nn.Linear(
+                args.dim, sum(self.projection_sizes["qkv_proj"]),
+                bias=False, **factory_kwargs
+            )
+            names = ["q_proj", "k_proj", "v_proj"]
+            self.fused_names = {"qkv_proj": names}
+            self._register_load_state_dict_pre_hook(partial(
+                _fuse_state_dict, names=names, fused_name="qkv_proj"
+            ))
+            self._register_state_dict_hook(partial(
+                _split_state_dict, names=names, fused_name="qkv_proj"
+            ))
+
+        else:
+            self.q_proj = torch.nn.Linear(
+                args.dim, args.n_heads * args.head_dim,
+                bias=False, **factory_kwargs
+            )
+            self.k_proj = torch.nn.Linear(
+                args.dim, args.n_kv_heads * args.head_dim,
+                bias=False, **factory_kwargs
+            )
+            self.v_proj = torch.nn.Linear(
+                args.dim, args.n_kv_heads * args.head_dim,
+                bias=False, **factory_kwargs
+            )
         self.o_proj = torch.nn.Linear(
-            args.n_heads * args.head_dim, args.dim, bias=False
+            args.n_heads * args.head_dim, args.dim,
+            bias=False, **factory_kwargs
         )
 
     @staticmethod
@@ -141,6 +239,37 @@ class Attention(torch.nn.Module):
         mask = mask.type(dtype) * -1e9
         return mask
 
+    @staticmethod
+    def create_block_diagonal_causal_mask(
+        lengths: List[int], dtype: torch.dtype = torch.float32
+    ) -> torch.Tensor:
+        """
+        Create the causal mask of sequences packed in one row.
+
+        A position only attends to the previous positions of its own
+        sequence.
+
+        Parameters
+        ---------
+        lengths: [int]
+            Length of each packed sequence.
+        dtype: torch.dtype
+            Precision type.
+
+        Returns
+        -------
+        mask: torch.Tensor
+            The block diagonal causal mask.
+        """
+        indices = torch.arange(sum(lengths))
+        segments = torch.repeat_interleave(
+            torch.arange(len(lengths)), torch.tensor(lengths)
+        )
+        mask = (indices[:, None] < indices[None]) | \
+            (segments[:, None] != segments[None])
+        mask = mask.type(dtype) * -1e9
+        return mask
+
     @staticmethod
     def create_rotation_matrix(
         positions: torch.Tensor,
@@ -194,6 +323,7 @@ class Attention(torch.nn.Module):
         rotation_matrix: torch.Tensor,
         mask: Optional[torch.Tensor] = None,
         cache: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        eviction: Optional[EvictionPolicy] = None,
     ) -> Tuple[torch.Tensor, Optional[Tuple[torch.Tensor, torch.Tensor]]]:
         """
         Forward pass.
@@ -209,6 +339,8 @@ class Attention(torch.nn.Module):
         cache: (key_cache, value_cache): (torch.Tensor, torch.Tensor)
             cache for keys and values
             for generating tokens with past context.
+        eviction: EvictionPolicy
+            Eviction policy of the cache for keys and values.
 
         Returns
         -------
@@ -217,7 +349,13 @@ class Attention(torch.nn.Module):
             (keys, values): cache for keys and values
         """
         B, L, D = x.shape
-        queries, keys, values = self.q_proj(x), self.k_proj(x), self.v_proj(x)
+        if self.args.fuse_projections:
+            queries, keys, values = self.qkv_proj(x).split(
+                self.projection_sizes["qkv_proj"], dim=-1
+            )
+        else:
+            queries = self.q_proj(x)
+            keys, values = self.k_proj(x), self.v_proj(x)
 
         # Prepare the queries, keys and values for the attention computation.
         queries = queries.reshape(B, L, self.n_heads, -1).transpose(1, 2)
@@ -260,8 +398,100 @@ class Attention(torch.nn.Module):
         output = torch.matmul(scores, values)
         output = output.transpose(1, 2).contiguous().reshape(B, L, -1)
 
+        if eviction is not None:
+            keys, values = eviction(
+                keys, values, scores, rope_theta=self.args.rope_theta
+            )
+
         return self.o_proj(output), (keys, values)
 
+    def decode(
+        self,
+        x: torch.Tensor,
+        out: torch.Tensor,
+        rotation_matrix: torch.Tensor,
+        workspace: DecodeWorkspace,
+        layer: int,
+    ):
+        """
+        Forward pass of one token in preallocated buffers.
+
+        The cache for keys and values of the layer is updated in place.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The input tensor of shape (batch, dim).
+        out: torch.Tensor
+            The output tensor of shape (batch, dim).
+        rotation_matrix: torch.Tensor
+            Rotation matrix used for positional encoding.
+        workspace: DecodeWorkspace
+            Preallocated buffers.
+        layer: int
+            Index of the Transformer block.
+        """
+        B = x.shape[0]
+        S = workspace.length + 1
+        head_dim = self.args.head_dim
+
+        if self.args.fuse_projections:
+            linear_into(x, self.qkv_proj, workspace.qkv)
+            queries, keys, values = workspace.qkv.split(
+                self.projection_sizes["qkv_proj"], dim=-1
+            )
+        else:
+            queries, keys, values = workspace.q, workspace.k, workspace.v
+            linear_into(x, self.q_proj, queries)
+            linear_into(x, self.k_proj, keys)
+            linear_into(x, self.v_proj, values)
+
+        # Positional encoding: x R^T for each head.
+        rotation = rotation_matrix[0].t().type(x.dtype)
+        queries = torch.mm(
+            queries.reshape(B * self.n_heads, head_dim),
+            rotation,
+            out=workspace.q_rot,
+        ).view(B, self.n_heads, 1, head_dim)
+        keys = torch.mm(
+            keys.reshape(B * self.n_kv_heads, head_dim),
+            rotation,
+            out=workspace.k_rot,
+        )
+
+        # Write the new key and value in the cache, repeated for each query
+        # head sharing them.
+        key_cache = workspace.keys[layer]
+        value_cache = workspace.values[layer]
+        key_cache[:, :, S - 1].view(
+            B, self.n_kv_heads, self.repeats, head_dim
+        ).copy_(keys.view(B, self.n_kv_heads, 1, head_dim))
+        value_cache[:, :, S - 1].view(
+            B, self.n_kv_heads, self.repeats, head_dim
+        ).copy_(values.view(B, self.n_kv_heads, 1, head_dim))
+        keys = key_cache[:, :, :S]
+        values = value_cache[:, :, :S]
+
+        n_scores = B * self.n_heads * S
+        scores = workspace.scores[:n_scores].view(B, self.n_heads, 1, S)
+        probs = workspace.probs[:n_scores].view(B, self.n_heads, 1, S)
+
+        torch.matmul(queries, keys.transpose(2, 3), out=scores)
+        scores.mul_(self.scale)
+
+        # Softmax in float32.
+        probs.copy_(scores)
+        torch.amax(probs, dim=-1, keepdim=True, out=workspace.probs_max)
+        probs.sub_(workspace.probs_max).exp_()
+        torch.sum(probs, dim=-1, keepdim=True, out=workspace.probs_sum)
+        probs.div_(workspace.probs_sum)
+        scores.copy_(probs)
+
+        # (B, n_heads, 1, head_dim) has the memory layout of
+        # (B, 1, n_heads * head_dim).
+        torch.matmul(scores, values, out=workspace.attn)
+        linear_into(workspace.attn.view(B, -1), self.o_proj, out)
+
 
 class FeedForward(torch.nn.Module):
     """
@@ -271,14 +501,50 @@ class FeedForward(torch.nn.Module):
     ----------
     args: TransformerArgs
         Model parameters.
+    device: torch.device
+        Device on which the parameters are allocated. On "meta", no
+        memory is allocated until the weights are assigned.
+    dtype: torch.dtype
+        Precision type of the parameters.
     """
 
-    def __init__(self, args: TransformerArgs):
+    def __init__(
+        self,
+        args: TransformerArgs,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ):
         super().__init__()
+        factory_kwargs = {"device": device, "dtype": dtype}
+        self.args = args
+        self.activation = torch.nn.GELU(approximate="tanh")
+
+        self.projection_sizes = {
+            "gate_up_proj": [args.hidden_dim, args.hidden_dim]
+        }
+        if args.fuse_projections:
+            self.gate_up_proj = torch.nn.Linear(
+                args.dim, 2 * args.hidden_dim, bias=False, **factory_kwargs
+            )
+            names = ["gate_proj", "up_proj"]
+            self.fused_names = {"gate_up_proj": names}
+            self._register_load_state_dict_pre_hook(partial(
+                _fuse_state_dict, names=names, fused_name="gate_up_proj"
+            ))
+            self._register_state_dict_hook(partial(
+                _split_state_dict, names=names, fused_name="gate_up_proj"
+            ))
 
-        self.gate_proj = torch.nn.Linear(args.dim, args.hidden_dim, bias=False)
-        self.up_proj = torch.nn.Linear(args.dim, args.hidden_dim, bias=False)
-        self.down_proj = torch.nn.Linear(args.hidden_dim, args.dim, bias=False)
+        else:
+            self.gate_proj = torch.nn.Linear(
+                args.dim, args.hidden_dim, bias=False, **factory_kwargs
+            )
+            self.up_proj = torch.nn.Linear(
+                args.dim, args.hidden_dim, bias=False, **factory_kwargs
+            )
+        self.down_proj = torch.nn.Linear(
+            args.hidden_dim, args.dim, bias=False, **factory_kwargs
+        )
 
     def forward(self, x) -> torch.Tensor:
         """
@@ -294,10 +560,50 @@ class FeedForward(torch.nn.Module):
         _: torch.Tensor
             The output tensor.
         """
-        return self.down_proj(
-            torch.nn.GELU(approximate="tanh")(self.gate_proj(x)) *
-            self.up_proj(x)
-        )
+        if self.args.fuse_projections:
+            gate, up = self.gate_up_proj(x).split(
+                self.projection_sizes["gate_up_proj"], dim=-1
+            )
+        else:
+            gate, up = self.gate_proj(x), self.up_proj(x)
+        return self.down_proj(self.activation(gate) * up)
+
+    def decode(
+        self,
+        x: torch.Tensor,
+        out: torch.Tensor,
+        workspace: DecodeWorkspace,
+    ):
+        """
+        Forward pass of one token in preallocated buffers.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The input tensor of shape (batch, dim).
+        out: torch.Tensor
+            The output tensor of shape (batch, dim).
+        workspace: DecodeWorkspace
+            Preallocated buffers.
+        """
+        if self.args.fuse_projections:
+            linear_into(x, self.gate_up_proj, workspace.gate_up)
+            gate, up = workspace.gate_up.split(
+                self.projection_sizes["gate_up_proj"], dim=-1
+            )
+        else:
+            gate, up = workspace.gate, workspace.up
+            linear_into(x, self.gate_proj, gate)
+            linear_into(x, self.up_proj, up)
+
+        # GELU (tanh approximation) in place.
+        scratch = workspace.scratch
+        torch.mul(gate, gate, out=scratch)
+        scratch.mul_(gate).mul_(0.044715).add_(gate)
+        scratch.mul_(math.sqrt(2.0 / math.pi)).tanh_().add_(1.0).mul_(0.5)
+        gate.mul_(scratch)
+        gate.mul_(up)
+        linear_into(gate, self.down_proj, out)
 
 
 class TransformerBlock(torch.nn.Module):
@@ -308,18 +614,37 @@ class TransformerBlock(torch.nn.Module):
     ----------
     args: TransformerArgs
         Model parameters.
+    device: torch.device
+        Device on which the parameters are allocated. On "meta", no
+        memory is allocated until the weights are assigned.
+    dtype: torch.dtype
+        Precision type of the parameters.
     """
 
-    def __init__(self, args: TransformerArgs):
+    def __init__(
+        self,
+        args: TransformerArgs,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ):
         super().__init__()
+        factory_kwargs = {"device": device, "dtype": dtype}
         self.n_heads = args.n_heads
         self.dim = args.dim
-        self.self_attn = Attention(args)
-        self.mlp = FeedForward(args=args)
-        self.input_layernorm = RMSNorm(args.dim, eps=args.norm_eps)
-        self.post_attention_layernorm = RMSNorm(args.dim, eps=args.norm_eps)
-        self.pre_feedforward_layernorm = RMSNorm(args.dim, eps=args.norm_eps)
-        self.post_feedforward_layernorm = RMSNorm(args.dim, eps=args.norm_eps)
+        self.self_attn = Attention(args, **factory_kwargs)
+        self.mlp = FeedForward(args=args, **factory_kwargs)
+        self.input_layernorm = RMSNorm(
+            args.dim, eps=args.norm_eps, **factory_kwargs
+        )
+        self.post_attention_layernorm = RMSNorm(
+            args.dim, eps=args.norm_eps, **factory_kwargs
+        )
+        self.pre_feedforward_layernorm = RMSNorm(
+            args.dim, eps=args.norm_eps, **factory_kwargs
+        )
+        self.post_feedforward_layernorm = RMSNorm(
+            args.dim, eps=args.norm_eps, **factory_kwargs
+        )
         self.args = args
 
     def forward(
@@ -331,6 +656,7 @@ class TransformerBlock(torch.nn.Module):
             Tuple[torch.Tensor,
                   Optional[Tuple[torch.Tensor, torch.Tensor]]]
         ] = None,
+        eviction: Optional[EvictionPolicy] = None,
     ) -> Tuple[torch.Tensor, Optional[Tuple[torch.Tensor, torch.Tensor]]]:
         """
         Forward pass.
@@ -346,6 +672,8 @@ class TransformerBlock(torch.nn.Module):
         cache: (key_cache, value_cache): (torch.Tensor, torch.Tensor)
             cache for keys and values
             for generating tokens with past context.
+        eviction: EvictionPolicy
+            Eviction policy of the cache for keys and values.
 
         Returns
         -------
@@ -358,12 +686,56 @@ class TransformerBlock(torch.nn.Module):
             rotation_matrix=rotation_matrix,
             mask=mask,
             cache=cache,
+            eviction=eviction,
         )
         h = x + self.post_attention_layernorm(r)
         r = self.mlp(self.pre_feedforward_layernorm(h))
         out = h + self.post_feedforward_layernorm(r)
         return out, cache
 
+    def decode(
+        self,
+        h: torch.Tensor,
+        rotation_matrix: torch.Tensor,
+        workspace: DecodeWorkspace,
+        layer: int,
+    ):
+        """
+        Forward pass of one token in preallocated buffers.
+
+        The residual stream is updated in place.
+
+        Parameters
+        ----------
+        h: torch.Tensor
+            The residual stream of shape (batch, dim).
+        rotation_matrix: torch.Tensor
+            Rotation matrix used for positional encoding.
+        workspace: DecodeWorkspace
+            Preallocated buffers.
+        layer: int
+            Index of the Transformer block.
+        """
+        x, out = workspace.x, workspace.out
+        self.input_layernorm.decode(h, out=x, workspace=workspace)
+        self.self_attn.decode(
+            x,
+            out=out,
+            rotation_matrix=rotation_matrix,
+            workspace=workspace,
+            layer=layer,
+        )
+        self.post_attention_layernorm.decode(
+            out, out=x, workspace=workspace
+        )
+        h.add_(x)
+        self.pre_feedforward_layernorm.decode(h, out=x, workspace=workspace)
+        self.mlp.decode(x, out=out, workspace=workspace)
+        self.post_feedforward_layernorm.decode(
+            out, out=x, workspace=workspace
+        )
+        h.add_(x)
+
 
 class Transformer(torch.nn.Module):
     """
@@ -373,26 +745,51 @@ class Transformer(torch.nn.Module):
     ----------
     args: TransformerArgs
         Model parameters.
+    dtype: torch.dtype
+        Precision type of the weights and activations. The RMSNorm
+        statistics, the softmax and the final logits are computed
+        in float32 whatever the precision.
+    device: torch.device
+        Device on which the parameters are allocated. On "meta", no
+        memory is allocated until the weights are assigned from
+        a checkpoint (see `python_lib.nlp.loader.build_model`).
     """
 
-    def __init__(self, args: TransformerArgs):
+    def __init__(
+        self,
+        args: TransformerArgs,
+        dtype: torch.dtype = torch.float32,
+        device: Optional[torch.device] = None,
+    ):
         super().__init__()
+        factory_kwargs = {"device": device, "dtype": dtype}
         self.args = args
         self.vocab_size = args.vocab_size
         self.n_layers = args.n_layers
+        # Normalizer of the embeddings.
+        self.embed_scale = args.dim ** 0.5
         assert self.vocab_size > 0
-        self.embed_tokens = torch.nn.Embedding(args.vocab_size, args.dim)
+        self.embed_tokens = torch.nn.Embedding(
+            args.vocab_size, args.dim, **factory_kwargs
+        )
         self.layers = torch.nn.ModuleList([
-            TransformerBlock(args=args) for _ in range(args.n_layers)
+            TransformerBlock(args=args, **factory_kwargs)
+            for _ in range(args.n_layers)
         ])
-        self.norm = RMSNorm(args.dim, eps=args.norm_eps)
-        self.output = torch.nn.Linear(args.dim, args.vocab_size, bias=False)
+        self.norm = RMSNorm(args.dim, eps=args.norm_eps, **factory_kwargs)
+        self.output = torch.nn.Linear(
+            args.dim, args.vocab_size, bias=False, **factory_kwargs
+        )
+        self.restricted_output = RestrictedOutput()
 
     def forward(
         self,
         x: torch.Tensor,
         cache=None,
-        n_layers=None
+        n_layers=None,
+        eviction: Optional[List[EvictionPolicy]] = None,
+        allowed_tokens: Optional[torch.Tensor] = None,
+        allowed_key: Optional[Hashable] = None,
     ) -> Tuple[torch.Tensor, Optional[list]]:
         """
         Forward pass.
@@ -406,39 +803,49 @@ class Transformer(torch.nn.Module):
             for generating tokens with past context.
         n_layers: Int
             Modifier of the number of Transformer blocks.
+        eviction: [EvictionPolicy]
+            Eviction policy of the cache for each layer.
+        allowed_tokens: torch.Tensor
+            Ids of the only tokens whose logits are computed, None for
+            the whole vocabulary.
+        allowed_key: Hashable
+            Identifier of `allowed_tokens`, see `RestrictedOutput`.
 
         Returns
         -------
         (output, cache): (torch.Tensor, list)
-            output: the output tensor
+            output: the output tensor, whose last axis follows
+                `allowed_tokens` when given
             cache: cache for keys and values for each layer
         """
         h = self.embed_tokens(x)
         normalizer = torch.tensor(h.shape[-1] ** 0.5, dtype=h.dtype)
         h = h * normalizer
 
+        offset = cache_length(cache)
+
         mask = None
         if h.shape[1] > 1:
             mask = Attention.create_additive_causal_mask(h.shape[1])
             mask = mask.type(h.dtype)
+            if offset > 0:
+                # The new tokens attend to all the cached ones.
+                mask = torch.cat(
+                    [torch.zeros(h.shape[1], offset, dtype=h.dtype), mask],
+                    dim=1,
+                )
             mask = mask.to(h.device)
 
-            positions = torch.arange(
-                1, h.shape[1] + 1, device=h.device
-            ).unsqueeze(1)
-
-        else:
-            key_cache = cache[0][0]
-            positions = torch.tensor(
-                [key_cache.shape[2] + 1], device=h.device
-            ).unsqueeze(1)
+        positions = torch.arange(
+            offset + 1, offset + h.shape[1] + 1, device=h.device
+        ).unsqueeze(1)
 
         rotation_matrix = Attention.create_rotation_matrix(
             positions=positions,
             embedding_dim=self.args.head_dim,
             rope_theta=self.args.rope_theta,
             device=h.device,
-        )
+        ).type(h.dtype)
 
         if cache is None:
             cache = [None] * len(self.layers)
@@ -448,11 +855,23 @@ class Transformer(torch.nn.Module):
                 break
 
             h, cache[e] = layer(
-                h, rotation_matrix=rotation_matrix, mask=mask, cache=cache[e]
+                h,
+                rotation_matrix=rotation_matrix,
+                mask=mask,
+                cache=cache[e],
+                eviction=eviction[e] if eviction is not None else None,
             )
 
         h = self.norm(h)
-        logits = self.output(h)
+        if allowed_tokens is not None:
+            logits = torch.nn.functional.linear(
+                h,
+                self.restricted_output(
+                    self.output, allowed_tokens, allowed_key
+                ).type_as(h),
+            ).float()
+        else:
+            logits = self.output(h).float()
         """
         # Do not use for now.
         if self.args.final_logit_softcapping is not None:
@@ -462,3 +881,171 @@ class Transformer(torch.nn.Module):
         """
 
         return logits, cache
+
+    def features(
+        self,
+        x: torch.Tensor,
+        lengths: Optional[List[int]] = None,
+        n_layers=None,
+        prefix: Optional[list] = None,
+    ) -> Tuple[torch.Tensor, List[list]]:
+        """
+        Compute the normalized hidden states, before the output layer.
+
+        The rows may contain several packed sequences, each one only
+        attending to itself with positions starting at 1. The output layer
+        can then be applied to the positions of interest only.
+
+        With a `prefix` cache, every packed sequence continues the same
+        prefix: it also attends to all the cached tokens and its positions
+        start after them. The prefix is shared, not copied per sequence.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The input tensor of shape (batch, sum(lengths)).
+        lengths: [int]
+            Length of each packed sequence, None for one sequence per row.
+        n_layers: Int
+            Modifier of the number of Transformer blocks.
+        prefix: [(torch.Tensor, torch.Tensor)]
+            Cache for keys and values of a prefix shared by the sequences,
+            for each layer.
+
+        Returns
+        -------
+        (h, caches): (torch.Tensor, [list])
+            h: the hidden states of shape (batch, sum(lengths), dim)
+            caches: cache for keys and values for each layer, for each
+                sequence, without the prefix
+        """
+        if lengths is None:
+            lengths = [x.shape[1]]
+        assert x.shape[1] == sum(lengths)
+        offset = prefix[0][0].shape[2] if prefix is not None else 0
+
+        h = self.embed_tokens(x)
+        normalizer = torch.tensor(h.shape[-1] ** 0.5, dtype=h.dtype)
+        h = h * normalizer
+
+        mask = Attention.create_block_diagonal_causal_mask(lengths)
+        mask = mask.type(h.dtype)
+        if offset > 0:
+            mask = torch.cat(
+                [torch.zeros(mask.shape[0], offset, dtype=h.dtype), mask],
+                dim=1,
+            )
+        mask = mask.to(h.device)
+
+        positions = torch.cat([
+            torch.arange(offset + 1, offset + length + 1, device=h.device)
+            for length in lengths
+        ]).unsqueeze(1)
+
+        rotation_matrix = Attention.create_rotation_matrix(
+            positions=positions,
+            embedding_dim=self.args.head_dim,
+            rope_theta=self.args.rope_theta,
+            device=h.device,
+        ).type(h.dtype)
+
+        cache = []
+        for e, layer in enumerate(self.layers):
+            if n_layers is not None and e == n_layers:
+                break
+
+            h, layer_cache = layer(
+                h,
+                rotation_matrix=rotation_matrix,
+                mask=mask,
+                cache=prefix[e] if prefix is not None else None,
+            )
+            cache.append(layer_cache)
+
+        caches = [[] for _ in lengths]
+        for keys, values in cache:
+            for caches_i, keys_i, values_i in zip(
+                caches,
+                keys[:, :, offset:].split(lengths, dim=2),
+                values[:, :, offset:].split(lengths, dim=2),
+            ):
+                caches_i.append((keys_i, values_i))
+
+        return self.norm(h), caches
+
+    def forward_packed(
+        self,
+        x: torch.Tensor,
+        lengths: List[int],
+        n_layers=None,
+    ) -> Tuple[torch.Tensor, List[list]]:
+        """
+        Forward pass of sequences packed in one row, without padding.
+
+        Each sequence only attends to itself and its positions start at 1,
+        so that its outputs are the ones of a forward pass on it alone.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The input tensor of shape (1, sum(lengths)).
+        lengths: [int]
+            Length of each packed sequence.
+        n_layers: Int
+            Modifier of the number of Transformer blocks.
+
+        Returns
+        -------
+        (output, caches): (torch.Tensor, [list])
+            output: the output tensor of shape (1, sum(lengths), vocab)
+            caches: cache for keys and values for each layer, for each
+                sequence
+        """
+        h, caches = self.features(x, lengths, n_layers=n_layers)
+        return self.output(h).float(), caches
+
+    @torch.no_grad()
+    def decode(
+        self,
+        x: torch.Tensor,
+        workspace: DecodeWorkspace,
+    ) -> torch.Tensor:
+        """
+        Forward pass of one token per sequence in preallocated buffers.
+
+        This is the allocation free counterpart of `forward` for the decode
+        steps: the cache for keys and values lives in the workspace, which
+        has to be filled with `DecodeWorkspace.load_cache` after prefill.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The tokens of shape (batch,).
+        workspace: DecodeWorkspace
+            Preallocated buffers.
+
+        Returns
+        -------
+        logits: torch.Tensor
+            The logits of shape (batch, vocab_size), owned by the workspace
+            and overwritten by the next call.
+        """
+        h = workspace.h
+        torch.index_select(self.embed_tokens.weight, 0, x, out=h)
+        h.mul_(self.embed_scale)
+
+        workspace.set_position(workspace.length + 1)
+        for e, layer in enumerate(self.layers):
+            layer.decode(
+                h,
+                rotation_matrix=workspace.rotation,
+                workspace=workspace,
+                layer=e,
+            )
+        workspace.length += 1
+
+        self.norm.decode(h, out=workspace.x, workspace=workspace)
+        linear_into(workspace.x, self.output, workspace.logits_mm)
+        if workspace.logits_mm is not workspace.logits:
+            workspace.logits.copy_(workspace.logits_mm)
+        return workspace.logits
@@ -1,7 +1,12 @@
+import sys
 import torch
-from typing import Generator, Optional
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+from typing import Generator, List, Optional, Tuple, Union
 
 from python_lib.nlp.model import Transformer
+from python_lib.nlp.workspace import DecodeWorkspace
+from python_lib.nlp.cache import EvictionPolicy, OffloadedCache
 
 
 def predict_no_cache(
@@ -43,8 +48,92 @@ def predict_no_cache(
     return sample(logits)
 
 
+def export_logits(
+    logits: torch.Tensor,
+    last_only: bool = False,
+    top_k: Optional[int] = None,
+    out: Optional[np.ndarray] = None,
+    shared_memory_name: Optional[str] = None,
+) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray], int]:
+    """
+    Reduce the logits on their device before sending them to the host.
+
+    Parameters
+    ----------
+    logits: torch.Tensor
+        The logits of shape (batch, sequence, vocab).
+    last_only: bool
+        Whether to only keep the last position of the sequence.
+    top_k: int
+        Number of best tokens to keep per position, None for all.
+    out: np.ndarray
+        Preallocated C-contiguous float32 buffer receiving the flattened
+        logits.
+    shared_memory_name: str
+        Name of an existing shared memory segment receiving the flattened
+        float32 logits. The segment is owned by the caller's process,
+        which unlinks it: it is not tracked here.
+
+    Returns
+    -------
+    _: np.ndarray | (np.ndarray, np.ndarray) | int
+        The flattened logits by default, the flattened ids (int32) and
+        values of the top-k tokens with `top_k`, the buffer with `out`,
+        the number of values written with `shared_memory_name`.
+    """
+    if last_only:
+        logits = logits[:, -1:]
+
+    if top_k is not None:
+        assert out is None and shared_memory_name is None
+        values, ids = torch.topk(logits, top_k, dim=-1)
+        return (
+            ids.int().cpu().numpy().flatten(),
+            values.float().cpu().numpy().flatten(),
+        )
+
+    # The buffers are filled straight from the device, converting to
+    # float32 during the copy, without an intermediate host tensor.
+    logits = logits.detach().reshape(-1)
+    if out is not None:
+        # A reshape of a non-contiguous array would be a copy, leaving
+        # `out` unchanged.
+        assert out.flags.c_contiguous
+        assert out.dtype == np.float32 and out.size >= logits.numel()
+        torch.from_numpy(out.reshape(-1)[:logits.numel()]).copy_(logits)
+        return out
+
+    if shared_memory_name is not None:
+        # Attaching registers the segment to the resource tracker, which
+        # would unlink it at exit although it belongs to the caller.
+        if sys.version_info >= (3, 13):
+            segment = shared_memory.SharedMemory(
+                name=shared_memory_name, track=False
+            )
+        else:
+            segment = shared_memory.SharedMemory(name=shared_memory_name)
+            resource_tracker.unregister(segment._name, "shared_memory")
+        try:
+            assert segment.size >= logits.numel() * 4
+            buffer = np.ndarray(
+                (logits.numel(),), dtype=np.float32, buffer=segment.buf
+            )
+            torch.from_numpy(buffer).copy_(logits)
+            del buffer
+        finally:
+            segment.close()
+        return logits.numel()
+
+    return logits.float().cpu().numpy()
+
+
 def generate_with_cache(
-    prompt: torch.Tensor, model: Transformer, temp: float = 0.0
+    prompt: torch.Tensor,
+    model: Transformer,
+    temp: float = 0.0,
+    eviction: Optional[List[EvictionPolicy]] = None,
+    cache: Optional[OffloadedCache] = None,
+    allowed_tokens: Optional[List[int]] = None,
 ) -> Generator[torch.Tensor, None, None]:
     """
     Generate text based on the given prompt and model.
@@ -57,6 +146,14 @@ def generate_with_cache(
         The model to use for generation.
     temp: float
         The temperature for sampling. If temp is 0, use max sampling.
+    eviction: [EvictionPolicy]
+        Eviction policy of the cache for each layer, keeps the memory and
+        the latency per token constant for endless sessions.
+    cache: OffloadedCache
+        Empty cache that spills cold blocks to the disk.
+    allowed_tokens: [int]
+        Ids of the only tokens that may be generated: the logits of the
+        other tokens are not computed.
 
     Returns
     -------
@@ -72,11 +169,83 @@ def generate_with_cache(
             )[0]
         )
 
+    allowed_key = None
+    if allowed_tokens is not None:
+        # Identify the set once instead of reading the ids back from the
+        # device at each step.
+        allowed_key = tuple(allowed_tokens)
+        allowed_tokens = torch.tensor(
+            allowed_tokens, dtype=torch.long, device=prompt.device
+        )
+
     y = prompt
-    cache = None
 
     while True:
-        logits, cache = model(y[None], cache=cache)
+        logits, cache = model(
+            y[None],
+            cache=cache,
+            eviction=eviction,
+            allowed_tokens=allowed_tokens,
+            allowed_key=allowed_key,
+        )
         logits = logits[:, -1, :]
+        y = sample(logits)
+        if allowed_tokens is not None:
+            y = allowed_tokens[y]
+        yield y
+
+
+def generate_with_workspace(
+    prompt: torch.Tensor,
+    model: Transformer,
+    temp: float = 0.0,
+    max_seq_len: int = 4096,
+) -> Generator[torch.Tensor, None, None]:
+    """
+    Generate text based on the given prompt and model.
+
+    The decode steps run in buffers preallocated once for the whole
+    generation.
+
+    Parameters
+    ----------
+    prompt: torch.Tensor
+        The input prompt.
+    model: Transformer
+        The model to use for generation.
+    temp: float
+        The temperature for sampling. If temp is 0, use max sampling.
+    max_seq_len: int
+        Maximal number of tokens (prompt included) in the cache.
+
+    Returns
+    -------
+    y: torch.Tensor
+        The generated text.
+    """
+    def sample(logits: torch.Tensor) -> torch.Tensor:
+        return (
+            torch.argmax(logits, dim=-1)
+            if temp == 0
+            else torch.multinomial(
+                torch.softmax(logits, dim=-1) * (1 / temp), 1
+            )[0]
+        )
+
+    logits, cache = model(prompt[None])
+    logits = logits[:, -1, :]
+
+    workspace = DecodeWorkspace(
+        model.args,
+        batch_size=1,
+        max_seq_len=max_seq_len,
+        dtype=model.norm.weight.dtype,
+        device=logits.device,
+    )
+    workspace.load_cache(cache)
+    del cache
+
+    while workspace.length < max_seq_len:
         y = sample(logits)
         yield y
+        logits = model.decode(y, workspace)
@@ -1,18 +1,104 @@
 import time
 import torch
-from typing import List
+from typing import List, Optional
 from pathlib import Path
+from functools import lru_cache
 
 from python_lib.nlp.llama2.tokenizer import Tokenizer
 from python_lib.nlp.generate import generate_with_cache
 from python_lib.nlp.model import Transformer, TransformerArgs
+from python_lib.nlp.loader import build_model
+from python_lib.nlp.streaming import build_streaming_model
+from python_lib.nlp.quantize import load_quantized_state
+from python_lib.nlp.registry import get_model
+from python_lib.weight import load_llama_state
+
+
+def _load_model_args() -> TransformerArgs:
+    """
+    Get the model parameters.
+
+    Returns
+    -------
+    _: TransformerArgs
+        Model parameters.
+    """
+    return TransformerArgs(
+        dim=4096,
+        n_layers=32,
+        head_dim=128,
+        hidden_dim=11008,
+        n_heads=32,
+        n_kv_heads=32,
+        norm_eps=1e-5,
+        vocab_size=32000,
+        rope_theta=10000
+    )
+
+
+def load_llama2_model(
+    model_path: str,
+    bits: Optional[int] = None,
+    group_size: Optional[int] = None,
+    dtype: torch.dtype = torch.float32,
+    device: str = "mps",
+) -> Transformer:
+    """
+    Get the model, loaded once and then kept in memory for the next calls.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    bits: int
+        Number of bits of the quantized weights (8 or 4), None to keep
+        the weights of the checkpoint.
+    group_size: int
+        Number of consecutive input features sharing a quantization scale,
+        None for one scale per output channel.
+    dtype: torch.dtype
+        Precision type of the weights and activations.
+    device: str
+        Device of the model.
+
+    Returns
+    -------
+    model: Transformer
+        The model.
+    """
+    def load_state():
+        return load_llama_state(model_path, lazy=False)
+
+    def load_model() -> Transformer:
+        if bits is None:
+            state = load_state()
+        else:
+            state = load_quantized_state(
+                model_path, load_state, bits, group_size
+            )
+
+        model = build_model(
+            Transformer, _load_model_args(), state,
+            dtype=dtype, bits=bits, group_size=group_size,
+        )
+        del state
+        return model.to(device)
+
+    return get_model(
+        model_path, load_model, dtype=dtype, device=device,
+        bits=bits, group_size=group_size,
+    )
 
 
 def generate(
     prompt: str,
     model_path: str,
     temp: float = 0,
-    max_tokens: int = 128
+    max_tokens: int = 128,
+    bits: Optional[int] = None,
+    group_size: Optional[int] = None,
+    dtype: torch.dtype = torch.float32,
+    resident_layers: Optional[int] = None,
 ):
     """
     Generate text based on the given prompt and model.
@@ -27,49 +113,60 @@ def generate(
         The temperature for sampling. If temp is 0, use max sampling.
     max_tokens: int
         The maximal number of generated tokens.
+    bits: int
+        Number of bits of the quantized weights (8 or 4), None to keep
+        the weights of the checkpoint.
+    group_size: int
+        Number of consecutive input features sharing a quantization scale,
+        None for one scale per output channel.
+    dtype: torch.dtype
+        Precision type of the weights and activations, torch.bfloat16
+        keeps the precision of the checkpoint.
+    resident_layers: int
+        Number of Transformer blocks kept in memory, the others being
+        read from the checkpoint when they run. None to load the whole
+        model in memory.
     """
-    state = torch.load(str(Path(model_path) / "consolidated.00.pth"))
-    state.pop("rope.freqs")
-    tokenizer = Tokenizer(str(Path(model_path) / "tokenizer.model"))
+    tokenizer = load_llama2_tokenizer(model_path)
 
     print(prompt)
     prompt = torch.tensor(
         tokenizer.encode(prompt), dtype=torch.long, device="mps"
     )
 
-    model_args = TransformerArgs(
-        dim=4096,
-        n_layers=32,
-        head_dim=128,
-        hidden_dim=11008,
-        n_heads=32,
-        n_kv_heads=32,
-        norm_eps=1e-5,
-        vocab_size=32000,
-        rope_theta=10000
-    )
-
-    model = Transformer(model_args)
-    model.load_state_dict(state)
-    model.to("mps")
+    if resident_layers is not None:
+        assert bits is None
+        model = build_streaming_model(
+            Transformer, _load_model_args(),
+            load_llama_state(model_path),
+            dtype=dtype, resident_layers=resident_layers, device="mps",
+        )
+    else:
+        model = load_llama2_model(
+            model_path, bits=bits, group_size=group_size, dtype=dtype
+        )
 
     start_time = time.time()
     print("Start generating...")
 
     tokens = []
     skip = 0
-    for token, n in zip(
-        generate_with_cache(prompt, model, temp),
-        range(max_tokens),
-    ):
-        if token == tokenizer.eos_id:
-            break
-
-        tokens.append(token.item())
-        s = tokenizer.decode(tokens)
-        if len(s) - skip > 1:
-            print(s[skip:-1], end="", flush=True)
-            skip = len(s) - 1
+    try:
+        for token, n in zip(
+            generate_with_cache(prompt, model, temp),
+            range(max_tokens),
+        ):
+            if token == tokenizer.eos_id:
+                break
+
+            tokens.append(token.item())
+            s = tokenizer.decode(tokens)
+            if len(s) - skip > 1:
+                print(s[skip:-1], end="", flush=True)
+                skip = len(s) - 1
+    finally:
+        if resident_layers is not None:
+            model.streamer.close()
 
     print(tokenizer.decode(tokens)[skip:], flush=True)
     print("End generating.")
@@ -82,9 +179,10 @@ def generate(
     print(f"Generation took: {elapsed_time:.6f} seconds.")
 
 
+@lru_cache(maxsize=8)
 def load_llama2_tokenizer(model_path: str) -> Tokenizer:
     """
-    Load tokenizer from the disk.
+    Load tokenizer from the disk, once per path.
 
     Parameters
     ----------
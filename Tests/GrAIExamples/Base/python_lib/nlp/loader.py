@@ -0,0 +1,134 @@
+import torch
+from typing import Dict, Optional, Type
+
+from python_lib.nlp.model import _fuse_state_dict
+from python_lib.nlp.quantize import quantize_model
+
+
+def assign_state(
+    model: torch.nn.Module,
+    state: Dict[str, torch.Tensor],
+    strict: bool = True,
+) -> torch.nn.Module:
+    """
+    Use the tensors of a checkpoint as the parameters of a model.
+
+    Contrary to `load_state_dict`, the parameters are not copied: each one
+    is replaced with the checkpoint tensor, which is only converted when
+    its precision differs from the one of the model. The model may then
+    live on the "meta" device, which never allocates its own weights.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+        The model, on any device.
+    state: [str: torch.Tensor]
+        The checkpoint state.
+    strict: bool
+        Whether to raise when keys are missing or unexpected.
+
+    Returns
+    -------
+    model: torch.nn.Module
+        The model holding the checkpoint tensors.
+    """
+    state = dict(state)
+    modules = list(model.named_modules())
+
+    # Same key remapping as the load state dict hooks of fused projections.
+    for name, module in modules:
+        prefix = name + "." if name else ""
+        for fused_name, names in getattr(module, "fused_names", {}).items():
+            _fuse_state_dict(
+                state, prefix, names=names, fused_name=fused_name
+            )
+
+    # Tied weights keep sharing memory once converted.
+    converted = {}
+
+    def convert(value: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+        if value.dtype == dtype:
+            return value
+        key = (value.data_ptr(), value.shape, value.stride(), dtype)
+        if key not in converted:
+            converted[key] = value.to(dtype)
+        return converted[key]
+
+    missing_keys = []
+    for name, module in modules:
+        prefix = name + "." if name else ""
+
+        for key, param in module._parameters.items():
+            if param is None:
+                continue
+            if prefix + key not in state:
+                missing_keys.append(prefix + key)
+                continue
+
+            value = convert(state.pop(prefix + key), param.dtype)
+            module._parameters[key] = torch.nn.Parameter(
+                value, requires_grad=param.requires_grad
+            )
+
+        for key, buffer in module._buffers.items():
+            if buffer is None or key in module._non_persistent_buffers_set:
+                continue
+            if prefix + key not in state:
+                missing_keys.append(prefix + key)
+                continue
+
+            module._buffers[key] = convert(
+                state.pop(prefix + key), buffer.dtype
+            )
+
+    if strict and (missing_keys or state):
+        raise RuntimeError(
+            f"Error(s) in assigning state to {model.__class__.__name__}: "
+            f"missing keys: {missing_keys}, "
+            f"unexpected keys: {list(state.keys())}."
+        )
+    return model
+
+
+def build_model(
+    model_cls: Type[torch.nn.Module],
+    args,
+    state: Dict[str, torch.Tensor],
+    dtype: torch.dtype = torch.float32,
+    bits: Optional[int] = None,
+    group_size: Optional[int] = None,
+) -> torch.nn.Module:
+    """
+    Build a model without allocating nor initializing random weights.
+
+    The model is created on the "meta" device and its parameters are
+    then taken from the checkpoint state, so that the weights are held
+    in memory once only.
+
+    Parameters
+    ----------
+    model_cls: Type[torch.nn.Module]
+        The Transformer class.
+    args: TransformerArgs
+        Model parameters.
+    state: [str: torch.Tensor]
+        The checkpoint state.
+    dtype: torch.dtype
+        Precision type of the weights and activations.
+    bits: int
+        Number of bits of the quantized weights (8 or 4) in the state,
+        None when the state is not quantized.
+    group_size: int
+        Number of consecutive input features sharing a quantization scale.
+
+    Returns
+    -------
+    model: torch.nn.Module
+        The model holding the checkpoint tensors.
+    """
+    model = model_cls(args, dtype=dtype, device="meta")
+    if bits is not None:
+        quantize_model(
+            model, bits, group_size, from_weights=False, device="meta"
+        )
+    return assign_state(model, state)
@@ -3,24 +3,112 @@ import time
 import torch
 import numpy as np
 from pathlib import Path
-from typing import List, Optional
-from safetensors.torch import load_file
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
 
 from python_lib.nlp.generate import (
     predict_no_cache,
-    generate_with_cache
+    generate_with_cache,
+    export_logits,
 )
 from python_lib.nlp.model import Transformer, TransformerArgs
+from python_lib.nlp.loader import build_model
+from python_lib.nlp.streaming import build_streaming_model
+from python_lib.nlp.quantize import load_quantized_state
+from python_lib.nlp.registry import get_model
+from python_lib.nlp.capture import capture_activations
+from python_lib.weight import load_mistral_state
 from mistral_common.protocol.instruct.messages import UserMessage
 from mistral_common.tokens.tokenizers.mistral import MistralTokenizer
 from mistral_common.protocol.instruct.request import ChatCompletionRequest
 
 
+def load_mistral_model(
+    model_path: str,
+    bits: Optional[int] = None,
+    group_size: Optional[int] = None,
+    dtype: torch.dtype = torch.float32,
+    device: str = "mps",
+) -> Transformer:
+    """
+    Get the model, loaded once and then kept in memory for the next calls.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    bits: int
+        Number of bits of the quantized weights (8 or 4), None to keep
+        the weights of the checkpoint.
+    group_size: int
+        Number of consecutive input features sharing a quantization scale,
+        None for one scale per output channel.
+    dtype: torch.dtype
+        Precision type of the weights and activations.
+    device: str
+        Device of the model.
+
+    Returns
+    -------
+    model: Transformer
+        The model.
+    """
+    def load_state():
+        return load_mistral_state(model_path, lazy=False)
+
+    def load_model() -> Transformer:
+        if bits is None:
+            state = load_state()
+        else:
+            state = load_quantized_state(
+                model_path, load_state, bits, group_size
+            )
+
+        model = build_model(
+            Transformer, _load_model_args(model_path), state,
+            dtype=dtype, bits=bits, group_size=group_size,
+        )
+        del state
+        return model.to(device)
+
+    return get_model(
+        model_path, load_model, dtype=dtype, device=device,
+        bits=bits, group_size=group_size,
+    )
+
+
+def _load_model_args(model_path: str) -> TransformerArgs:
+    """
+    Read the model parameters.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+
+    Returns
+    -------
+    model_args: TransformerArgs
+        Model parameters.
+    """
+    with open(Path(model_path) / "params.json", "r") as f:
+        config = json.loads(f.read())
+        config.pop("sliding_window", None)
+        config.pop("model_type", None)
+        model_args = TransformerArgs(**config)
+        model_args.rope_theta = 10000
+    return model_args
+
+
 def generate(
     prompt: str,
     model_path: str,
     temp: float = 0,
-    max_tokens: int = 128
+    max_tokens: int = 128,
+    bits: Optional[int] = None,
+    group_size: Optional[int] = None,
+    dtype: torch.dtype = torch.float32,
+    resident_layers: Optional[int] = None,
 ):
     """
     Generate text based on the given prompt and model.
@@ -35,11 +123,21 @@ def generate(
         The temperature for sampling. If temp is 0, use max sampling.
     max_tokens: int
         The maximal number of generated tokens.
+    bits: int
+        Number of bits of the quantized weights (8 or 4), None to keep
+        the weights of the checkpoint.
+    group_size: int
+        Number of consecutive input features sharing a quantization scale,
+        None for one scale per output channel.
+    dtype: torch.dtype
+        Precision type of the weights and activations, torch.bfloat16
+        keeps the precision of the checkpoint.
+    resident_layers: int
+        Number of Transformer blocks kept in memory, the others being
+        read from the checkpoint when they run. None to load the whole
+        model in memory.
     """
-    state = load_file(str(Path(model_path) / "consolidated.safetensors"))
-    tokenizer = MistralTokenizer.from_file(
-        str(Path(model_path) / "tokenizer.model.v3")
-    )
+    tokenizer = load_mistral_tokenizer(model_path)
 
     completion_request = ChatCompletionRequest(
         messages=[
@@ -51,34 +149,39 @@ def generate(
     print(prompt)
     prompt = torch.tensor(tokens, dtype=torch.long, device="mps")
 
-    with open(Path(model_path) / "params.json", "r") as f:
-        config = json.loads(f.read())
-        config.pop("sliding_window", None)
-        config.pop("model_type", None)
-        model_args = TransformerArgs(**config)
-        model_args.rope_theta = 10000
-
-    model = Transformer(model_args)
-    model.load_state_dict(state)
-    model.to("mps")
+    if resident_layers is not None:
+        assert bits is None
+        model = build_streaming_model(
+            Transformer, _load_model_args(model_path),
+            load_mistral_state(model_path),
+            dtype=dtype, resident_layers=resident_layers, device="mps",
+        )
+    else:
+        model = load_mistral_model(
+            model_path, bits=bits, group_size=group_size, dtype=dtype
+        )
 
     start_time = time.time()
     print("Start generating...")
 
     tokens = []
     skip = 0
-    for token, n in zip(
-        generate_with_cache(prompt, model, temp),
-        range(max_tokens),
-    ):
-        if token == tokenizer.instruct_tokenizer.tokenizer.eos_id:
-            break
-
-        tokens.append(token.item())
-        s = tokenizer.decode(tokens)
-        if len(s) - skip > 1:
-            print(s[skip:-1], end="", flush=True)
-            skip = len(s) - 1
+    try:
+        for token, n in zip(
+            generate_with_cache(prompt, model, temp),
+            range(max_tokens),
+        ):
+            if token == tokenizer.instruct_tokenizer.tokenizer.eos_id:
+                break
+
+            tokens.append(token.item())
+            s = tokenizer.decode(tokens)
+            if len(s) - skip > 1:
+                print(s[skip:-1], end="", flush=True)
+                skip = len(s) - 1
+    finally:
+        if resident_layers is not None:
+            model.streamer.close()
 
     print(tokenizer.decode(tokens)[skip:], flush=True)
     print("End generating.")
@@ -111,10 +214,7 @@ def predict(
     n_layers: int
         Modifier of the number of Transformer blocks.
     """
-    state = load_file(str(Path(model_path) / "consolidated.safetensors"))
-    tokenizer = MistralTokenizer.from_file(
-        str(Path(model_path) / "tokenizer.model.v3")
-    )
+    tokenizer = load_mistral_tokenizer(model_path)
 
     completion_request = ChatCompletionRequest(
         messages=[
@@ -126,16 +226,7 @@ def predict(
     print(prompt)
     prompt = torch.tensor(tokens, dtype=torch.long, device="mps")
 
-    with open(Path(model_path) / "params.json", "r") as f:
-        config = json.loads(f.read())
-        config.pop("sliding_window", None)
-        config.pop("model_type", None)
-        model_args = TransformerArgs(**config)
-        model_args.rope_theta = 10000
-
-    model = Transformer(model_args)
-    model.load_state_dict(state)
-    model.to("mps")
+    model = load_mistral_model(model_path)
 
     tokens = predict_no_cache(
         prompt, model, temp, n_layers
@@ -148,11 +239,18 @@ def predict(
 def predict_mistral(
     prompt: str,
     model_path: str,
-    n_layers: Optional[int] = None
-) -> np.ndarray:
+    n_layers: Optional[int] = None,
+    last_only: bool = False,
+    top_k: Optional[int] = None,
+    out: Optional[np.ndarray] = None,
+    shared_memory_name: Optional[str] = None,
+) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray], int]:
     """
     Predict text based on the given prompt and model.
 
+    By default, the logits of all the positions are returned. The other
+    options reduce them on the device before they cross to the caller.
+
     Parameters
     ----------
     prompt: torch.Tensor
@@ -161,11 +259,22 @@ def predict_mistral(
         Path to the model on the disk.
     n_layers: int
         Modifier of the number of Transformer blocks.
+    last_only: bool
+        Whether to only return the logits of the last position.
+    top_k: int
+        Number of best tokens to return per position, None for all.
+    out: np.ndarray
+        Preallocated float32 buffer receiving the flattened logits.
+    shared_memory_name: str
+        Name of an existing shared memory segment receiving the flattened
+        float32 logits.
+
+    Returns
+    -------
+    _: np.ndarray | (np.ndarray, np.ndarray) | int
+        See `export_logits`.
     """
-    state = load_file(str(Path(model_path) / "consolidated.safetensors"))
-    tokenizer = MistralTokenizer.from_file(
-        str(Path(model_path) / "tokenizer.model.v3")
-    )
+    tokenizer = load_mistral_tokenizer(model_path)
 
     completion_request = ChatCompletionRequest(
         messages=[
@@ -175,24 +284,72 @@ def predict_mistral(
     tokens = tokenizer.encode_chat_completion(completion_request).tokens
     prompt = torch.tensor(tokens, dtype=torch.long, device="mps")
 
-    with open(Path(model_path) / "params.json", "r") as f:
-        config = json.loads(f.read())
-        config.pop("sliding_window", None)
-        config.pop("model_type", None)
-        model_args = TransformerArgs(**config)
-        model_args.rope_theta = 10000
+    model = load_mistral_model(model_path)
+
+    with torch.no_grad():
+        logits, _ = model(prompt[None], n_layers=n_layers)
+    return export_logits(
+        logits,
+        last_only=last_only,
+        top_k=top_k,
+        out=out,
+        shared_memory_name=shared_memory_name,
+    )
+
+
+def capture_mistral(
+    prompt: str,
+    model_path: str,
+    archive_path: str,
+    dtype: str = "float32",
+    logits: bool = True,
+) -> Dict[str, np.ndarray]:
+    """
+    Get the activations of every block, RMS norm and attention in one
+    forward pass.
 
-    model = Transformer(model_args)
-    model.load_state_dict(state)
-    model.to("mps")
+    With `logits`, `layers.<i>.logits` holds the output of
+    `predict_mistral` with `n_layers=i + 1`, without running the model
+    once per depth.
+
+    Parameters
+    ----------
+    prompt: torch.Tensor
+        The input prompt.
+    model_path: str
+        Path to the model on the disk.
+    archive_path: str
+        Path to the archive of the activations, without suffix.
+    dtype: str
+        Precision of the archive: "float32", "float16" or "bfloat16".
+    logits: bool
+        Whether to also capture the logits after each block.
 
-    out, _ = model(prompt[None], n_layers=n_layers)
-    return out.detach().cpu().numpy().flatten()
+    Returns
+    -------
+    _: Dict[str, np.ndarray]
+        Views of the activations in the archive.
+    """
+    tokenizer = load_mistral_tokenizer(model_path)
+
+    completion_request = ChatCompletionRequest(
+        messages=[
+            UserMessage(content=prompt),
+        ],
+    )
+    tokens = tokenizer.encode_chat_completion(completion_request).tokens
+    prompt = torch.tensor(tokens, dtype=torch.long, device="mps")
+
+    model = load_mistral_model(model_path)
+    return capture_activations(
+        model, prompt[None], archive_path, dtype=dtype, logits=logits
+    )
 
 
+@lru_cache(maxsize=8)
 def load_mistral_tokenizer(model_path: str) -> MistralTokenizer:
     """
-    Load tokenizer from the disk.
+    Load tokenizer from the disk, once per path.
 
     Parameters
     ----------
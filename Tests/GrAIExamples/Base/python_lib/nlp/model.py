@@ -1,6 +1,11 @@
 import torch
+from functools import partial
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from python_lib.nlp.cache import EvictionPolicy, OffloadedCache
+from python_lib.nlp.quantize import QuantizedLinear, linear_into
+from python_lib.nlp.workspace import DecodeWorkspace
 
 
 @dataclass
@@ -28,6 +33,11 @@ class TransformerArgs:
         Vocabulary size.
     rope_theta: float
         Coefficient used to initialize rotation matrix.
+    fuse_projections: bool
+        Whether to run the queries, keys and values projections as one
+        matrix multiplication (and the gate and up projections as another
+        one). The weights are concatenated when loading the state dict,
+        which keeps checkpoints compatible.
     """
     dim: int
     n_layers: int
@@ -38,6 +48,149 @@ class TransformerArgs:
     norm_eps: float
     vocab_size: int
     rope_theta: float = 10000
+    fuse_projections: bool = False
+
+
+def _fuse_state_dict(
+    state_dict: Dict[str, torch.Tensor],
+    prefix: str,
+    *args,
+    names: List[str],
+    fused_name: str,
+):
+    """
+    Concatenate the weights of several projections into one fused weight.
+
+    Parameters
+    ----------
+    state_dict: [str: torch.Tensor]
+        The state dict being loaded.
+    prefix: str
+        Prefix of the keys of the module.
+    names: [str]
+        Names of the projections to fuse.
+    fused_name: str
+        Name of the fused projection.
+    """
+    # Quantized projections store their rows in several tensors.
+    for suffix in [".weight", ".qweight", ".scales"]:
+        keys = [prefix + name + suffix for name in names]
+        if all(key in state_dict for key in keys):
+            state_dict[prefix + fused_name + suffix] = torch.concat(
+                [state_dict.pop(key) for key in keys], dim=0
+            )
+
+
+def _split_state_dict(
+    module: torch.nn.Module,
+    state_dict: Dict[str, torch.Tensor],
+    prefix: str,
+    *args,
+    names: List[str],
+    fused_name: str,
+):
+    """
+    Split a fused weight back into the weights of the original projections.
+
+    Parameters
+    ----------
+    module: torch.nn.Module
+        The module whose state dict is being built.
+    state_dict: [str: torch.Tensor]
+        The state dict being built.
+    prefix: str
+        Prefix of the keys of the module.
+    names: [str]
+        Names of the fused projections.
+    fused_name: str
+        Name of the fused projection.
+    """
+    sizes = module.projection_sizes[fused_name]
+    for suffix in [".weight", ".qweight", ".scales"]:
+        if prefix + fused_name + suffix in state_dict:
+            weight = state_dict.pop(prefix + fused_name + suffix)
+            for name, split in zip(names, weight.split(sizes, dim=0)):
+                state_dict[prefix + name + suffix] = split
+
+
+def cache_length(cache) -> int:
+    """
+    Get the number of tokens in the cache for keys and values.
+
+    The length of an `OffloadedCache` is read without paging its cold
+    blocks in, nor counting an access in its statistics.
+
+    Parameters
+    ----------
+    cache: [(torch.Tensor, torch.Tensor)] | OffloadedCache
+        Cache for keys and values for each layer, or None.
+
+    Returns
+    -------
+    _: int
+        Number of cached tokens.
+    """
+    if cache is None:
+        return 0
+    if isinstance(cache, OffloadedCache):
+        return cache.seq_len
+    return cache[0][0].shape[2] if cache[0] is not None else 0
+
+
+class RestrictedOutput:
+    """
+    Rows of the weight of an output layer for sets of allowed tokens.
+
+    The rows are gathered once per set, then cached until the output layer
+    changes (new weights, quantization). A quantized layer only
+    dequantizes the gathered rows.
+    """
+
+    def __init__(self):
+        self._heads: Dict[Hashable, torch.Tensor] = {}
+        self._source: Tuple = ()
+
+    def __call__(
+        self,
+        output: torch.nn.Module,
+        allowed_tokens: torch.Tensor,
+        key: Optional[Hashable] = None,
+    ) -> torch.Tensor:
+        """
+        Get the rows of the output weight of a set of allowed tokens.
+
+        Parameters
+        ----------
+        output: torch.nn.Module
+            The output layer.
+        allowed_tokens: torch.Tensor
+            Ids of the allowed tokens.
+        key: Hashable
+            Identifier of the set, computed once by the caller. When None,
+            the ids are read back from their device.
+
+        Returns
+        -------
+        _: torch.Tensor
+            The weight of shape (len(allowed_tokens), dim).
+        """
+        source = tuple(
+            tensor.data_ptr() for tensor in
+            list(output.parameters()) + list(output.buffers())
+        )
+        if source != self._source:
+            self._heads = {}
+            self._source = source
+
+        if key is None:
+            key = tuple(allowed_tokens.tolist())
+        if key not in self._heads:
+            if isinstance(output, QuantizedLinear):
+                self._heads[key] = output.weight_rows(allowed_tokens)
+            else:
+                weight = output.weight.detach()
+                self._heads[key] = weight[allowed_tokens.to(weight.device)]
+        return self._heads[key]
 
 
 class RMSNorm(torch.nn.Module):
@@ -50,11 +203,24 @@ class RMSNorm(torch.nn.Module):
         Embedding dimension.
     eps: float
         Epsilon value to avoid 0 division.
+    device: torch.device
+        Device on which the parameters are allocated. On "meta", no
+        memory is allocated until the weights are assigned.
+    dtype: torch.dtype
+        Precision type of the parameters.
     """
 
-    def __init__(self, dims: int, eps: float = 1e-5):
+    def __init__(
+        self,
+        dims: int,
+        eps: float = 1e-5,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ):
         super().__init__()
-        self.weight = torch.nn.Parameter(torch.ones(dims))
+        self.weight = torch.nn.Parameter(
+            torch.ones(dims, device=device, dtype=dtype)
+        )
         self.eps = eps
 
     def _norm(self, x):
@@ -77,6 +243,35 @@ class RMSNorm(torch.nn.Module):
         output = self._norm(x.type(torch.float32)).type(x.dtype)
         return self.weight * output
 
+    def decode(
+        self,
+        x: torch.Tensor,
+        out: torch.Tensor,
+        workspace: DecodeWorkspace,
+    ):
+        """
+        Forward pass of one token in preallocated buffers.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The input tensor of shape (batch, dim).
+        out: torch.Tensor
+            The output tensor, may be the same as the input one.
+        workspace: DecodeWorkspace
+            Preallocated buffers.
+        """
+        x_float = workspace.x_float
+        x_float.copy_(x)
+        torch.square(x_float, out=workspace.x_square)
+        torch.mean(
+            workspace.x_square, dim=-1, keepdim=True, out=workspace.stats
+        )
+        workspace.stats.add_(self.eps).rsqrt_()
+        x_float.mul_(workspace.stats)
+        out.copy_(x_float)
+        out.mul_(self.weight)
+
 
 class Attention(torch.nn.Module):
     """
@@ -86,10 +281,21 @@ class Attention(torch.nn.Module):
     ----------
     args: TransformerArgs
         Model parameters.
+    device: torch.device
+        Device on which the parameters are allocated. On "meta", no
+        memory is allocated until the weights are assigned.
+    dtype: torch.dtype
+        Precision type of the parameters.
     """
 
-    def __init__(self, args: TransformerArgs):
+    def __init__(
+        self,
+        args: TransformerArgs,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ):
         super().__init__()
+        factory_kwargs = {"device": device, "dtype": dtype}
         self.args = args
 
         self.n_heads: int = args.n_heads
@@ -99,17 +305,43 @@ class Attention(torch.nn.Module):
 
         self.scale = self.args.head_dim**-0.5
 
-        self.wq = torch.nn.Linear(
-            args.dim, args.n_heads * args.head_dim, bias=False
-        )
-        self.wk = torch.nn.Linear(
-            args.dim, args.n_kv_heads * args.head_dim, bias=False
-        )
-        self.wv = torch.nn.Linear(
-            args.dim, args.n_kv_heads * args.head_dim, bias=False
-        )
+        self.projection_sizes = {
+            "wqkv": [
+                args.n_heads * args.head_dim,
+                args.n_kv_heads * args.head_dim,
+                args.n_kv_heads * args.head_dim,
+            ]
+        }
+        if args.fuse_projections:
+            self.wqkv = torch.nn.Linear(
+                args.dim, sum(self.projection_sizes["wqkv"]),
+                bias=False, **factory_kwargs
+            )
+            names = ["wq", "wk", "wv"]
+            self.fused_names = {"wqkv": names}
+            self._register_load_state_dict_pre_hook(partial(
+                _fuse_state_dict, names=names, fused_name="wqkv"
+            ))
+            self._register_state_dict_hook(partial(
+                _split_state_dict, names=names, fused_name="wqkv"
+            ))
+
+        else:
+            self.wq = torch.nn.Linear(
+                args.dim, args.n_heads * args.head_dim,
+                bias=False, **factory_kwargs
+            )
+            self.wk = torch.nn.Linear(
+                args.dim, args.n_kv_heads * args.head_dim,
+                bias=False, **factory_kwargs
+            )
+            self.wv = torch.nn.Linear(
+                args.dim, args.n_kv_heads * args.head_dim,
+                bias=False, **factory_kwargs
+            )
         self.wo = torch.nn.Linear(
-            args.n_heads * args.head_dim, args.dim, bias=False
+            args.n_heads * args.head_dim, args.dim,
+            bias=False, **factory_kwargs
         )
 
     @staticmethod
@@ -138,6 +370,37 @@ class Attention(torch.nn.Module):
         mask = mask.type(dtype) * -1e9
         return mask
 
+    @staticmethod
+    def create_block_diagonal_causal_mask(
+        lengths: List[int], dtype: torch.dtype = torch.float32
+    ) -> torch.Tensor:
+        """
+        Create the causal mask of sequences packed in one row.
+
+        A position only attends to the previous positions of its own
+        sequence.
+
+        Parameters
+        ---------
+        lengths: [int]
+            Length of each packed sequence.
+        dtype: torch.dtype
+            Precision type.
+
+        Returns
+        -------
+        mask: torch.Tensor
+            The block diagonal causal mask.
+        """
+        indices = torch.arange(sum(lengths))
+        segments = torch.repeat_interleave(
+            torch.arange(len(lengths)), torch.tensor(lengths)
+        )
+        mask = (indices[:, None] < indices[None]) | \
+            (segments[:, None] != segments[None])
+        mask = mask.type(dtype) * -1e9
+        return mask
+
     @staticmethod
     def create_rotation_matrix(
         positions: torch.Tensor,
@@ -191,6 +454,7 @@ class Attention(torch.nn.Module):
         rotation_matrix: torch.Tensor,
         mask: Optional[torch.Tensor] = None,
         cache: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        eviction: Optional[EvictionPolicy] = None,
     ) -> Tuple[torch.Tensor, Optional[Tuple[torch.Tensor, torch.Tensor]]]:
         """
         Forward pass.
@@ -206,6 +470,8 @@ class Attention(torch.nn.Module):
         cache: (key_cache, value_cache): (torch.Tensor, torch.Tensor)
             cache for keys and values
             for generating tokens with past context.
+        eviction: EvictionPolicy
+            Eviction policy of the cache for keys and values.
 
         Returns
         -------
@@ -214,7 +480,12 @@ class Attention(torch.nn.Module):
             (keys, values): cache for keys and values
         """
         B, L, D = x.shape
-        queries, keys, values = self.wq(x), self.wk(x), self.wv(x)
+        if self.args.fuse_projections:
+            queries, keys, values = self.wqkv(x).split(
+                self.projection_sizes["wqkv"], dim=-1
+            )
+        else:
+            queries, keys, values = self.wq(x), self.wk(x), self.wv(x)
 
         # Prepare the queries, keys and values for the attention computation.
         queries = queries.reshape(B, L, self.n_heads, -1).transpose(1, 2)
@@ -250,8 +521,100 @@ class Attention(torch.nn.Module):
         output = torch.matmul(scores, values)
         output = output.transpose(1, 2).contiguous().reshape(B, L, -1)
 
+        if eviction is not None:
+            keys, values = eviction(
+                keys, values, scores, rope_theta=self.args.rope_theta
+            )
+
         return self.wo(output), (keys, values)
 
+    def decode(
+        self,
+        x: torch.Tensor,
+        out: torch.Tensor,
+        rotation_matrix: torch.Tensor,
+        workspace: DecodeWorkspace,
+        layer: int,
+    ):
+        """
+        Forward pass of one token in preallocated buffers.
+
+        The cache for keys and values of the layer is updated in place.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The input tensor of shape (batch, dim).
+        out: torch.Tensor
+            The output tensor of shape (batch, dim).
+        rotation_matrix: torch.Tensor
+            Rotation matrix used for positional encoding.
+        workspace: DecodeWorkspace
+            Preallocated buffers.
+        layer: int
+            Index of the Transformer block.
+        """
+        B = x.shape[0]
+        S = workspace.length + 1
+        head_dim = self.args.head_dim
+
+        if self.args.fuse_projections:
+            linear_into(x, self.wqkv, workspace.qkv)
+            queries, keys, values = workspace.qkv.split(
+                self.projection_sizes["wqkv"], dim=-1
+            )
+        else:
+            queries, keys, values = workspace.q, workspace.k, workspace.v
+            linear_into(x, self.wq, queries)
+            linear_into(x, self.wk, keys)
+            linear_into(x, self.wv, values)
+
+        # Positional encoding: x R^T for each head.
+        rotation = rotation_matrix[0].t().type(x.dtype)
+        queries = torch.mm(
+            queries.reshape(B * self.n_heads, head_dim),
+            rotation,
+            out=workspace.q_rot,
+        ).view(B, self.n_heads, 1, head_dim)
+        keys = torch.mm(
+            keys.reshape(B * self.n_kv_heads, head_dim),
+            rotation,
+            out=workspace.k_rot,
+        )
+
+        # Write the new key and value in the cache, repeated for each query
+        # head sharing them.
+        key_cache = workspace.keys[layer]
+        value_cache = workspace.values[layer]
+        key_cache[:, :, S - 1].view(
+            B, self.n_kv_heads, self.repeats, head_dim
+        ).copy_(keys.view(B, self.n_kv_heads, 1, head_dim))
+        value_cache[:, :, S - 1].view(
+            B, self.n_kv_heads, self.repeats, head_dim
+        ).copy_(values.view(B, self.n_kv_heads, 1, head_dim))
+        keys = key_cache[:, :, :S]
+        values = value_cache[:, :, :S]
+
+        n_scores = B * self.n_heads * S
+        scores = workspace.scores[:n_scores].view(B, self.n_heads, 1, S)
+        probs = workspace.probs[:n_scores].view(B, self.n_heads, 1, S)
+
+        torch.matmul(queries, keys.transpose(2, 3), out=scores)
+        scores.mul_(self.scale)
+
+        # Softmax in float32.
+        probs.copy_(scores)
+        torch.amax(probs, dim=-1, keepdim=True, out=workspace.probs_max)
+        probs.sub_(workspace.probs_max).exp_()
+        torch.sum(probs, dim=-1, keepdim=True, out=workspace.probs_sum)
+        probs.div_(workspace.probs_sum)
+        scores.copy_(probs)
+
+        # (B, n_heads, 1, head_dim) has the memory layout of
+        # (B, 1, n_heads * head_dim).
+        torch.matmul(scores, values, out=workspace.attn)
+        linear_into(workspace.attn.view(B, -1), self.wo, out)
+
 
 class FeedForward(torch.nn.Module):
     """
@@ -261,14 +624,49 @@ class FeedForward(torch.nn.Module):
     ----------
     args: TransformerArgs
         Model parameters.
+    device: torch.device
+        Device on which the parameters are allocated. On "meta", no
+        memory is allocated until the weights are assigned.
+    dtype: torch.dtype
+        Precision type of the parameters.
     """
 
-    def __init__(self, args: TransformerArgs):
+    def __init__(
+        self,
+        args: TransformerArgs,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ):
         super().__init__()
+        factory_kwargs = {"device": device, "dtype": dtype}
+        self.args = args
+        self.activation = torch.nn.SiLU()
+
+        self.projection_sizes = {"w13": [args.hidden_dim, args.hidden_dim]}
+        if args.fuse_projections:
+            self.w13 = torch.nn.Linear(
+                args.dim, 2 * args.hidden_dim, bias=False, **factory_kwargs
+            )
+            names = ["w1", "w3"]
+            self.fused_names = {"w13": names}
+            self._register_load_state_dict_pre_hook(partial(
+                _fuse_state_dict, names=names, fused_name="w13"
+            ))
+            self._register_state_dict_hook(partial(
+                _split_state_dict, names=names, fused_name="w13"
+            ))
 
-        self.w1 = torch.nn.Linear(args.dim, args.hidden_dim, bias=False)
-        self.w2 = torch.nn.Linear(args.hidden_dim, args.dim, bias=False)
-        self.w3 = torch.nn.Linear(args.dim, args.hidden_dim, bias=False)
+        else:
+            self.w1 = torch.nn.Linear(
+                args.dim, args.hidden_dim, bias=False, **factory_kwargs
+            )
+        self.w2 = torch.nn.Linear(
+            args.hidden_dim, args.dim, bias=False, **factory_kwargs
+        )
+        if not args.fuse_projections:
+            self.w3 = torch.nn.Linear(
+                args.dim, args.hidden_dim, bias=False, **factory_kwargs
+            )
 
     def forward(self, x) -> torch.Tensor:
         """
@@ -284,7 +682,45 @@ class FeedForward(torch.nn.Module):
         _: torch.Tensor
             The output tensor.
         """
-        return self.w2(torch.nn.SiLU()(self.w1(x)) * self.w3(x))
+        if self.args.fuse_projections:
+            gate, up = self.w13(x).split(
+                self.projection_sizes["w13"], dim=-1
+            )
+        else:
+            gate, up = self.w1(x), self.w3(x)
+        return self.w2(self.activation(gate) * up)
+
+    def decode(
+        self,
+        x: torch.Tensor,
+        out: torch.Tensor,
+        workspace: DecodeWorkspace,
+    ):
+        """
+        Forward pass of one token in preallocated buffers.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The input tensor of shape (batch, dim).
+        out: torch.Tensor
+            The output tensor of shape (batch, dim).
+        workspace: DecodeWorkspace
+            Preallocated buffers.
+        """
+        if self.args.fuse_projections:
+            linear_into(x, self.w13, workspace.gate_up)
+            gate, up = workspace.gate_up.split(
+                self.projection_sizes["w13"], dim=-1
+            )
+        else:
+            gate, up = workspace.gate, workspace.up
+            linear_into(x, self.w1, gate)
+            linear_into(x, self.w3, up)
+
+        torch.nn.functional.silu(gate, inplace=True)
+        gate.mul_(up)
+        linear_into(gate, self.w2, out)
 
 
 class TransformerBlock(torch.nn.Module):
@@ -295,16 +731,29 @@ class TransformerBlock(torch.nn.Module):
     ----------
     args: TransformerArgs
         Model parameters.
+    device: torch.device
+        Device on which the parameters are allocated. On "meta", no
+        memory is allocated until the weights are assigned.
+    dtype: torch.dtype
+        Precision type of the parameters.
     """
 
-    def __init__(self, args: TransformerArgs):
+    def __init__(
+        self,
+        args: TransformerArgs,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ):
         super().__init__()
+        factory_kwargs = {"device": device, "dtype": dtype}
         self.n_heads = args.n_heads
         self.dim = args.dim
-        self.attention = Attention(args)
-        self.feed_forward = FeedForward(args=args)
-        self.attention_norm = RMSNorm(args.dim, eps=args.norm_eps)
-        self.ffn_norm = RMSNorm(args.dim, eps=args.norm_eps)
+        self.attention = Attention(args, **factory_kwargs)
+        self.feed_forward = FeedForward(args=args, **factory_kwargs)
+        self.attention_norm = RMSNorm(
+            args.dim, eps=args.norm_eps, **factory_kwargs
+        )
+        self.ffn_norm = RMSNorm(args.dim, eps=args.norm_eps, **factory_kwargs)
         self.args = args
 
     def forward(
@@ -316,6 +765,7 @@ class TransformerBlock(torch.nn.Module):
             Tuple[torch.Tensor,
                   Optional[Tuple[torch.Tensor, torch.Tensor]]]
         ] = None,
+        eviction: Optional[EvictionPolicy] = None,
     ) -> Tuple[torch.Tensor, Optional[Tuple[torch.Tensor, torch.Tensor]]]:
         """
         Forward pass.
@@ -331,6 +781,8 @@ class TransformerBlock(torch.nn.Module):
         cache: (key_cache, value_cache): (torch.Tensor, torch.Tensor)
             cache for keys and values
             for generating tokens with past context.
+        eviction: EvictionPolicy
+            Eviction policy of the cache for keys and values.
 
         Returns
         -------
@@ -343,12 +795,50 @@ class TransformerBlock(torch.nn.Module):
             rotation_matrix=rotation_matrix,
             mask=mask,
             cache=cache,
+            eviction=eviction,
         )
         h = x + r
         r = self.feed_forward(self.ffn_norm(h))
         out = h + r
         return out, cache
 
+    def decode(
+        self,
+        h: torch.Tensor,
+        rotation_matrix: torch.Tensor,
+        workspace: DecodeWorkspace,
+        layer: int,
+    ):
+        """
+        Forward pass of one token in preallocated buffers.
+
+        The residual stream is updated in place.
+
+        Parameters
+        ----------
+        h: torch.Tensor
+            The residual stream of shape (batch, dim).
+        rotation_matrix: torch.Tensor
+            Rotation matrix used for positional encoding.
+        workspace: DecodeWorkspace
+            Preallocated buffers.
+        layer: int
+            Index of the Transformer block.
+        """
+        x, out = workspace.x, workspace.out
+        self.attention_norm.decode(h, out=x, workspace=workspace)
+        self.attention.decode(
+            x,
+            out=out,
+            rotation_matrix=rotation_matrix,
+            workspace=workspace,
+            layer=layer,
+        )
+        h.add_(out)
+        self.ffn_norm.decode(h, out=x, workspace=workspace)
+        self.feed_forward.decode(x, out=out, workspace=workspace)
+        h.add_(out)
+
 
 class Transformer(torch.nn.Module):
     """
@@ -358,26 +848,49 @@ class Transformer(torch.nn.Module):
     ----------
     args: TransformerArgs
         Model parameters.
+    dtype: torch.dtype
+        Precision type of the weights and activations. The RMSNorm
+        statistics, the softmax and the final logits are computed
+        in float32 whatever the precision.
+    device: torch.device
+        Device on which the parameters are allocated. On "meta", no
+        memory is allocated until the weights are assigned from
+        a checkpoint (see `python_lib.nlp.loader.build_model`).
     """
 
-    def __init__(self, args: TransformerArgs):
+    def __init__(
+        self,
+        args: TransformerArgs,
+        dtype: torch.dtype = torch.float32,
+        device: Optional[torch.device] = None,
+    ):
         super().__init__()
+        factory_kwargs = {"device": device, "dtype": dtype}
         self.args = args
         self.vocab_size = args.vocab_size
         self.n_layers = args.n_layers
         assert self.vocab_size > 0
-        self.tok_embeddings = torch.nn.Embedding(args.vocab_size, args.dim)
+        self.tok_embeddings = torch.nn.Embedding(
+            args.vocab_size, args.dim, **factory_kwargs
+        )
         self.layers = torch.nn.ModuleList([
-            TransformerBlock(args=args) for _ in range(args.n_layers)
+            TransformerBlock(args=args, **factory_kwargs)
+            for _ in range(args.n_layers)
         ])
-        self.norm = RMSNorm(args.dim, eps=args.norm_eps)
-        self.output = torch.nn.Linear(args.dim, args.vocab_size, bias=False)
+        self.norm = RMSNorm(args.dim, eps=args.norm_eps, **factory_kwargs)
+        self.output = torch.nn.Linear(
+            args.dim, args.vocab_size, bias=False, **factory_kwargs
+        )
+        self.restricted_output = RestrictedOutput()
 
     def forward(
         self,
         x: torch.Tensor,
         cache=None,
-        n_layers=None
+        n_layers=None,
+        eviction: Optional[List[EvictionPolicy]] = None,
+        allowed_tokens: Optional[torch.Tensor] = None,
+        allowed_key: Optional[Hashable] = None,
     ) -> Tuple[torch.Tensor, Optional[list]]:
         """
         Forward pass.
@@ -391,37 +904,47 @@ class Transformer(torch.nn.Module):
             for generating tokens with past context.
         n_layers: Int
             Modifier of the number of Transformer blocks.
+        eviction: [EvictionPolicy]
+            Eviction policy of the cache for each layer.
+        allowed_tokens: torch.Tensor
+            Ids of the only tokens whose logits are computed, None for
+            the whole vocabulary.
+        allowed_key: Hashable
+            Identifier of `allowed_tokens`, see `RestrictedOutput`.
 
         Returns
         -------
         (output, cache): (torch.Tensor, list)
-            output: the output tensor
+            output: the output tensor, whose last axis follows
+                `allowed_tokens` when given
             cache: cache for keys and values for each layer
         """
         h = self.tok_embeddings(x)
 
+        offset = cache_length(cache)
+
         mask = None
         if h.shape[1] > 1:
             mask = Attention.create_additive_causal_mask(h.shape[1])
             mask = mask.type(h.dtype)
+            if offset > 0:
+                # The new tokens attend to all the cached ones.
+                mask = torch.cat(
+                    [torch.zeros(h.shape[1], offset, dtype=h.dtype), mask],
+                    dim=1,
+                )
             mask = mask.to(h.device)
 
-            positions = torch.arange(
-                1, h.shape[1] + 1, device=h.device
-            ).unsqueeze(1)
-
-        else:
-            key_cache = cache[0][0]
-            positions = torch.tensor(
-                [key_cache.shape[2] + 1], device=h.device
-            ).unsqueeze(1)
+        positions = torch.arange(
+            offset + 1, offset + h.shape[1] + 1, device=h.device
+        ).unsqueeze(1)
 
         rotation_matrix = Attention.create_rotation_matrix(
             positions=positions,
             embedding_dim=self.args.head_dim,
             rope_theta=self.args.rope_theta,
             device=h.device,
-        )
+        ).type(h.dtype)
 
         if cache is None:
             cache = [None] * len(self.layers)
@@ -431,7 +954,185 @@ class Transformer(torch.nn.Module):
                 break
 
             h, cache[e] = layer(
-                h, rotation_matrix=rotation_matrix, mask=mask, cache=cache[e]
+                h,
+                rotation_matrix=rotation_matrix,
+                mask=mask,
+                cache=cache[e],
+                eviction=eviction[e] if eviction is not None else None,
+            )
+
+        h = self.norm(h)
+        if allowed_tokens is not None:
+            logits = torch.nn.functional.linear(
+                h,
+                self.restricted_output(
+                    self.output, allowed_tokens, allowed_key
+                ).type_as(h),
+            )
+            return logits.float(), cache
+        return self.output(h).float(), cache
+
+    def features(
+        self,
+        x: torch.Tensor,
+        lengths: Optional[List[int]] = None,
+        n_layers=None,
+        prefix: Optional[list] = None,
+    ) -> Tuple[torch.Tensor, List[list]]:
+        """
+        Compute the normalized hidden states, before the output layer.
+
+        The rows may contain several packed sequences, each one only
+        attending to itself with positions starting at 1. The output layer
+        can then be applied to the positions of interest only.
+
+        With a `prefix` cache, every packed sequence continues the same
+        prefix: it also attends to all the cached tokens and its positions
+        start after them. The prefix is shared, not copied per sequence.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The input tensor of shape (batch, sum(lengths)).
+        lengths: [int]
+            Length of each packed sequence, None for one sequence per row.
+        n_layers: Int
+            Modifier of the number of Transformer blocks.
+        prefix: [(torch.Tensor, torch.Tensor)]
+            Cache for keys and values of a prefix shared by the sequences,
+            for each layer.
+
+        Returns
+        -------
+        (h, caches): (torch.Tensor, [list])
+            h: the hidden states of shape (batch, sum(lengths), dim)
+            caches: cache for keys and values for each layer, for each
+                sequence, without the prefix
+        """
+        if lengths is None:
+            lengths = [x.shape[1]]
+        assert x.shape[1] == sum(lengths)
+        offset = prefix[0][0].shape[2] if prefix is not None else 0
+
+        h = self.tok_embeddings(x)
+
+        mask = Attention.create_block_diagonal_causal_mask(lengths)
+        mask = mask.type(h.dtype)
+        if offset > 0:
+            mask = torch.cat(
+                [torch.zeros(mask.shape[0], offset, dtype=h.dtype), mask],
+                dim=1,
+            )
+        mask = mask.to(h.device)
+
+        positions = torch.cat([
+            torch.arange(offset + 1, offset + length + 1, device=h.device)
+            for length in lengths
+        ]).unsqueeze(1)
+
+        rotation_matrix = Attention.create_rotation_matrix(
+            positions=positions,
+            embedding_dim=self.args.head_dim,
+            rope_theta=self.args.rope_theta,
+            device=h.device,
+        ).type(h.dtype)
+
+        cache = []
+        for e, layer in enumerate(self.layers):
+            if n_layers is not None and e == n_layers:
+                break
+
+            h, layer_cache = layer(
+                h,
+                rotation_matrix=rotation_matrix,
+                mask=mask,
+                cache=prefix[e] if prefix is not None else None,
+            )
+            cache.append(layer_cache)
+
+        caches = [[] for _ in lengths]
+        for keys, values in cache:
+            for caches_i, keys_i, values_i in zip(
+                caches,
+                keys[:, :, offset:].split(lengths, dim=2),
+                values[:, :, offset:].split(lengths, dim=2),
+            ):
+                caches_i.append((keys_i, values_i))
+
+        return self.norm(h), caches
+
+    def forward_packed(
+        self,
+        x: torch.Tensor,
+        lengths: List[int],
+        n_layers=None,
+    ) -> Tuple[torch.Tensor, List[list]]:
+        """
+        Forward pass of sequences packed in one row, without padding.
+
+        Each sequence only attends to itself and its positions start at 1,
+        so that its outputs are the ones of a forward pass on it alone.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The input tensor of shape (1, sum(lengths)).
+        lengths: [int]
+            Length of each packed sequence.
+        n_layers: Int
+            Modifier of the number of Transformer blocks.
+
+        Returns
+        -------
+        (output, caches): (torch.Tensor, [list])
+            output: the output tensor of shape (1, sum(lengths), vocab)
+            caches: cache for keys and values for each layer, for each
+                sequence
+        """
+        h, caches = self.features(x, lengths, n_layers=n_layers)
+        return self.output(h).float(), caches
+
+    @torch.no_grad()
+    def decode(
+        self,
+        x: torch.Tensor,
+        workspace: DecodeWorkspace,
+    ) -> torch.Tensor:
+        """
+        Forward pass of one token per sequence in preallocated buffers.
+
+        This is the allocation free counterpart of `forward` for the decode
+        steps: the cache for keys and values lives in the workspace, which
+        has to be filled with `DecodeWorkspace.load_cache` after prefill.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The tokens of shape (batch,).
+        workspace: DecodeWorkspace
+            Preallocated buffers.
+
+        Returns
+        -------
+        logits: torch.Tensor
+            The logits of shape (batch, vocab_size), owned by the workspace
+            and overwritten by the next call.
+        """
+        h = workspace.h
+        torch.index_select(self.tok_embeddings.weight, 0, x, out=h)
+
+        workspace.set_position(workspace.length + 1)
+        for e, layer in enumerate(self.layers):
+            layer.decode(
+                h,
+                rotation_matrix=workspace.rotation,
+                workspace=workspace,
+                layer=e,
             )
+        workspace.length += 1
 
-        return self.output(self.norm(h)), cache
+        self.norm.decode(h, out=workspace.x, workspace=workspace)
+        linear_into(workspace.x, self.output, workspace.logits_mm)
+        if workspace.logits_mm is not workspace.logits:
+            workspace.logits.copy_(workspace.logits_mm)
+        return workspace.logits
@@ -0,0 +1,524 @@
+import torch
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+
+def quantize_weight(
+    weight: torch.Tensor,
+    bits: int = 8,
+    group_size: Optional[int] = None,
+    symmetric: bool = True,
+) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+    """
+    Quantize the weight of a linear layer row by row.
+
+    Parameters
+    ----------
+    weight: torch.Tensor
+        The weight of shape (out_features, in_features).
+    bits: int
+        Number of bits per value: 8 or 4. Two 4 bits values are packed
+        in one byte along the input axis.
+    group_size: int
+        Number of consecutive input features sharing a scale.
+        When None, one scale per output channel.
+    symmetric: bool
+        Whether to quantize around 0 (int8 values and no zero point) or on
+        the [min, max] range of each group (uint8 values and zero points).
+
+    Returns
+    -------
+    (qweight, scales, zeros): (torch.Tensor, torch.Tensor, torch.Tensor)
+        qweight: quantized values
+        scales: scales of shape (out_features, n_groups)
+        zeros: zero points of shape (out_features, n_groups) or None
+    """
+    assert bits in [4, 8]
+    out_features, in_features = weight.shape
+    if group_size is None:
+        group_size = in_features
+    assert in_features % group_size == 0
+
+    w = weight.detach().float().reshape(out_features, -1, group_size)
+
+    if symmetric:
+        q_max = 2 ** (bits - 1) - 1
+        scales = w.abs().amax(dim=-1, keepdim=True) / q_max
+        scales = scales.clamp(min=1e-8)
+        q = torch.round(w / scales).clamp(-q_max - 1, q_max)
+        zeros = None
+        # Shift 4 bits values to [0, 15] before packing.
+        q = q.to(torch.int8) if bits == 8 else (q + 8).to(torch.uint8)
+
+    else:
+        q_max = 2 ** bits - 1
+        # The range must contain 0 for the zero point to be representable.
+        w_min = w.amin(dim=-1, keepdim=True).clamp(max=0)
+        w_max = w.amax(dim=-1, keepdim=True).clamp(min=0)
+        scales = ((w_max - w_min) / q_max).clamp(min=1e-8)
+        zeros = torch.round(-w_min / scales).clamp(0, q_max)
+        q = (torch.round(w / scales) + zeros).clamp(0, q_max)
+        q = q.to(torch.uint8)
+        zeros = zeros.squeeze(-1)
+
+    q = q.reshape(out_features, in_features)
+    if bits == 4:
+        q = q[:, 0::2] | (q[:, 1::2] << 4)
+    return q.contiguous(), scales.squeeze(-1), zeros
+
+
+def dequantize_weight(
+    qweight: torch.Tensor,
+    scales: torch.Tensor,
+    zeros: Optional[torch.Tensor] = None,
+    bits: int = 8,
+    dtype: torch.dtype = torch.float32,
+) -> torch.Tensor:
+    """
+    Dequantize the weight of a linear layer.
+
+    Parameters
+    ----------
+    qweight: torch.Tensor
+        Quantized values.
+    scales: torch.Tensor
+        Scales of shape (out_features, n_groups).
+    zeros: torch.Tensor
+        Zero points of shape (out_features, n_groups) or None.
+    bits: int
+        Number of bits per value: 8 or 4.
+    dtype: torch.dtype
+        Precision type of the dequantized weight.
+
+    Returns
+    -------
+    _: torch.Tensor
+        The weight of shape (out_features, in_features).
+    """
+    if bits == 4:
+        q = torch.stack([qweight & 0x0F, qweight >> 4], dim=-1)
+        q = q.reshape(qweight.shape[0], -1).float()
+        if zeros is None:
+            q -= 8
+    else:
+        q = qweight.float()
+
+    out_features, in_features = q.shape
+    q = q.reshape(out_features, scales.shape[1], -1)
+    if zeros is not None:
+        q -= zeros.float().unsqueeze(-1)
+    q *= scales.float().unsqueeze(-1)
+    return q.reshape(out_features, in_features).to(dtype)
+
+
+class QuantizedLinear(torch.nn.Module):
+    """
+    Linear layer without biases whose weight is stored quantized.
+
+    At each forward, the weight is dequantized in the precision of the input
+    by tiles of output rows, each tile being multiplied right away: only one
+    tile of the weight exists in full precision at once. With
+    `cache_weight`, the weight is instead dequantized once and kept, which
+    trades the memory saved by quantization for speed.
+
+    Parameters
+    ----------
+    in_features: int
+        Number of input features.
+    out_features: int
+        Number of output features.
+    bits: int
+        Number of bits per value: 8 or 4.
+    group_size: int
+        Number of consecutive input features sharing a scale.
+        When None, one scale per output channel.
+    device: torch.device
+        Device on which the buffers are allocated.
+    tile_size: int
+        Number of weight values dequantized at once.
+    cache_weight: bool
+        Whether to keep the dequantized weight between forwards.
+    """
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        bits: int = 8,
+        group_size: Optional[int] = None,
+        device: Optional[torch.device] = None,
+        tile_size: int = 2 ** 22,
+        cache_weight: bool = False,
+    ):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = in_features if group_size is None else group_size
+        self.tile_size = tile_size
+        self.cache_weight = cache_weight
+        self._weight_cache: Optional[Tuple[Tuple, torch.Tensor]] = None
+
+        packed_features = in_features if bits == 8 else in_features // 2
+        self.register_buffer("qweight", torch.zeros(
+            (out_features, packed_features),
+            dtype=torch.int8 if bits == 8 else torch.uint8,
+            device=device,
+        ))
+        self.register_buffer("scales", torch.ones(
+            (out_features, in_features // self.group_size), device=device
+        ))
+
+    @staticmethod
+    def from_linear(
+        linear: torch.nn.Linear,
+        bits: int = 8,
+        group_size: Optional[int] = None,
+        cache_weight: bool = False,
+    ) -> "QuantizedLinear":
+        """
+        Quantize a linear layer.
+
+        Parameters
+        ----------
+        linear: torch.nn.Linear
+            The linear layer to quantize.
+        bits: int
+            Number of bits per value: 8 or 4.
+        group_size: int
+            Number of consecutive input features sharing a scale.
+        cache_weight: bool
+            Whether to keep the dequantized weight between forwards.
+
+        Returns
+        -------
+        _: QuantizedLinear
+            The quantized layer.
+        """
+        module = QuantizedLinear(
+            linear.in_features, linear.out_features, bits, group_size,
+            cache_weight=cache_weight,
+        )
+        module.qweight, module.scales, _ = quantize_weight(
+            linear.weight, bits, group_size
+        )
+        return module
+
+    def _dequantize(
+        self,
+        dtype: torch.dtype,
+        start: int = 0,
+        end: Optional[int] = None,
+    ) -> torch.Tensor:
+        """
+        Dequantize rows of the weight.
+
+        Parameters
+        ----------
+        dtype: torch.dtype
+            Precision type of the dequantized rows.
+        start: int
+            First output row.
+        end: int
+            End of the output rows, None for all of them.
+
+        Returns
+        -------
+        _: torch.Tensor
+            The rows of shape (end - start, in_features).
+        """
+        return dequantize_weight(
+            self.qweight[start:end], self.scales[start:end],
+            bits=self.bits, dtype=dtype,
+        )
+
+    def cached_weight(self, dtype: torch.dtype) -> torch.Tensor:
+        """
+        Get the dequantized weight, dequantizing it when the quantized
+        buffers or the precision type changed.
+
+        Parameters
+        ----------
+        dtype: torch.dtype
+            Precision type of the dequantized weight.
+
+        Returns
+        -------
+        _: torch.Tensor
+            The weight of shape (out_features, in_features).
+        """
+        key = (dtype, self.qweight.data_ptr(), self.scales.data_ptr())
+        if self._weight_cache is None or self._weight_cache[0] != key:
+            self._weight_cache = None
+            self._weight_cache = (key, self._dequantize(dtype))
+        return self._weight_cache[1]
+
+    def weight_rows(self, rows: torch.Tensor) -> torch.Tensor:
+        """
+        Dequantize some rows of the weight only.
+
+        Parameters
+        ----------
+        rows: torch.Tensor
+            Indices of the output rows.
+
+        Returns
+        -------
+        _: torch.Tensor
+            The rows of shape (len(rows), in_features).
+        """
+        rows = rows.to(self.qweight.device)
+        return dequantize_weight(
+            self.qweight[rows], self.scales[rows],
+            bits=self.bits, dtype=self.scales.dtype,
+        )
+
+    @property
+    def weight(self) -> torch.Tensor:
+        """
+        The dequantized weight, dequantized again at each access unless
+        `cache_weight` is set: the forward passes do not use it.
+        """
+        if self.cache_weight:
+            return self.cached_weight(self.scales.dtype)
+        return self._dequantize(self.scales.dtype)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Forward pass.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The input tensor.
+
+        Returns
+        -------
+        _: torch.Tensor
+            The output tensor.
+        """
+        if self.cache_weight:
+            return torch.nn.functional.linear(
+                x, self.cached_weight(x.dtype)
+            )
+
+        rows = max(self.tile_size // self.in_features, 1)
+        if rows >= self.out_features:
+            return torch.nn.functional.linear(x, self._dequantize(x.dtype))
+
+        out = x.new_empty(x.shape[:-1] + (self.out_features,))
+        return self.forward_into(x, out)
+
+    def forward_into(
+        self,
+        x: torch.Tensor,
+        out: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Forward pass writing into a preallocated output.
+
+        Parameters
+        ----------
+        x: torch.Tensor
+            The input tensor.
+        out: torch.Tensor
+            The output tensor of shape x.shape[:-1] + (out_features,).
+
+        Returns
+        -------
+        out: torch.Tensor
+            The output tensor.
+        """
+        if self.cache_weight:
+            return torch.matmul(x, self.cached_weight(x.dtype).t(), out=out)
+
+        rows = max(self.tile_size // self.in_features, 1)
+        for start in range(0, self.out_features, rows):
+            weight = self._dequantize(x.dtype, start, start + rows)
+            out[..., start:start + rows] = \
+                torch.nn.functional.linear(x, weight)
+            del weight
+        return out
+
+
+def linear_into(
+    x: torch.Tensor,
+    layer: torch.nn.Module,
+    out: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Apply a linear layer without biases, writing into a preallocated
+    output.
+
+    A quantized layer never goes through its `weight` property, which
+    would dequantize the full weight at each call.
+
+    Parameters
+    ----------
+    x: torch.Tensor
+        The input tensor of shape (batch, in_features).
+    layer: torch.nn.Module
+        A `torch.nn.Linear` or a `QuantizedLinear`.
+    out: torch.Tensor
+        The output tensor of shape (batch, out_features).
+
+    Returns
+    -------
+    out: torch.Tensor
+        The output tensor.
+    """
+    if isinstance(layer, QuantizedLinear):
+        return layer.forward_into(x, out)
+    return torch.mm(x, layer.weight.t(), out=out)
+
+
+def quantize_model(
+    model: torch.nn.Module,
+    bits: int = 8,
+    group_size: Optional[int] = None,
+    from_weights: bool = True,
+    device: Optional[torch.device] = None,
+    cache_weight: bool = False,
+) -> torch.nn.Module:
+    """
+    Replace the linear layers of a model (attention, feed forward and
+    output) with quantized ones, in place.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+        The model to quantize.
+    bits: int
+        Number of bits per value: 8 or 4.
+    group_size: int
+        Number of consecutive input features sharing a scale.
+    from_weights: bool
+        Whether to quantize the current weights or to leave the quantized
+        layers empty, waiting for a quantized state to be loaded.
+    device: torch.device
+        Device on which the empty quantized layers are allocated.
+    cache_weight: bool
+        Whether the layers keep their dequantized weight between forwards,
+        see `QuantizedLinear`.
+
+    Returns
+    -------
+    model: torch.nn.Module
+        The quantized model.
+    """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if not isinstance(child, torch.nn.Linear):
+                continue
+
+            if from_weights:
+                layer = QuantizedLinear.from_linear(
+                    child, bits, group_size, cache_weight=cache_weight
+                )
+            else:
+                layer = QuantizedLinear(
+                    child.in_features, child.out_features, bits, group_size,
+                    device=device, cache_weight=cache_weight,
+                )
+            setattr(module, name, layer)
+    return model
+
+
+def quantize_state(
+    state: Dict[str, torch.Tensor],
+    bits: int = 8,
+    group_size: Optional[int] = None,
+) -> Dict[str, torch.Tensor]:
+    """
+    Quantize the weights of the linear layers of a checkpoint.
+
+    Every 2D weight except the embeddings is considered to come from
+    a linear layer: "x.weight" is replaced with "x.qweight" and "x.scales".
+
+    Parameters
+    ----------
+    state: [str: torch.Tensor]
+        The checkpoint state.
+    bits: int
+        Number of bits per value: 8 or 4.
+    group_size: int
+        Number of consecutive input features sharing a scale.
+
+    Returns
+    -------
+    _: [str: torch.Tensor]
+        The quantized state.
+    """
+    quantized_state = {}
+    for key, value in state.items():
+        if key.endswith(".weight") and value.dim() == 2 and \
+           "embed" not in key:
+            prefix = key[:-len("weight")]
+            qweight, scales, _ = quantize_weight(value, bits, group_size)
+            quantized_state[prefix + "qweight"] = qweight
+            quantized_state[prefix + "scales"] = scales
+        else:
+            quantized_state[key] = value
+    return quantized_state
+
+
+def load_quantized_state(
+    model_path: str,
+    load_state: Callable[[], Dict[str, torch.Tensor]],
+    bits: int = 8,
+    group_size: Optional[int] = None,
+) -> Dict[str, torch.Tensor]:
+    """
+    Load a quantized state, quantizing and persisting it next to the
+    checkpoint the first time. The fingerprint of the checkpoint is stored
+    in the metadata of the file: the state is quantized again when the
+    checkpoint changed.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    load_state: Callable
+        Function loading the original state.
+    bits: int
+        Number of bits per value: 8 or 4.
+    group_size: int
+        Number of consecutive input features sharing a scale.
+
+    Returns
+    -------
+    _: [str: torch.Tensor]
+        The quantized state.
+    """
+    # `python_lib.weight` imports this module.
+    from python_lib.weight import _checkpoint_fingerprint
+
+    group = "row" if group_size is None else str(group_size)
+    cache_path = Path(model_path) / \
+        f"quantized-int{bits}-g{group}.safetensors"
+    metadata = {
+        "format": "pt",
+        "source": _checkpoint_fingerprint(model_path),
+    }
+    if cache_path.exists():
+        with safe_open(str(cache_path), framework="pt", device="cpu") as f:
+            valid = f.metadata() == metadata
+        if valid:
+            return load_file(str(cache_path))
+
+    state = quantize_state(load_state(), bits, group_size)
+
+    # Tied weights share memory, which safetensors refuses to serialize.
+    state_copy = {}
+    data_ptrs = set()
+    for key, value in state.items():
+        value = value.contiguous()
+        if value.data_ptr() in data_ptrs:
+            value = value.clone()
+        data_ptrs.add(value.data_ptr())
+        state_copy[key] = value
+    save_file(state_copy, str(cache_path), metadata=metadata)
+    return state
@@ -0,0 +1,410 @@
+import os
+import gc
+import torch
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+from safetensors import safe_open
+from python_lib.weight import _index_shards
+
+
+def model_nbytes(model: torch.nn.Module) -> int:
+    """
+    Count the bytes of the parameters and buffers of a model.
+
+    Tensors sharing memory (tied weights) are counted once.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+        The model.
+
+    Returns
+    -------
+    _: int
+        Number of bytes.
+    """
+    seen = set()
+    nbytes = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        key = (tensor.device, tensor.data_ptr())
+        if key not in seen:
+            seen.add(key)
+            nbytes += tensor.numel() * tensor.element_size()
+    return nbytes
+
+
+def estimate_nbytes(
+    model_path: str,
+    dtype: torch.dtype = torch.float32,
+    bits: Optional[int] = None,
+    group_size: Optional[int] = None,
+) -> Optional[int]:
+    """
+    Estimate the bytes of a model before loading it, from the shapes in
+    the header of its safetensors checkpoint.
+
+    Without a safetensors checkpoint, the size of the PyTorch checkpoint
+    files is used instead.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    dtype: torch.dtype
+        Precision type of the model.
+    bits: int
+        Number of bits of the quantized linear layers, None when the model
+        is not quantized.
+    group_size: int
+        Number of consecutive input features sharing a scale.
+        None for one scale per output channel.
+
+    Returns
+    -------
+    _: int
+        Number of bytes, None when no checkpoint is found.
+    """
+    try:
+        index = _index_shards(model_path)
+    except FileNotFoundError:
+        paths = list(Path(model_path).glob("*.pth"))
+        if len(paths) == 0:
+            return None
+        return sum(path.stat().st_size for path in paths)
+
+    shards: Dict[Path, list] = {}
+    for key, path in index.items():
+        shards.setdefault(path, []).append(key)
+
+    element_size = torch.empty((), dtype=dtype).element_size()
+    nbytes = 0
+    for path, keys in shards.items():
+        with safe_open(str(path), framework="pt", device="cpu") as f:
+            for key in keys:
+                shape = f.get_slice(key).get_shape()
+                numel = 1
+                for size in shape:
+                    numel *= size
+                # Same rule as `quantize_state` for the linear layers.
+                if bits is not None and key.endswith(".weight") and \
+                   len(shape) == 2 and "embed" not in key:
+                    n_groups = 1 if group_size is None \
+                        else shape[1] // group_size
+                    nbytes += numel * bits // 8 + \
+                        shape[0] * n_groups * element_size
+                else:
+                    nbytes += numel * element_size
+    return nbytes
+
+
+def _default_budget() -> Optional[int]:
+    """
+    Half of the physical memory, None when it is not known.
+
+    Returns
+    -------
+    _: int
+        Number of bytes.
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class ModelRegistry:
+    """
+    Keep loaded models in memory across calls.
+
+    The models are identified by their path, precision type, device and
+    loading options. When the models exceed the memory budget, the least
+    recently used ones are released. Given an estimate of its size, room
+    is made for a model before it is loaded, so that the models in memory
+    never exceed the budget during the loading. The model being requested
+    is always kept, even if it exceeds the budget alone.
+
+    Parameters
+    ----------
+    max_bytes: int
+        Memory budget of the models in bytes, None for no limit.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self._models: "OrderedDict[Tuple, Tuple[torch.nn.Module, int]]" = \
+            OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def make_key(
+        model_path: str,
+        dtype: torch.dtype,
+        device: str,
+        **options: Hashable,
+    ) -> Tuple:
+        """
+        Identify a model.
+
+        Parameters
+        ----------
+        model_path: str
+            Path to the model on the disk.
+        dtype: torch.dtype
+            Precision type of the model.
+        device: str
+            Device of the model.
+        options: Hashable
+            Other loading options, like quantization bits.
+
+        Returns
+        -------
+        _: Tuple
+            The key of the model.
+        """
+        return (
+            str(Path(model_path).resolve()),
+            dtype,
+            str(device),
+            tuple(sorted(options.items())),
+        )
+
+    def get(
+        self,
+        key: Tuple,
+        load_model: Callable[[], torch.nn.Module],
+        estimate: Optional[Callable[[], Optional[int]]] = None,
+    ) -> torch.nn.Module:
+        """
+        Get a model, loading it the first time.
+
+        Parameters
+        ----------
+        key: Tuple
+            The key of the model, see `make_key`.
+        load_model: Callable
+            Function loading the model.
+        estimate: Callable
+            Function estimating the bytes of the model before it is loaded,
+            like `estimate_nbytes`. It may return None when unknown.
+
+        Returns
+        -------
+        model: torch.nn.Module
+            The model.
+        """
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+
+            nbytes = None if estimate is None else estimate()
+            if nbytes is not None:
+                self._evict(reserved=nbytes, keep=0)
+
+            model = load_model()
+            self._models[key] = (model, model_nbytes(model))
+            self._evict()
+            return model
+
+    def _evict(self, reserved: int = 0, keep: int = 1):
+        """
+        Release the least recently used models until the budget is met.
+
+        Parameters
+        ----------
+        reserved: int
+            Bytes to leave free in the budget, for a model to be loaded.
+        keep: int
+            Number of most recently used models never released.
+        """
+        if self.max_bytes is None:
+            return
+
+        released = False
+        while len(self._models) > keep and \
+                self.nbytes() + reserved > self.max_bytes:
+            self._models.popitem(last=False)
+            released = True
+        if released:
+            gc.collect()
+
+    def unload(self, model_path: Optional[str] = None) -> int:
+        """
+        Release the models of a path, all the models when None.
+
+        Parameters
+        ----------
+        model_path: str
+            Path to the model on the disk.
+
+        Returns
+        -------
+        _: int
+            Number of models released.
+        """
+        with self._lock:
+            if model_path is None:
+                keys = list(self._models.keys())
+            else:
+                path = str(Path(model_path).resolve())
+                keys = [key for key in self._models if key[0] == path]
+            for key in keys:
+                del self._models[key]
+            gc.collect()
+            return len(keys)
+
+    def nbytes(self) -> int:
+        """
+        Count the bytes of the models in memory.
+
+        Returns
+        -------
+        _: int
+            Number of bytes.
+        """
+        return sum(nbytes for _, nbytes in self._models.values())
+
+    def info(self) -> Dict[str, int]:
+        """
+        Report the models in memory.
+
+        Returns
+        -------
+        _: Dict[str, int]
+            Bytes of each model, identified by its path and precision type.
+        """
+        with self._lock:
+            return {
+                f"{path} ({dtype}, {device})": nbytes
+                for (path, dtype, device, _), (_, nbytes)
+                in self._models.items()
+            }
+
+
+_registry = ModelRegistry(max_bytes=_default_budget())
+
+
+def get_model(
+    model_path: str,
+    load_model: Callable[[], torch.nn.Module],
+    dtype: torch.dtype = torch.float32,
+    device: str = "mps",
+    **options: Hashable,
+) -> torch.nn.Module:
+    """
+    Get a model from the process-wide registry, loading it the first time.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    load_model: Callable
+        Function loading the model on `device` with `dtype`.
+    dtype: torch.dtype
+        Precision type of the model.
+    device: str
+        Device of the model.
+    options: Hashable
+        Other loading options, like quantization bits. The "bits" and
+        "group_size" options are used to estimate the size of the model.
+
+    Returns
+    -------
+    model: torch.nn.Module
+        The model.
+    """
+    key = ModelRegistry.make_key(model_path, dtype, device, **options)
+    return _registry.get(
+        key, load_model,
+        estimate=lambda: estimate_nbytes(
+            model_path, dtype,
+            bits=options.get("bits"),
+            group_size=options.get("group_size"),
+        ),
+    )
+
+
+def unload_model(model_path: Optional[str] = None) -> int:
+    """
+    Release the models of a path from the process-wide registry,
+    all the models when None.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+
+    Returns
+    -------
+    _: int
+        Number of models released.
+    """
+    return _registry.unload(model_path)
+
+
+def set_memory_budget(max_bytes: Optional[int]):
+    """
+    Set the memory budget of the process-wide registry.
+
+    Parameters
+    ----------
+    max_bytes: int
+        Memory budget of the models in bytes, None for no limit.
+    """
+    with _registry._lock:
+        _registry.max_bytes = max_bytes
+        _registry._evict()
+
+
+if __name__ == "__main__":
+    import tempfile
+    from safetensors.torch import save_file
+
+    registry = ModelRegistry()
+    paths = []
+    for name in ["a", "b", "c"]:
+        path = Path(tempfile.mkdtemp()) / name
+        path.mkdir()
+        save_file(
+            {"layer.weight": torch.zeros(64, 64)},
+            str(path / "model.safetensors"),
+        )
+        paths.append(str(path))
+    model_size = estimate_nbytes(paths[0])
+    assert model_size == 64 * 64 * 4
+    registry.max_bytes = 2 * model_size
+
+    loaded = []
+
+    def load(path: str) -> Callable[[], torch.nn.Module]:
+        def load_model() -> torch.nn.Module:
+            # Room must have been made before loading.
+            assert registry.nbytes() + model_size <= registry.max_bytes
+            loaded.append(path)
+            return torch.nn.Linear(64, 64, bias=False)
+        return load_model
+
+    def get(path: str) -> torch.nn.Module:
+        return registry.get(
+            ModelRegistry.make_key(path, torch.float32, "cpu"),
+            load(path),
+            estimate=lambda: estimate_nbytes(path),
+        )
+
+    get(paths[0])
+    get(paths[1])
+    get(paths[0])
+    # "b" is the least recently used model.
+    get(paths[2])
+    assert [key[0] for key in registry._models] == [
+        str(Path(paths[0]).resolve()), str(Path(paths[2]).resolve())
+    ]
+    get(paths[1])
+    assert [key[0] for key in registry._models] == [
+        str(Path(paths[2]).resolve()), str(Path(paths[1]).resolve())
+    ]
+    assert loaded == [paths[0], paths[1], paths[2], paths[1]]
+    print("ok")
@@ -0,0 +1,418 @@
+import json
+import math
+import torch
+import numpy as np
+from pathlib import Path
+from typing import Dict, Generator, Iterable, List, Optional
+
+from python_lib.nlp.batch import make_packs
+
+
+def token_logprobs(
+    model: torch.nn.Module,
+    h: torch.Tensor,
+    targets: torch.Tensor,
+    chunk_size: int = 512,
+) -> torch.Tensor:
+    """
+    Compute the log-probabilities of target tokens from hidden states.
+
+    The logits are computed for `chunk_size` positions at a time and
+    reduced to the log-probability of their target right away:
+    log p(t) = logit(t) - logsumexp(logits). Neither the logits nor the
+    log-softmax of all the positions are materialized.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model whose output layer is applied.
+    h: torch.Tensor
+        Normalized hidden states of shape (n, dim), see
+        `Transformer.features`.
+    targets: torch.Tensor
+        Token predicted by each hidden state, of shape (n,).
+    chunk_size: int
+        Number of positions whose logits are computed at once.
+
+    Returns
+    -------
+    _: torch.Tensor
+        The float32 log-probabilities of shape (n,).
+    """
+    logprobs = []
+    for start in range(0, h.shape[0], chunk_size):
+        logits = model.output(h[start:start + chunk_size]).float()
+        target_logits = logits.gather(
+            -1, targets[start:start + chunk_size, None]
+        )[:, 0]
+        logprobs.append(target_logits - torch.logsumexp(logits, dim=-1))
+        del logits
+    if len(logprobs) == 0:
+        return torch.zeros(0, device=h.device)
+    return torch.cat(logprobs)
+
+
+def score_tokens(
+    model: torch.nn.Module,
+    tokens: List[int],
+    context_len: int = 4096,
+    stride: Optional[int] = None,
+    chunk_size: int = 512,
+    n_layers: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Compute the log-probability of each token given the previous ones.
+
+    Sequences longer than the context are evaluated with a sliding window:
+    windows of `context_len` tokens start every `stride` tokens and each
+    one only scores the tokens not scored by the previous windows, so that
+    every token but the first ones has at least `context_len - stride`
+    tokens of context.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model.
+    tokens: [int]
+        The sequence of tokens.
+    context_len: int
+        Maximal number of tokens in a forward pass.
+    stride: int
+        Number of tokens between the starts of two windows, None for
+        `context_len // 2`. It is at most `context_len - 1`: the first
+        token scored by a window is predicted by the last token of the
+        previous one.
+    chunk_size: int
+        Number of positions whose logits are computed at once.
+    n_layers: int
+        Modifier of the number of Transformer blocks.
+
+    Returns
+    -------
+    _: np.ndarray
+        The log-probabilities of tokens[1:].
+    """
+    assert context_len > 1
+    if stride is None:
+        stride = context_len // 2
+    stride = min(stride, context_len - 1)
+    assert stride > 0
+
+    device = next(model.parameters()).device
+    tokens = torch.tensor(tokens, dtype=torch.long, device=device)
+
+    logprobs = []
+    scored = 1
+    for begin in range(0, len(tokens), stride):
+        end = min(begin + context_len, len(tokens))
+        if end > scored:
+            with torch.no_grad():
+                h, _ = model.features(
+                    tokens[None, begin:end], n_layers=n_layers
+                )
+                logprobs.append(token_logprobs(
+                    model,
+                    h[0, scored - 1 - begin:end - 1 - begin],
+                    tokens[scored:end],
+                    chunk_size=chunk_size,
+                ).cpu())
+            scored = end
+        if end == len(tokens):
+            break
+
+    if len(logprobs) == 0:
+        return np.zeros(0, dtype=np.float32)
+    return torch.cat(logprobs).numpy()
+
+
+def _score_pack(
+    model: torch.nn.Module,
+    sequences: List[List[int]],
+    chunk_size: int,
+    n_layers: Optional[int],
+) -> List[np.ndarray]:
+    """
+    Compute the log-probabilities of sequences packed in one row.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model.
+    sequences: [[int]]
+        The sequences of tokens, shorter than the context.
+    chunk_size: int
+        Number of positions whose logits are computed at once.
+    n_layers: int
+        Modifier of the number of Transformer blocks.
+
+    Returns
+    -------
+    _: [np.ndarray]
+        For each sequence, the log-probabilities of its tokens but the
+        first one.
+    """
+    device = next(model.parameters()).device
+    lengths = [len(sequence) for sequence in sequences]
+    x = torch.tensor([sum(sequences, [])], dtype=torch.long, device=device)
+
+    with torch.no_grad():
+        h, _ = model.features(x, lengths, n_layers=n_layers)
+
+        # The last position of each sequence predicts nothing.
+        predicting = []
+        start = 0
+        for length in lengths:
+            predicting.extend(range(start, start + length - 1))
+            start += length
+        predicting = torch.tensor(predicting, dtype=torch.long, device=device)
+
+        logprobs = token_logprobs(
+            model, h[0, predicting], x[0, predicting + 1],
+            chunk_size=chunk_size,
+        ).cpu()
+    return list(logprobs.split([length - 1 for length in lengths]))
+
+
+def score_sequences(
+    model: torch.nn.Module,
+    sequences: Iterable[List[int]],
+    context_len: int = 4096,
+    stride: Optional[int] = None,
+    max_batch_tokens: int = 4096,
+    buffer_size: int = 256,
+    chunk_size: int = 512,
+    n_layers: Optional[int] = None,
+    return_logprobs: bool = False,
+) -> Generator[Dict, None, None]:
+    """
+    Score a stream of token sequences.
+
+    The sequences are read `buffer_size` at a time: the ones fitting in the
+    context are packed in rows of at most `max_batch_tokens` tokens, the
+    longer ones are evaluated with a sliding window. The results are
+    yielded in the input order, so that corpora larger than the memory can
+    be scored.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model.
+    sequences: Iterable[[int]]
+        The sequences of tokens.
+    context_len: int
+        Maximal number of tokens in a forward pass.
+    stride: int
+        Number of tokens between the starts of two sliding windows.
+    max_batch_tokens: int
+        Maximal number of tokens in a packed row.
+    buffer_size: int
+        Number of sequences read before running the model.
+    chunk_size: int
+        Number of positions whose logits are computed at once.
+    n_layers: int
+        Modifier of the number of Transformer blocks.
+    return_logprobs: bool
+        Whether to also return the log-probability of each token.
+
+    Returns
+    -------
+    _: Dict
+        For each sequence: its log-likelihood, its number of scored tokens
+        and, with `return_logprobs`, the log-probabilities of its tokens
+        but the first one.
+    """
+    def flush(buffer: List[List[int]]) -> Generator[Dict, None, None]:
+        results = [None] * len(buffer)
+        short = [
+            i for i, sequence in enumerate(buffer)
+            if 1 < len(sequence) <= min(context_len, max_batch_tokens)
+        ]
+        for pack in make_packs(
+            [len(buffer[i]) for i in short], max_batch_tokens
+        ):
+            pack = [short[i] for i in pack]
+            for i, logprobs in zip(pack, _score_pack(
+                model, [buffer[i] for i in pack], chunk_size, n_layers
+            )):
+                results[i] = logprobs.numpy()
+
+        for i, sequence in enumerate(buffer):
+            if results[i] is None:
+                results[i] = score_tokens(
+                    model, sequence,
+                    context_len=context_len,
+                    stride=stride,
+                    chunk_size=chunk_size,
+                    n_layers=n_layers,
+                )
+
+        for logprobs in results:
+            result = {
+                "log_likelihood": float(logprobs.sum(dtype=np.float64)),
+                "n_tokens": len(logprobs),
+            }
+            if return_logprobs:
+                result["logprobs"] = logprobs
+            yield result
+
+    buffer = []
+    for sequence in sequences:
+        buffer.append(list(sequence))
+        if len(buffer) == buffer_size:
+            yield from flush(buffer)
+            buffer = []
+    if len(buffer) > 0:
+        yield from flush(buffer)
+
+
+def score_corpus(
+    model: torch.nn.Module,
+    sequences: Iterable[List[int]],
+    output_path: Optional[str] = None,
+    **kwargs,
+) -> Dict[str, float]:
+    """
+    Compute the perplexity of a model on a corpus, optionally writing the
+    score of each sequence as a JSON line.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model.
+    sequences: Iterable[[int]]
+        The sequences of tokens.
+    output_path: str
+        Path to the JSON lines file of the scores of the sequences.
+    kwargs:
+        Options of `score_sequences`.
+
+    Returns
+    -------
+    _: Dict[str, float]
+        Log-likelihood, number of scored tokens and perplexity of the
+        corpus.
+    """
+    log_likelihood = 0.0
+    n_tokens = 0
+
+    f = open(Path(output_path), "w") if output_path is not None else None
+    try:
+        for result in score_sequences(model, sequences, **kwargs):
+            log_likelihood += result["log_likelihood"]
+            n_tokens += result["n_tokens"]
+            if f is not None:
+                f.write(json.dumps({
+                    "log_likelihood": result["log_likelihood"],
+                    "n_tokens": result["n_tokens"],
+                }) + "\n")
+    finally:
+        if f is not None:
+            f.close()
+
+    return {
+        "log_likelihood": log_likelihood,
+        "n_tokens": n_tokens,
+        "perplexity": math.exp(-log_likelihood / max(n_tokens, 1)),
+    }
+
+
+def score_choices(
+    model: torch.nn.Module,
+    context: List[int],
+    continuations: List[List[int]],
+    max_batch_tokens: int = 4096,
+    chunk_size: int = 512,
+    n_layers: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Compute the log-likelihood of continuations of the same context,
+    as in multiple-choice evaluation.
+
+    The context is run once. The continuations are then packed in rows
+    that all attend to the cache of the context, which is shared and not
+    copied per continuation.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model.
+    context: [int]
+        The tokens of the shared context.
+    continuations: [[int]]
+        The tokens of each continuation.
+    max_batch_tokens: int
+        Maximal number of continuation tokens in a forward pass.
+    chunk_size: int
+        Number of positions whose logits are computed at once.
+    n_layers: int
+        Modifier of the number of Transformer blocks.
+
+    Returns
+    -------
+    _: np.ndarray
+        The log-likelihood of each continuation given the context.
+    """
+    assert len(context) > 0
+    device = next(model.parameters()).device
+    lengths = [len(continuation) for continuation in continuations]
+    log_likelihoods = np.zeros(len(continuations), dtype=np.float64)
+
+    with torch.no_grad():
+        h, caches = model.features(
+            torch.tensor([context], dtype=torch.long, device=device),
+            n_layers=n_layers,
+        )
+        last = h[0, -1:]
+        prefix = caches[0]
+
+        for pack in make_packs(lengths, max_batch_tokens):
+            pack = [i for i in pack if lengths[i] > 0]
+            if len(pack) == 0:
+                continue
+            pack_lengths = [lengths[i] for i in pack]
+            x = torch.tensor(
+                [sum([continuations[i] for i in pack], [])],
+                dtype=torch.long, device=device,
+            )
+            h, _ = model.features(
+                x, pack_lengths, n_layers=n_layers, prefix=prefix
+            )
+
+            # The first token of a continuation is predicted by the last
+            # token of the context, the next ones by the continuation.
+            rows = []
+            targets = []
+            start = 0
+            for length in pack_lengths:
+                rows.append(last)
+                rows.append(h[0, start:start + length - 1])
+                targets.append(x[0, start:start + length])
+                start += length
+
+            logprobs = token_logprobs(
+                model, torch.cat(rows), torch.cat(targets),
+                chunk_size=chunk_size,
+            ).cpu()
+            for i, logprobs_i in zip(pack, logprobs.split(pack_lengths)):
+                log_likelihoods[i] = logprobs_i.sum(dtype=torch.float64)
+    return log_likelihoods
+
+
+if __name__ == "__main__":
+    from python_lib.nlp.model import Transformer, TransformerArgs
+
+    torch.manual_seed(0)
+    model = Transformer(TransformerArgs(
+        dim=64, n_layers=2, head_dim=16, hidden_dim=128,
+        n_heads=4, n_kv_heads=2, norm_eps=1e-5, vocab_size=100,
+    )).eval()
+    tokens = torch.randint(0, 100, (40,)).tolist()
+
+    # Every token but the first one is scored, whatever the stride.
+    reference = score_tokens(model, tokens, context_len=8, stride=7)
+    for stride in [1, 4, 7, 8, 16]:
+        logprobs = score_tokens(model, tokens, context_len=8, stride=stride)
+        assert len(logprobs) == len(tokens) - 1
+    logprobs = score_tokens(model, tokens, context_len=8, stride=8)
+    assert np.allclose(logprobs, reference, atol=1e-5)
+    print("ok")
@@ -0,0 +1,218 @@
+import torch
+from functools import partial
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Type, Union
+
+from python_lib.weight import LazyTensor
+from python_lib.nlp.loader import assign_state
+
+
+def _load(
+    tensor: Union[torch.Tensor, LazyTensor],
+    device: torch.device,
+) -> torch.Tensor:
+    """
+    Read a tensor if it is lazy and move it on a device.
+
+    Parameters
+    ----------
+    tensor: torch.Tensor | LazyTensor
+        The tensor.
+    device: torch.device
+        The device.
+
+    Returns
+    -------
+    _: torch.Tensor
+        The tensor on the device.
+    """
+    if isinstance(tensor, LazyTensor):
+        tensor = tensor.load()
+    return tensor.to(device)
+
+
+class LayerStreamer:
+    """
+    Page the weights of the Transformer blocks in just before they run.
+
+    The weights of a block are read from the (lazy) state by a forward
+    pre-hook, while the weights of the next block are read on a background
+    thread. At most `resident_layers` blocks (prefetched ones included) are
+    in memory, the least recently used ones being sent back to the "meta"
+    device.
+
+    Only the regular forward is streamed, not the decode path.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model whose blocks are on the "meta" device.
+    state: [str: torch.Tensor | LazyTensor]
+        The checkpoint state.
+    resident_layers: int
+        Maximal number of blocks in memory.
+    device: torch.device
+        Device on which the blocks run.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        state: Dict[str, Union[torch.Tensor, LazyTensor]],
+        resident_layers: int = 2,
+        device: torch.device = "cpu",
+    ):
+        assert resident_layers >= 1
+        self.model = model
+        self.resident_layers = resident_layers
+        self.device = device
+        self.n_layers = len(model.layers)
+
+        self.layer_states: List[Dict[str, Union[torch.Tensor, LazyTensor]]]
+        self.layer_states = [{} for _ in range(self.n_layers)]
+        for key, value in state.items():
+            if key.startswith("layers."):
+                layer, name = key[len("layers."):].split(".", 1)
+                self.layer_states[int(layer)][name] = value
+
+        self._resident: List[int] = []
+        self._pending: Dict[int, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._handles = [
+            layer.register_forward_pre_hook(partial(self._page_in, e))
+            for e, layer in enumerate(model.layers)
+        ]
+
+    def _read(self, layer: int) -> Dict[str, torch.Tensor]:
+        """
+        Read the weights of a block.
+
+        Parameters
+        ----------
+        layer: int
+            Index of the block.
+
+        Returns
+        -------
+        _: [str: torch.Tensor]
+            The state of the block.
+        """
+        return {
+            name: _load(value, self.device)
+            for name, value in self.layer_states[layer].items()
+        }
+
+    def _evict(self, n_blocks: int, keep: int):
+        """
+        Release the least recently used blocks until there is room for
+        `n_blocks` more.
+
+        Parameters
+        ----------
+        n_blocks: int
+            Number of blocks to make room for.
+        keep: int
+            Index of a block not to release.
+        """
+        candidates = [e for e in self._resident if e != keep]
+        while len(self._resident) + len(self._pending) + n_blocks > \
+                self.resident_layers and len(candidates) > 0:
+            layer = candidates.pop(0)
+            self._resident.remove(layer)
+            self.model.layers[layer].to_empty(device="meta")
+
+    def _page_in(self, layer: int, module: torch.nn.Module, *args):
+        """
+        Forward pre-hook of a block: make it resident and prefetch
+        the next one.
+
+        Parameters
+        ----------
+        layer: int
+            Index of the block.
+        module: torch.nn.Module
+            The block.
+        """
+        if layer in self._resident:
+            self._resident.remove(layer)
+        else:
+            future = self._pending.pop(layer, None)
+            if future is None:
+                self._evict(1, keep=layer)
+                tensors = self._read(layer)
+            else:
+                tensors = future.result()
+            assign_state(module, tensors)
+        self._resident.append(layer)
+
+        next_layer = (layer + 1) % self.n_layers
+        if self.resident_layers > 1 and next_layer != layer and \
+           next_layer not in self._resident and \
+           next_layer not in self._pending:
+            self._evict(1, keep=layer)
+            self._pending[next_layer] = self._executor.submit(
+                self._read, next_layer
+            )
+
+    def close(self):
+        """
+        Remove the hooks and stop the background thread.
+        """
+        for handle in self._handles:
+            handle.remove()
+        self._executor.shutdown(wait=True)
+        self._pending.clear()
+
+
+def build_streaming_model(
+    model_cls: Type[torch.nn.Module],
+    args,
+    state: Dict[str, Union[torch.Tensor, LazyTensor]],
+    dtype: torch.dtype = torch.float32,
+    resident_layers: int = 2,
+    device: torch.device = "cpu",
+) -> torch.nn.Module:
+    """
+    Build a model whose Transformer blocks are paged in from the
+    checkpoint when they run.
+
+    The embeddings, the final norm and the output layer stay in memory.
+    The streamer is available as `model.streamer`.
+
+    Parameters
+    ----------
+    model_cls: Type[torch.nn.Module]
+        The Transformer class.
+    args: TransformerArgs
+        Model parameters.
+    state: [str: torch.Tensor | LazyTensor]
+        The checkpoint state, preferably lazy.
+    dtype: torch.dtype
+        Precision type of the weights and activations.
+    resident_layers: int
+        Maximal number of blocks in memory.
+    device: torch.device
+        Device on which the model runs.
+
+    Returns
+    -------
+    model: torch.nn.Module
+        The model.
+    """
+    model = model_cls(args, dtype=dtype, device="meta")
+
+    # Tied weights share the same lazy tensor, read it once.
+    loaded = {}
+    for key, value in state.items():
+        if not key.startswith("layers.") and id(value) not in loaded:
+            loaded[id(value)] = _load(value, device)
+    assign_state(
+        model,
+        {
+            key: loaded[id(value)] for key, value in state.items()
+            if not key.startswith("layers.")
+        },
+        strict=False,
+    )
+    model.streamer = LayerStreamer(model, state, resident_layers, device)
+    return model
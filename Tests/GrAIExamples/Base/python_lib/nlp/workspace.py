@@ -0,0 +1,237 @@
+import torch
+from typing import Dict, List, Optional, Tuple
+
+
+class DecodeWorkspace:
+    """
+    Preallocated buffers for the decode step of a Transformer.
+
+    The buffers of the residual stream, norms, projections, attention and
+    feed forward are shared by all the Transformer blocks as they run one
+    after the other. The cache for keys and values is allocated once per
+    layer for `max_seq_len` tokens and filled in place.
+
+    Parameters
+    ----------
+    args: TransformerArgs
+        Model parameters.
+    batch_size: int
+        Number of sequences decoded together.
+    max_seq_len: int
+        Maximal number of tokens in the cache.
+    dtype: torch.dtype
+        Precision type of the activations.
+    device: torch.device
+        Device on which the buffers are allocated.
+    """
+
+    def __init__(
+        self,
+        args,
+        batch_size: int,
+        max_seq_len: int,
+        dtype: torch.dtype = torch.float32,
+        device: torch.device = "cpu",
+    ):
+        B = batch_size
+        q_dim = args.n_heads * args.head_dim
+        kv_dim = args.n_kv_heads * args.head_dim
+
+        self.batch_size = batch_size
+        self.max_seq_len = max_seq_len
+        self.length = 0
+
+        def empty(*shape, float32=False):
+            return torch.empty(
+                shape,
+                dtype=torch.float32 if float32 else dtype,
+                device=device,
+            )
+
+        # Residual stream, norms and block outputs.
+        self.h = empty(B, args.dim)
+        self.x = empty(B, args.dim)
+        self.out = empty(B, args.dim)
+        self.x_float = empty(B, args.dim, float32=True)
+        self.x_square = empty(B, args.dim, float32=True)
+        self.stats = empty(B, 1, float32=True)
+
+        # Projections.
+        self.qkv = empty(B, q_dim + 2 * kv_dim)
+        self.q = empty(B, q_dim)
+        self.k = empty(B, kv_dim)
+        self.v = empty(B, kv_dim)
+        self.q_rot = empty(B * args.n_heads, args.head_dim)
+        self.k_rot = empty(B * args.n_kv_heads, args.head_dim)
+
+        # Attention.
+        self.scores = empty(B * args.n_heads * max_seq_len)
+        self.probs = empty(B * args.n_heads * max_seq_len, float32=True)
+        self.probs_max = empty(B, args.n_heads, 1, 1, float32=True)
+        self.probs_sum = empty(B, args.n_heads, 1, 1, float32=True)
+        self.attn = empty(B, args.n_heads, 1, args.head_dim)
+
+        # Feed forward.
+        self.gate_up = empty(B, 2 * args.hidden_dim)
+        self.gate = empty(B, args.hidden_dim)
+        self.up = empty(B, args.hidden_dim)
+        self.scratch = empty(B, args.hidden_dim)
+
+        # The logits are returned in float32, like by `Transformer.forward`.
+        self.logits = empty(B, args.vocab_size, float32=True)
+        self.logits_mm = self.logits if dtype == torch.float32 else \
+            empty(B, args.vocab_size)
+
+        # RoPE.
+        slice_i = torch.arange(0, args.head_dim // 2, device=device)
+        self.theta = args.rope_theta ** (
+            -2.0 * (slice_i.float()) / args.head_dim
+        )
+        self.m_theta = empty(args.head_dim // 2, float32=True)
+        self.cos = empty(args.head_dim // 2, float32=True)
+        self.sin = empty(args.head_dim // 2, float32=True)
+        self.rotation = torch.zeros(
+            (1, args.head_dim, args.head_dim),
+            dtype=torch.float32,
+            device=device,
+        )
+
+        # Cache for keys and values.
+        self.keys: List[torch.Tensor] = [
+            empty(B, args.n_heads, max_seq_len, args.head_dim)
+            for _ in range(args.n_layers)
+        ]
+        self.values: List[torch.Tensor] = [
+            empty(B, args.n_heads, max_seq_len, args.head_dim)
+            for _ in range(args.n_layers)
+        ]
+
+    def load_cache(self, cache: List[Tuple[torch.Tensor, torch.Tensor]]):
+        """
+        Copy the cache computed by a regular forward (prefill) in the
+        preallocated buffers.
+
+        Parameters
+        ----------
+        cache: [(torch.Tensor, torch.Tensor)]
+            Cache for keys and values for each layer.
+        """
+        length = cache[0][0].shape[2]
+        assert length <= self.max_seq_len
+        for e, (keys, values) in enumerate(cache):
+            self.keys[e][:, :, :length].copy_(keys)
+            self.values[e][:, :, :length].copy_(values)
+        self.length = length
+
+    def set_position(self, position: int):
+        """
+        Fill the rotation matrix used for positional encoding in place.
+
+        Parameters
+        ----------
+        position: int
+            Position of the token to decode, starting at 1.
+        """
+        torch.mul(self.theta, position, out=self.m_theta)
+        torch.cos(self.m_theta, out=self.cos)
+        torch.sin(self.m_theta, out=self.sin)
+
+        # Walk the 2x2 blocks of the diagonal with strided views.
+        embedding_dim = self.rotation.shape[-1]
+        step = 2 * embedding_dim + 2
+        flat = self.rotation.view(-1)
+        flat[0::step].copy_(self.cos)
+        flat[1::step].copy_(self.sin).neg_()
+        flat[embedding_dim::step].copy_(self.sin)
+        flat[embedding_dim + 1::step].copy_(self.cos)
+
+
+def count_allocations(fn, *args, **kwargs) -> int:
+    """
+    Count the CPU memory allocations done while calling a function.
+
+    Parameters
+    ----------
+    fn: Callable
+        The function to profile.
+
+    Returns
+    -------
+    _: int
+        Number of allocations.
+    """
+    with torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU],
+        profile_memory=True,
+    ) as prof:
+        fn(*args, **kwargs)
+
+    return sum(
+        1 for event in prof.events()
+        if event.name == "[memory]" and event.cpu_memory_usage > 0
+    )
+
+
+def measure_decode_allocations(
+    model,
+    prompt: torch.Tensor,
+    n_tokens: int = 8,
+    max_seq_len: Optional[int] = None,
+) -> Dict[str, float]:
+    """
+    Report the number of allocations per generated token with the regular
+    forward and with the preallocated decode path.
+
+    Parameters
+    ----------
+    model: Transformer
+        The model to use for generation.
+    prompt: torch.Tensor
+        The input prompt.
+    n_tokens: int
+        Number of tokens to decode.
+    max_seq_len: int
+        Maximal number of tokens in the cache.
+
+    Returns
+    -------
+    _: Dict[str, float]
+        Allocations per token before ("forward") and after ("decode").
+    """
+    if max_seq_len is None:
+        max_seq_len = len(prompt) + n_tokens
+
+    with torch.no_grad():
+        logits, cache = model(prompt[None])
+        token = torch.argmax(logits[:, -1, :], dim=-1)
+
+        workspace = DecodeWorkspace(
+            model.args,
+            batch_size=1,
+            max_seq_len=max_seq_len,
+            dtype=model.norm.weight.dtype,
+            device=logits.device,
+        )
+        workspace.load_cache(cache)
+
+        n_forward = 0
+        y = token
+        for _ in range(n_tokens):
+            def step():
+                nonlocal cache, y
+                logits, cache = model(y[None], cache=cache)
+                y = torch.argmax(logits[:, -1, :], dim=-1)
+            n_forward += count_allocations(step)
+
+        n_decode = 0
+        y = token
+        for _ in range(n_tokens):
+            def step():
+                nonlocal y
+                y = torch.argmax(model.decode(y, workspace), dim=-1)
+            n_decode += count_allocations(step)
+
+    return {
+        "forward": n_forward / n_tokens,
+        "decode": n_decode / n_tokens,
+    }
@@ -0,0 +1,281 @@
+import json
+import torch
+import hashlib
+import numpy as np
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from python_lib.weight import LazyTensor, _checkpoint_fingerprint
+
+
+class StoredTensor(LazyTensor):
+    """
+    Tensor of a weight store, read only when it is loaded.
+
+    Parameters
+    ----------
+    store: WeightStore
+        The store containing the chunks of the tensor.
+    entry: Dict
+        Precision type, shape and chunks of the tensor.
+    """
+
+    def __init__(self, store: "WeightStore", entry: Dict):
+        self.store = store
+        self.entry = entry
+
+    def load(self) -> torch.Tensor:
+        """
+        Read the tensor from the store.
+
+        Returns
+        -------
+        _: torch.Tensor
+            The tensor.
+        """
+        return self.store.materialize(self.entry)
+
+
+class WeightStore:
+    """
+    Content-addressed store of model weights.
+
+    The tensors are cut in chunks identified by the hash of their content.
+    Each unique chunk is appended once to a pack file, so that the tensors
+    shared by several models (fine-tunes of a base model, tied weights)
+    are stored once. A tensor whose chunks are contiguous in the pack is
+    materialized as a view of the memory-mapped pack, shared by all the
+    models using it.
+
+    The store is not meant to be written by several processes at once.
+
+    Parameters
+    ----------
+    root: str
+        Directory of the store.
+    chunk_size: int
+        Number of bytes of the chunks.
+    alignment: int
+        Alignment in bytes of the chunks in the pack.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        chunk_size: int = 1 << 24,
+        alignment: int = 64,
+    ):
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+        self.alignment = alignment
+        (self.root / "models").mkdir(parents=True, exist_ok=True)
+
+        self.pack_path = self.root / "chunks.bin"
+        self.index_path = self.root / "index.json"
+        self.index: Dict[str, Tuple[int, int]] = {}
+        if self.index_path.exists():
+            with open(self.index_path, "r") as f:
+                self.index = {
+                    key: tuple(value) for key, value in json.load(f).items()
+                }
+        self._pack: Optional[np.memmap] = None
+
+    def _chunks(self, data: np.ndarray) -> List[Tuple[str, np.ndarray]]:
+        """
+        Cut the bytes of a tensor in hashed chunks.
+
+        Parameters
+        ----------
+        data: np.ndarray
+            The bytes of the tensor.
+
+        Returns
+        -------
+        _: [(str, np.ndarray)]
+            The hash and the bytes of each chunk.
+        """
+        chunks = []
+        for start in range(0, max(len(data), 1), self.chunk_size):
+            chunk = data[start:start + self.chunk_size]
+            chunks.append((hashlib.sha256(chunk).hexdigest(), chunk))
+        return chunks
+
+    def add(
+        self,
+        name: str,
+        state: Dict[str, Union[torch.Tensor, LazyTensor]],
+    ):
+        """
+        Add the tensors of a model to the store.
+
+        Parameters
+        ----------
+        name: str
+            Name of the model in the store.
+        state: [str: torch.Tensor | LazyTensor]
+            The module state, emptied along the way.
+        """
+        manifest = {}
+        with open(self.pack_path, "ab") as pack:
+            for key in list(state.keys()):
+                tensor = state.pop(key)
+                if isinstance(tensor, LazyTensor):
+                    tensor = tensor.load()
+                tensor = tensor.detach().cpu().contiguous()
+                data = tensor.view(-1).view(torch.uint8).numpy()
+
+                hashes = []
+                for chunk_hash, chunk in self._chunks(data):
+                    if chunk_hash not in self.index:
+                        offset = pack.tell()
+                        padding = -offset % self.alignment
+                        pack.write(b"\0" * padding)
+                        self.index[chunk_hash] = (offset + padding, len(chunk))
+                        pack.write(chunk.tobytes())
+                    hashes.append(chunk_hash)
+
+                manifest[key] = {
+                    "dtype": str(tensor.dtype).replace("torch.", ""),
+                    "shape": list(tensor.shape),
+                    "chunks": hashes,
+                }
+                del tensor, data
+
+        with open(self.index_path, "w") as f:
+            json.dump(self.index, f)
+        with open(self.root / "models" / f"{name}.json", "w") as f:
+            json.dump(manifest, f, indent=1)
+        self._pack = None
+
+    def has(self, name: str) -> bool:
+        """
+        Whether a model is in the store.
+
+        Parameters
+        ----------
+        name: str
+            Name of the model in the store.
+
+        Returns
+        -------
+        _: bool
+        """
+        return (self.root / "models" / f"{name}.json").exists()
+
+    def load(self, name: str) -> Dict[str, StoredTensor]:
+        """
+        Get the lazy tensors of a model.
+
+        Parameters
+        ----------
+        name: str
+            Name of the model in the store.
+
+        Returns
+        -------
+        _: Dict[str, StoredTensor]
+            Dictionary of lazy weights.
+        """
+        with open(self.root / "models" / f"{name}.json", "r") as f:
+            manifest = json.load(f)
+        return {
+            key: StoredTensor(self, entry) for key, entry in manifest.items()
+        }
+
+    def materialize(self, entry: Dict) -> torch.Tensor:
+        """
+        Build a tensor from its chunks, without copy when they are
+        contiguous in the pack.
+
+        Parameters
+        ----------
+        entry: Dict
+            Precision type, shape and chunks of the tensor.
+
+        Returns
+        -------
+        _: torch.Tensor
+            The tensor.
+        """
+        if self._pack is None:
+            # Copy on write: the pages are shared until a tensor is modified.
+            self._pack = np.memmap(self.pack_path, dtype=np.uint8, mode="c")
+
+        locations = [self.index[chunk_hash] for chunk_hash in entry["chunks"]]
+        start = locations[0][0]
+        nbytes = sum(size for _, size in locations)
+
+        contiguous = all(
+            offset == previous_offset + previous_size
+            for (previous_offset, previous_size), (offset, _) in zip(
+                locations[:-1], locations[1:]
+            )
+        )
+        if contiguous:
+            data = self._pack[start:start + nbytes]
+        else:
+            data = np.concatenate([
+                self._pack[offset:offset + size]
+                for offset, size in locations
+            ])
+
+        dtype = getattr(torch, entry["dtype"])
+        return torch.from_numpy(data).view(dtype).reshape(entry["shape"])
+
+    def size(self) -> Dict[str, int]:
+        """
+        Report the number of bytes stored and referenced by the models.
+
+        Returns
+        -------
+        _: Dict[str, int]
+            Bytes of the pack and bytes of all the models.
+        """
+        referenced = 0
+        for path in (self.root / "models").glob("*.json"):
+            with open(path, "r") as f:
+                manifest = json.load(f)
+            for entry in manifest.values():
+                referenced += sum(
+                    self.index[chunk_hash][1]
+                    for chunk_hash in entry["chunks"]
+                )
+        return {
+            "stored_bytes": self.pack_path.stat().st_size
+            if self.pack_path.exists() else 0,
+            "referenced_bytes": referenced,
+        }
+
+
+def load_stored_state(
+    model_path: str,
+    store_path: str,
+    load_state: Callable[[str], Dict[str, Union[torch.Tensor, LazyTensor]]],
+) -> Dict[str, StoredTensor]:
+    """
+    Get the state of a model from a weight store, adding it the first time
+    or when the checkpoint has changed.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    store_path: str
+        Directory of the store.
+    load_state: Callable
+        Function loading the state of the model from `model_path`,
+        like `load_mistral_state`.
+
+    Returns
+    -------
+    _: Dict[str, StoredTensor]
+        Dictionary of lazy weights.
+    """
+    store = WeightStore(store_path)
+    model_id = str(Path(model_path).resolve()) + \
+        _checkpoint_fingerprint(model_path)
+    name = Path(model_path).resolve().name + "-" + \
+        hashlib.sha256(model_id.encode()).hexdigest()[:16]
+    if not store.has(name):
+        store.add(name, load_state(model_path))
+    return store.load(name)
@@ -1,12 +1,173 @@
+import os
+import json
+import queue
 import torch
+import hashlib
+import pickle
+import struct
+import zipfile
+import threading
 import numpy as np
 from pathlib import Path
-from typing import List, Tuple, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Callable, Generator, List, Tuple, Dict, Optional, Union
+)
 
-from safetensors.torch import load_file
+from safetensors import safe_open
+from python_lib.nlp.quantize import quantize_weight
 from python_lib.model import SimpleAutoEncoder
 
 
+class LazyTensor:
+    """
+    Tensor of a safetensors file, read only when it is loaded.
+
+    The file is memory-mapped for the duration of the read, so that
+    the tensor does not stay in memory once the caller releases it.
+
+    Parameters
+    ----------
+    path: str
+        Path to the safetensors file.
+    key: str
+        Key of the tensor in the file.
+    """
+
+    def __init__(self, path: str, key: str):
+        self.path = path
+        self.key = key
+
+    def load(self) -> torch.Tensor:
+        """
+        Read the tensor from the disk.
+
+        Returns
+        -------
+        _: torch.Tensor
+            The tensor.
+        """
+        with safe_open(self.path, framework="pt", device="cpu") as f:
+            return f.get_tensor(self.key)
+
+
+def _index_shards(model_path: str) -> Dict[str, Path]:
+    """
+    Find the shard containing each key of a safetensors checkpoint.
+
+    The two formats are never merged, as their keys differ: the
+    "consolidated*.safetensors" files are used when present, otherwise
+    "model.safetensors.index.json" or, when missing, the header of every
+    "model*.safetensors" file.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+
+    Returns
+    -------
+    index: Dict[str, Path]
+        The shard of each key.
+    """
+    paths = sorted(Path(model_path).glob("consolidated*.safetensors"))
+    index_path = Path(model_path) / "model.safetensors.index.json"
+    if len(paths) == 0 and index_path.exists():
+        with open(index_path, "r") as f:
+            weight_map = json.load(f)["weight_map"]
+        return {
+            key: Path(model_path) / shard
+            for key, shard in weight_map.items()
+        }
+
+    if len(paths) == 0:
+        paths = sorted(Path(model_path).glob("model*.safetensors"))
+    if len(paths) == 0:
+        raise FileNotFoundError(f"No safetensors checkpoint in {model_path}.")
+
+    index = {}
+    for path in paths:
+        with safe_open(str(path), framework="pt", device="cpu") as f:
+            for key in f.keys():
+                index[key] = path
+    return index
+
+
+def load_sharded_state(
+    model_path: str,
+    keys: Optional[List[str]] = None,
+    strip_prefix: Optional[str] = None,
+    tied: Optional[Dict[str, str]] = None,
+    lazy: bool = False,
+    max_workers: int = 4,
+) -> Dict[str, Union[torch.Tensor, LazyTensor]]:
+    """
+    Load a safetensors checkpoint split in one or several shards.
+
+    The shards are read concurrently. Renamed and tied keys refer to the
+    loaded tensors without copying them.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    keys: [str]
+        Keys to load (after renaming), None to load every key.
+    strip_prefix: str
+        Prefix removed from the keys of the checkpoint.
+    tied: Dict[str, str]
+        Keys missing from the checkpoint that share the tensor of another
+        key, for instance {"output.weight": "embed_tokens.weight"}.
+    lazy: bool
+        Whether to return lazy tensors, read from the disk when extracted.
+    max_workers: int
+        Number of shards read at the same time.
+
+    Returns
+    -------
+    state: Dict[str, torch.Tensor | LazyTensor]
+        Dictionary of weights.
+    """
+    index = {}
+    for key, path in _index_shards(model_path).items():
+        new_key = key
+        if strip_prefix is not None and key.startswith(strip_prefix):
+            new_key = key[len(strip_prefix):]
+        index[new_key] = (path, key)
+
+    tied = {
+        new_key: key for new_key, key in (tied or {}).items()
+        if new_key not in index
+    }
+    if keys is None:
+        keys = list(index.keys()) + list(tied.keys())
+    sources = {tied.get(key, key) for key in keys}
+
+    if lazy:
+        tensors = {
+            key: LazyTensor(str(index[key][0]), index[key][1])
+            for key in sources
+        }
+
+    else:
+        shards: Dict[Path, List[str]] = {}
+        for key in sources:
+            shards.setdefault(index[key][0], []).append(key)
+
+        def load_shard(path: Path, shard_keys: List[str]):
+            with safe_open(str(path), framework="pt", device="cpu") as f:
+                return {key: f.get_tensor(index[key][1]) for key in shard_keys}
+
+        tensors = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for shard in executor.map(
+                lambda item: load_shard(*item), shards.items()
+            ):
+                tensors.update(shard)
+
+    return {key: tensors[tied.get(key, key)] for key in keys}
+
+
 def _flatten_weights(
     weights: np.ndarray
 ) -> Tuple[np.ndarray, List[int]]:
@@ -30,7 +191,8 @@ def _flatten_weights(
 
 
 def _extract_weights(
-    state: Dict[str, torch.Tensor]
+    state: Dict[str, torch.Tensor],
+    arena: bool = False,
 ) -> Tuple[List[np.ndarray], List[List[int]]]:
     """
     Get weights and biases.
@@ -39,12 +201,18 @@ def _extract_weights(
     ----------
     state: [str: torch.Tensor]
         The module state, containing the weights and biases.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     (_, _): List[np.ndarray], List[List[int]]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
+    if arena:
+        return _pack_weights(list(state.items()))
+
     layers_weights: List[np.ndarray] = []
     layers_dims: List[List[int]] = []
     for name, layer_weights in state.items():
@@ -60,8 +228,9 @@ def _extract_weights(
 
 
 def _extract_state(
-    state: Dict[str, torch.Tensor]
-) -> Dict[str, np.ndarray]:
+    state: Dict[str, torch.Tensor],
+    arena: bool = False,
+) -> Union[Dict[str, np.ndarray], Tuple[np.ndarray, np.ndarray]]:
     """
     Get weights and biases.
 
@@ -69,12 +238,19 @@ def _extract_state(
     ----------
     state: [str: torch.Tensor]
         The module state, containing the weights and biases.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     layer_weights: Dict[str, np.ndarray]
         Dictionary of flattened weights.
+        When `arena` is True: the arena and its offset and shape table,
+        in the order of `state`.
     """
+    if arena:
+        return _pack_weights(list(state.items()))
+
     layers_weights: Dict[str, np.ndarray] = {}
     for name, layer_weights in state.items():
         print(f"Extracting weights {name}.")
@@ -87,16 +263,19 @@ def _extract_state(
 
 def extract_state_key(
     key: str,
-    state: Dict[str, torch.Tensor]
+    state: Dict[str, Union[torch.Tensor, LazyTensor, np.ndarray]]
 ) -> np.ndarray:
     """
     Get weights and biases.
 
+    Lazy tensors are read from the disk and released once flattened.
+    Arrays from the weight cache are returned without copy.
+
     Parameters
     ----------
     key: str
         Key to extract.
-    state: [str: torch.Tensor]
+    state: [str: torch.Tensor | LazyTensor | np.ndarray]
         The module state, containing the weights and biases.
 
     Returns
@@ -105,17 +284,119 @@ def extract_state_key(
         Array of flattened weights.
     """
     print(f"Extracting weigths {key}.")
+    weights = state[key]
+    if isinstance(weights, np.ndarray):
+        # Views on the weight cache: bfloat16 values are stored as uint16.
+        if weights.dtype == np.uint16:
+            weights = (weights.astype(np.uint32) << 16).view(np.float32)
+        return weights.reshape(-1)
+
+    if isinstance(weights, LazyTensor):
+        weights = weights.load()
     weights_list, _ = _flatten_weights(
-        state[key].data.cpu().float().numpy()
+        weights.data.cpu().float().numpy()
     )
     return weights_list
 
 
-def _extract_and_transpose_weights(
+def iter_state(
+    keys: List[str],
+    state: Dict[str, Union[torch.Tensor, LazyTensor, np.ndarray]],
+    prefetch: int = 2,
+) -> Generator[Tuple[str, np.ndarray], None, None]:
+    """
+    Build an iterator on the flattened weights of a state.
+
+    The next `prefetch` keys are extracted on a background thread. Each
+    key is removed from the state when extracted, so that at most
+    `prefetch` extracted weights wait in memory.
+
+    Parameters
+    ----------
+    keys: [str]
+        Keys of the weights, in the order they are consumed.
+    state: [str: torch.Tensor | LazyTensor | np.ndarray]
+        The module state, emptied along the iteration.
+    prefetch: int
+        Number of weights extracted in advance.
+
+    Returns
+    -------
+    An iterator on (key, flattened weights).
+    """
+    buffer = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def worker():
+        try:
+            for key in keys:
+                if stop.is_set():
+                    return
+                weights = state.pop(key)
+                if isinstance(weights, np.ndarray):
+                    weights_list = extract_state_key(key, {key: weights})
+                else:
+                    if isinstance(weights, LazyTensor):
+                        weights = weights.load()
+                    weights_list, _ = _flatten_weights(
+                        weights.data.cpu().float().numpy()
+                    )
+                del weights
+                put((key, weights_list))
+            put(None)
+        except Exception as error:
+            put(error)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            del item
+    finally:
+        stop.set()
+
+
+def next_state_key(iterator) -> Tuple[str, np.ndarray]:
+    """
+    Get the next flattened weights from a state iterator.
+
+    Parameters
+    ----------
+    iterator
+        The iterator built by `iter_state`.
+
+    Returns
+    -------
+    str
+        The key of the weights, empty at the end of the iteration.
+    np.ndarray
+        The flattened weights.
+    """
+    try:
+        return next(iterator)
+    except StopIteration:
+        return "", np.zeros(0, dtype=np.float32)
+
+
+def _collect_and_transpose_weights(
     modules: [torch.nn.Module]
-) -> Tuple[List[np.ndarray], List[List[int]]]:
+) -> List[Tuple[str, torch.Tensor]]:
     """
-    Get weights and biases.
+    Get weights and biases, module after module.
     Transpose weights when they come from a
     ConvTranspose2d layer.
 
@@ -126,124 +407,712 @@ def _extract_and_transpose_weights(
 
     Returns
     -------
-    (_, _): List[np.ndarray], List[List[int]]
-        The flattened weights, their shape.
+    _: [(str, torch.Tensor)]
+        The named weights and biases.
     """
-    layers_weights: List[np.ndarray] = []
-    layers_dims: List[List[int]] = []
+    named_weights: List[Tuple[str, torch.Tensor]] = []
     for module in modules:
         submodules = list(module.children())
         if len(submodules) > 0:
-            (weights_list, dims_list) = _extract_and_transpose_weights(
-                submodules
-            )
-            layers_weights += weights_list
-            layers_dims += dims_list
+            named_weights += _collect_and_transpose_weights(submodules)
 
         else:
+            name = module.__class__.__name__
             if hasattr(module, "weight"):
+                weights = module.weight.detach()
                 if isinstance(module, torch.nn.ConvTranspose2d):
-                    weights = np.transpose(
-                        module.weight.detach().numpy(), (1, 0, 2, 3)
-                    )
-                    weights_list, dims_list = _flatten_weights(weights)
+                    weights = weights.permute(1, 0, 2, 3)
+                named_weights.append((f"{name}.weight", weights))
 
-                else:
-                    weights = module.weight.detach().numpy()
-                    weights_list, dims_list = _flatten_weights(weights)
+            if hasattr(module, "bias"):
+                named_weights.append((f"{name}.bias", module.bias.detach()))
 
-                layers_weights.append(weights_list)
-                layers_dims.append(dims_list)
+    return named_weights
 
-            if hasattr(module, "bias"):
-                weights = module.bias.detach().numpy()
-                weights_list, dims_list = _flatten_weights(weights)
 
-                layers_weights.append(weights_list)
-                layers_dims.append(dims_list)
+def _extract_and_transpose_weights(
+    modules: [torch.nn.Module],
+    arena: bool = False,
+) -> Tuple[List[np.ndarray], List[List[int]]]:
+    """
+    Get weights and biases.
+    Transpose weights when they come from a
+    ConvTranspose2d layer.
+
+    Parameters
+    ----------
+    modules: [torch.nn.Module]
+        The list of modules to get the weights and biases from.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
+
+    Returns
+    -------
+    (_, _): List[np.ndarray], List[List[int]]
+        The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
+    """
+    named_weights = _collect_and_transpose_weights(modules)
+    if arena:
+        return _pack_weights(named_weights)
+
+    layers_weights: List[np.ndarray] = []
+    layers_dims: List[List[int]] = []
+    for _, weights in named_weights:
+        weights_list, dims_list = _flatten_weights(weights.numpy())
+
+        layers_weights.append(weights_list)
+        layers_dims.append(dims_list)
 
     return layers_weights, layers_dims
 
 
+# Kept identical to the copy in the python_lib of GrAITorchTests, which is
+# installed as a separate package.
+def _pack_weights(
+    named_weights: List[Tuple[str, torch.Tensor]],
+    max_workers: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pack weights and biases in one contiguous float32 arena.
+
+    The tensors are converted and copied concurrently, each one in its
+    own slice of the arena.
+
+    Parameters
+    ----------
+    named_weights: [(str, torch.Tensor)]
+        The weights and biases, in order.
+    max_workers: int
+        Number of threads copying the tensors.
+
+    Returns
+    -------
+    (arena, table): np.ndarray, np.ndarray
+        arena: the flattened weights, one after the other
+        table: for each tensor, its offset in the arena, its size, its
+        rank and its shape padded with 0 up to the maximal rank
+    """
+    shapes = [list(weights.shape) for _, weights in named_weights]
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    offsets = np.cumsum([0] + sizes)
+    max_rank = max([len(shape) for shape in shapes], default=0)
+
+    table = np.zeros((len(shapes), 3 + max_rank), dtype=np.int64)
+    for i, shape in enumerate(shapes):
+        table[i, :3] = [offsets[i], sizes[i], len(shape)]
+        table[i, 3:3 + len(shape)] = shape
+
+    arena = np.empty(offsets[-1], dtype=np.float32)
+    arena_tensor = torch.from_numpy(arena)
+
+    def copy(i: int):
+        weights = named_weights[i][1].detach()
+        arena_tensor[offsets[i]:offsets[i + 1]].view(weights.shape).copy_(
+            weights
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(copy, range(len(named_weights))))
+    return arena, table
+
+
 def load_simple_auto_encoder_weights(
-) -> Tuple[List[np.ndarray], List[List[int]]]:
+    arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for simple auto encoder model.
 
+    Parameters
+    ----------
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
+
     Returns
     -------
     (_, _): List[np.ndarray], List[List[int]]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = SimpleAutoEncoder()
-    return _extract_and_transpose_weights(list(model.children()))
+    return _extract_and_transpose_weights(
+        list(model.children()), arena=arena
+    )
 
 
 def load_gemma_state(
-    model_path: str
-) -> Dict[str, torch.Tensor]:
+    model_path: str,
+    lazy: bool = True,
+) -> Dict[str, Union[torch.Tensor, LazyTensor]]:
     """
     Get weights and biases for Gemma-2-2b-it LLM.
 
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    lazy: bool
+        Whether to return lazy tensors, read from the disk when extracted.
+
     Returns
     -------
-    _: Dict[str, np.ndarray]
+    _: Dict[str, torch.Tensor | LazyTensor]
         Dictionary of weights.
     """
-    state1 = load_file(
-        str(Path(model_path) / "model-00001-of-00002.safetensors"),
-        "cpu"
+    return load_sharded_state(
+        model_path,
+        strip_prefix="model.",
+        tied={"output.weight": "embed_tokens.weight"},
+        lazy=lazy,
     )
-    state2 = load_file(
-        str(Path(model_path) / "model-00002-of-00002.safetensors"),
-        "cpu"
+
+
+def load_mistral_state(
+    model_path: str,
+    lazy: bool = True,
+) -> Dict[str, Union[torch.Tensor, LazyTensor]]:
+    """
+    Get weights and biases for Mistral-7B-Instruct-v0.3 LLM.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    lazy: bool
+        Whether to return lazy tensors, read from the disk when extracted.
+
+    Returns
+    -------
+    _: Dict[str, torch.Tensor | LazyTensor]
+        Dictionary of weights.
+    """
+    return load_sharded_state(model_path, lazy=lazy)
+
+
+_SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
+
+class _TensorRecord:
+    """
+    Location of a tensor in a PyTorch zip checkpoint.
+
+    Parameters
+    ----------
+    storage: (str, torch.dtype)
+        Key of the storage in the archive and its precision type.
+    offset: int
+        Offset of the tensor in the storage, in elements.
+    shape: [int]
+        Shape of the tensor.
+    stride: [int]
+        Stride of the tensor.
+    """
+
+    def __init__(self, storage, offset, shape, stride, *args):
+        self.key, self.dtype = storage
+        self.offset = offset
+        self.shape = list(shape)
+        self.stride = list(stride)
+
+    @property
+    def element_size(self) -> int:
+        return torch.empty((), dtype=self.dtype).element_size()
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * self.element_size
+
+    @property
+    def is_contiguous(self) -> bool:
+        expected_stride = 1
+        for dim, stride in zip(self.shape[::-1], self.stride[::-1]):
+            if dim > 1 and stride != expected_stride:
+                return False
+            expected_stride *= dim
+        return True
+
+
+class _PthUnpickler(pickle.Unpickler):
+    """
+    Unpickle the state of a PyTorch zip checkpoint into tensor records,
+    without reading the storages.
+    """
+
+    def find_class(self, module, name):
+        if module == "torch._utils" and name == "_rebuild_tensor_v2":
+            return _TensorRecord
+        return super().find_class(module, name)
+
+    def persistent_load(self, pid):
+        _, storage_type, key, _, _ = pid
+        return key, storage_type.dtype
+
+
+def convert_pth_to_safetensors(
+    pth_path: str,
+    drop_keys: Optional[List[str]] = None,
+    chunk_size: int = 1 << 24,
+) -> Path:
+    """
+    Convert a PyTorch checkpoint into a safetensors file next to it.
+
+    The tensors are streamed from the zip archive to the new file so that
+    the whole state is never held in memory. The conversion is done once:
+    the size and modification time of the checkpoint are stored in the
+    metadata of the file and checked on the next calls.
+
+    Parameters
+    ----------
+    pth_path: str
+        Path to the PyTorch checkpoint.
+    drop_keys: [str]
+        Keys not to convert.
+    chunk_size: int
+        Number of bytes copied at a time.
+
+    Returns
+    -------
+    path: Path
+        Path to the safetensors file.
+    """
+    pth_path = Path(pth_path)
+    path = pth_path.with_suffix(".safetensors")
+    stat = pth_path.stat()
+    metadata = {
+        "format": "pt",
+        "source_size": str(stat.st_size),
+        "source_mtime": str(stat.st_mtime_ns),
+    }
+
+    if path.exists():
+        with safe_open(str(path), framework="pt", device="cpu") as f:
+            if f.metadata() == metadata:
+                return path
+
+    with zipfile.ZipFile(pth_path) as archive:
+        pkl_name = next(
+            name for name in archive.namelist()
+            if name.endswith("data.pkl")
+        )
+        prefix = pkl_name[:-len("data.pkl")]
+        with archive.open(pkl_name) as f:
+            records = _PthUnpickler(f).load()
+        for key in drop_keys or []:
+            records.pop(key, None)
+
+        header = {"__metadata__": metadata}
+        offset = 0
+        for key, record in records.items():
+            header[key] = {
+                "dtype": _SAFETENSORS_DTYPES[record.dtype],
+                "shape": record.shape,
+                "data_offsets": [offset, offset + record.nbytes],
+            }
+            offset += record.nbytes
+
+        header = json.dumps(header, separators=(",", ":")).encode()
+        header += b" " * (-len(header) % 8)
+
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as out:
+            out.write(struct.pack("<Q", len(header)))
+            out.write(header)
+
+            for record in records.values():
+                name = prefix + "data/" + record.key
+                with archive.open(name) as storage:
+                    if record.is_contiguous:
+                        storage.seek(record.offset * record.element_size)
+                        remaining = record.nbytes
+                        while remaining > 0:
+                            chunk = storage.read(min(chunk_size, remaining))
+                            if len(chunk) == 0:
+                                raise ValueError(
+                                    f"Truncated storage {name} in "
+                                    f"{pth_path}: {remaining} bytes missing."
+                                )
+                            out.write(chunk)
+                            remaining -= len(chunk)
+
+                    else:
+                        data = storage.read()
+                        end = record.offset + sum(
+                            (size - 1) * stride for size, stride
+                            in zip(record.shape, record.stride)
+                        ) + 1
+                        if len(data) < end * record.element_size:
+                            raise ValueError(
+                                f"Truncated storage {name} in {pth_path}."
+                            )
+                        tensor = torch.frombuffer(
+                            bytearray(data), dtype=record.dtype
+                        ).as_strided(
+                            record.shape, record.stride, record.offset
+                        )
+                        out.write(
+                            tensor.contiguous().view(torch.uint8)
+                            .numpy().tobytes()
+                        )
+
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_llama_state(
+    model_path: str,
+    lazy: bool = True,
+) -> Dict[str, Union[torch.Tensor, LazyTensor]]:
+    """
+    Get state for Llama-2-7B-Chat or Llama-3-8B-Instruct.
+
+    The checkpoint is converted into safetensors the first time.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    lazy: bool
+        Whether to return lazy tensors, read from the disk when extracted.
+
+    Returns
+    -------
+    _: Dict[str, torch.Tensor | LazyTensor]
+        Dictionary of weights.
+    """
+    convert_pth_to_safetensors(
+        str(Path(model_path) / "consolidated.00.pth"),
+        drop_keys=["rope.freqs"],
     )
+    return load_sharded_state(model_path, lazy=lazy)
 
-    state = state1
-    state.update(state2)
-    state["model.output.weight"] = state["model.embed_tokens.weight"]
 
-    state_copy = {}
-    for key, value in state.items():
-        new_key = key.replace("model.", "")
-        state_copy[new_key] = value
-    state = state_copy
+def _checkpoint_fingerprint(model_path: str) -> str:
+    """
+    Hash the name, the size and the modification time of the checkpoint
+    files, like `convert_pth_to_safetensors` does, without reading them.
 
-    return state
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
 
+    Returns
+    -------
+    _: str
+        The fingerprint of the checkpoint.
+    """
+    paths = sorted(Path(model_path).glob("*.pth"))
+    if len(paths) == 0:
+        paths = sorted(set(_index_shards(model_path).values()))
 
-def load_mistral_state(
+    fingerprint = hashlib.sha256()
+    for path in paths:
+        stat = path.stat()
+        fingerprint.update(
+            f"{path.name}:{stat.st_size}:{stat.st_mtime_ns};".encode()
+        )
+    return fingerprint.hexdigest()
+
+
+def _read_manifest(
+    manifest_path: Path,
+    model_path: str,
+    keys: List[str],
+) -> Optional[Dict]:
+    """
+    Read the manifest of an exported cache if it is still valid.
+
+    Parameters
+    ----------
+    manifest_path: Path
+        Path to the manifest.
     model_path: str
-) -> Dict[str, torch.Tensor]:
+        Path to the model on the disk.
+    keys: [str]
+        Keys of the weights, in the order they are consumed.
+
+    Returns
+    -------
+    manifest: Dict
+        The manifest, None when missing or out of date.
     """
-    Get weights and biases for Mistral-7B-Instruct-v0.3 LLM.
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if manifest["checkpoint"] != _checkpoint_fingerprint(model_path) or \
+       [tensor["key"] for tensor in manifest["tensors"]] != list(keys):
+        return None
+    return manifest
+
+
+def export_weight_cache(
+    model_path: str,
+    keys: List[str],
+    load_state: Callable[[str], Dict[str, Union[torch.Tensor, LazyTensor]]],
+    dtype: str = "float32",
+) -> Path:
+    """
+    Write the weights of a model in one contiguous little-endian file,
+    in the order they are consumed, along with a JSON manifest.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    keys: [str]
+        Keys of the weights, in the order they are consumed.
+    load_state: Callable
+        Function loading the state of the model from `model_path`.
+    dtype: str
+        Precision of the cache: "float32" or "bfloat16".
+
+    Returns
+    -------
+    manifest_path: Path
+        Path to the manifest.
+    """
+    assert dtype in ["float32", "bfloat16"]
+    data_path = Path(model_path) / f"weights-{dtype}.bin"
+    manifest_path = Path(model_path) / f"weights-{dtype}.json"
+
+    state = load_state(model_path)
+    tensors = []
+    offset = 0
+    with open(data_path.with_suffix(".tmp"), "wb") as f:
+        for key in keys:
+            weights = state.pop(key)
+            if isinstance(weights, LazyTensor):
+                weights = weights.load()
+            weights = weights.detach().cpu().contiguous()
+            if dtype == "float32":
+                data = weights.float().numpy().astype("<f4")
+            else:
+                data = weights.to(torch.bfloat16).view(torch.int16)
+                data = data.numpy().view("<u2")
+            f.write(data.tobytes())
+
+            tensors.append({
+                "key": key,
+                "offset": offset,
+                "shape": list(weights.shape),
+            })
+            offset += data.nbytes
+    os.replace(data_path.with_suffix(".tmp"), data_path)
+
+    manifest = {
+        "checkpoint": _checkpoint_fingerprint(model_path),
+        "dtype": dtype,
+        "tensors": tensors,
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    return manifest_path
+
+
+def load_weight_cache(
+    model_path: str,
+    keys: List[str],
+    load_state: Callable[[str], Dict[str, Union[torch.Tensor, LazyTensor]]],
+    dtype: str = "float32",
+) -> Dict[str, np.ndarray]:
+    """
+    Get flat views of the weights in the weight cache, exporting it the
+    first time or when the checkpoint has changed.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    keys: [str]
+        Keys of the weights, in the order they are consumed.
+    load_state: Callable
+        Function loading the state of the model from `model_path`.
+    dtype: str
+        Precision of the cache: "float32" or "bfloat16".
 
     Returns
     -------
     _: Dict[str, np.ndarray]
-        Dictionary of weights.
+        Dictionary of memory-mapped flattened weights.
     """
-    state = load_file(
-        str(Path(model_path) / "consolidated.safetensors"),
-        "cpu"
+    manifest_path = Path(model_path) / f"weights-{dtype}.json"
+    manifest = _read_manifest(manifest_path, model_path, keys)
+    if manifest is None:
+        export_weight_cache(model_path, keys, load_state, dtype)
+        manifest = _read_manifest(manifest_path, model_path, keys)
+
+    data = np.memmap(
+        Path(model_path) / f"weights-{dtype}.bin",
+        dtype="<f4" if dtype == "float32" else "<u2",
+        mode="r",
     )
+    itemsize = data.dtype.itemsize
+
+    state = {}
+    for tensor in manifest["tensors"]:
+        start = tensor["offset"] // itemsize
+        end = start + int(np.prod(tensor["shape"]))
+        state[tensor["key"]] = data[start:end]
     return state
 
 
-def load_llama_state(
+def export_quantized_weights(
+    model_path: str,
+    keys: List[str],
+    load_state: Callable[[str], Dict[str, Union[torch.Tensor, LazyTensor]]],
+    bits: int = 8,
+    alignment: int = 16,
+) -> Path:
+    """
+    Write the weights of a model quantized per row in one file, in the
+    order they are consumed, along with a JSON manifest.
+
+    The matrices are quantized on `bits` unsigned bits with a scale and
+    a zero point per row, the other tensors are kept in float32. See
+    Docs/Examples/LLM.md for the format.
+
+    Parameters
+    ----------
     model_path: str
-) -> Dict[str, torch.Tensor]:
+        Path to the model on the disk.
+    keys: [str]
+        Keys of the weights, in the order they are consumed.
+    load_state: Callable
+        Function loading the state of the model from `model_path`.
+    bits: int
+        Number of bits per value: 8 or 4.
+    alignment: int
+        Alignment in bytes of every array in the file.
+
+    Returns
+    -------
+    manifest_path: Path
+        Path to the manifest.
     """
-    Get state for Llama-2-7B-Chat or Llama-3-8B-Instruct.
+    assert bits in [4, 8]
+    data_path = Path(model_path) / f"weights-int{bits}.bin"
+    manifest_path = Path(model_path) / f"weights-int{bits}.json"
+
+    state = load_state(model_path)
+    tensors = []
+    offset = 0
+    with open(data_path.with_suffix(".tmp"), "wb") as f:
+        def write(data: np.ndarray) -> int:
+            nonlocal offset
+            start = offset
+            padding = -data.nbytes % alignment
+            f.write(data.tobytes() + b"\0" * padding)
+            offset += data.nbytes + padding
+            return start
+
+        for key in keys:
+            weights = state.pop(key)
+            if isinstance(weights, LazyTensor):
+                weights = weights.load()
+            weights = weights.detach().cpu()
+
+            tensor = {"key": key, "shape": list(weights.shape)}
+            if weights.dim() == 2 and weights.shape[1] % 2 == 0:
+                qweight, scales, zeros = quantize_weight(
+                    weights, bits, symmetric=False
+                )
+                tensor["format"] = f"int{bits}"
+                tensor["offset"] = write(qweight.numpy())
+                tensor["scales_offset"] = write(
+                    scales.flatten().numpy().astype("<f4")
+                )
+                tensor["zeros_offset"] = write(
+                    zeros.flatten().numpy().astype(np.uint8)
+                )
+            else:
+                tensor["format"] = "float32"
+                tensor["offset"] = write(
+                    weights.float().flatten().numpy().astype("<f4")
+                )
+            tensors.append(tensor)
+    os.replace(data_path.with_suffix(".tmp"), data_path)
+
+    manifest = {
+        "checkpoint": _checkpoint_fingerprint(model_path),
+        "bits": bits,
+        "tensors": tensors,
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    return manifest_path
+
+
+def load_quantized_weights(
+    model_path: str,
+    keys: List[str],
+    load_state: Callable[[str], Dict[str, Union[torch.Tensor, LazyTensor]]],
+    bits: int = 8,
+) -> Dict[str, Dict[str, np.ndarray]]:
+    """
+    Get views of the quantized weights, exporting them the first time or
+    when the checkpoint has changed.
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the model on the disk.
+    keys: [str]
+        Keys of the weights, in the order they are consumed.
+    load_state: Callable
+        Function loading the state of the model from `model_path`.
+    bits: int
+        Number of bits per value: 8 or 4.
 
     Returns
     -------
-    _: Dict[str, np.ndarray]
-        Dictionary of weights.
+    _: Dict[str, Dict[str, np.ndarray]]
+        For each key, the memory-mapped "qweight", "scales" and "zeros"
+        of a quantized matrix or the flattened float32 "weights".
     """
-    state = torch.load(
-        str(Path(model_path) / "consolidated.00.pth"),
-        "cpu"
+    manifest_path = Path(model_path) / f"weights-int{bits}.json"
+    manifest = _read_manifest(manifest_path, model_path, keys)
+    if manifest is None:
+        export_quantized_weights(model_path, keys, load_state, bits)
+        manifest = _read_manifest(manifest_path, model_path, keys)
+
+    data = np.memmap(
+        Path(model_path) / f"weights-int{bits}.bin", dtype=np.uint8, mode="r"
     )
+
+    def view(offset: int, count: int, dtype: str) -> np.ndarray:
+        size = count * np.dtype(dtype).itemsize
+        return data[offset:offset + size].view(dtype)
+
+    state = {}
+    for tensor in manifest["tensors"]:
+        shape = tensor["shape"]
+        if tensor["format"] == "float32":
+            state[tensor["key"]] = {
+                "weights": view(tensor["offset"], int(np.prod(shape)), "<f4")
+            }
+        else:
+            rows, cols = shape
+            packed_cols = cols if bits == 8 else cols // 2
+            state[tensor["key"]] = {
+                "qweight": view(
+                    tensor["offset"], rows * packed_cols, "u1"
+                ).reshape(rows, packed_cols),
+                "scales": view(tensor["scales_offset"], rows, "<f4"),
+                "zeros": view(tensor["zeros_offset"], rows, "u1"),
+            }
     return state
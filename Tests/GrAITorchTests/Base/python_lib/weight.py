@@ -1,6 +1,7 @@
 import torch
 import numpy as np
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Union
 
 from python_lib.model import (
     ModelTestConv1,
@@ -40,8 +41,28 @@ def _flatten_weights(
     return weights_list, dims_list
 
 
-def _extract_weights(
+def _collect_weights(
+    model: torch.nn.Module
+) -> List[Tuple[str, torch.Tensor]]:
+    """
+    Get weights and biases in the order of the state dict.
+
+    Parameters
+    ----------
     model: torch.nn.Module
+        The module to get the weights and biases from.
+
+    Returns
+    -------
+    _: [(str, torch.Tensor)]
+        The named weights and biases.
+    """
+    return list(model.state_dict().items())
+
+
+def _extract_weights(
+    model: torch.nn.Module,
+    arena: bool = False,
 ) -> Tuple[List[np.ndarray], List[List[int]]]:
     """
     Get weights and biases.
@@ -50,17 +71,22 @@ def _extract_weights(
     ----------
     model: torch.nn.Module
         The module to get the weights and biases from.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     (_, _): List[np.ndarray], List[List[int]]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
-    model_weights = model.state_dict()
+    named_weights = _collect_weights(model)
+    if arena:
+        return _pack_weights(named_weights)
 
     layers_weights: List[np.ndarray] = []
     layers_dims: List[List[int]] = []
-    for name, layer_weights in model_weights.items():
+    for name, layer_weights in named_weights:
         print(f"Extracting weigths {name}.")
         weights_list, dims_list = _flatten_weights(
             layer_weights.data.cpu().numpy()
@@ -72,11 +98,11 @@ def _extract_weights(
     return layers_weights, layers_dims
 
 
-def _extract_and_transpose_weights(
+def _collect_and_transpose_weights(
     modules: [torch.nn.Module]
-) -> Tuple[List[np.ndarray], List[List[int]]]:
+) -> List[Tuple[str, torch.Tensor]]:
     """
-    Get weights and biases.
+    Get weights and biases, module after module.
     Transpose weights when they come from a
     ConvTranspose2d layer.
 
@@ -87,47 +113,116 @@ def _extract_and_transpose_weights(
 
     Returns
     -------
-    (_, _): List[np.ndarray], List[List[int]]
-        The flattened weights, their shape.
+    _: [(str, torch.Tensor)]
+        The named weights and biases.
     """
-    layers_weights: List[np.ndarray] = []
-    layers_dims: List[List[int]] = []
+    named_weights: List[Tuple[str, torch.Tensor]] = []
     for module in modules:
         submodules = list(module.children())
         if len(submodules) > 0:
-            (weights_list, dims_list) = _extract_and_transpose_weights(
-                submodules
-            )
-            layers_weights += weights_list
-            layers_dims += dims_list
+            named_weights += _collect_and_transpose_weights(submodules)
 
         else:
+            name = module.__class__.__name__
             if hasattr(module, "weight"):
+                weights = module.weight.detach()
                 if isinstance(module, torch.nn.ConvTranspose2d):
-                    weights = np.transpose(
-                        module.weight.detach().numpy(), (1, 0, 2, 3)
-                    )
-                    weights_list, dims_list = _flatten_weights(weights)
+                    weights = weights.permute(1, 0, 2, 3)
+                named_weights.append((f"{name}.weight", weights))
 
-                else:
-                    weights = module.weight.detach().numpy()
-                    weights_list, dims_list = _flatten_weights(weights)
+            if hasattr(module, "bias"):
+                named_weights.append((f"{name}.bias", module.bias.detach()))
 
-                layers_weights.append(weights_list)
-                layers_dims.append(dims_list)
+    return named_weights
 
-            if hasattr(module, "bias"):
-                weights = module.bias.detach().numpy()
-                weights_list, dims_list = _flatten_weights(weights)
 
-                layers_weights.append(weights_list)
-                layers_dims.append(dims_list)
+def _extract_and_transpose_weights(
+    modules: [torch.nn.Module],
+    arena: bool = False,
+) -> Tuple[List[np.ndarray], List[List[int]]]:
+    """
+    Get weights and biases.
+    Transpose weights when they come from a
+    ConvTranspose2d layer.
+
+    Parameters
+    ----------
+    modules: [torch.nn.Module]
+        The list of modules to get the weights and biases from.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
+
+    Returns
+    -------
+    (_, _): List[np.ndarray], List[List[int]]
+        The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
+    """
+    named_weights = _collect_and_transpose_weights(modules)
+    if arena:
+        return _pack_weights(named_weights)
+
+    layers_weights: List[np.ndarray] = []
+    layers_dims: List[List[int]] = []
+    for _, weights in named_weights:
+        weights_list, dims_list = _flatten_weights(weights.numpy())
+
+        layers_weights.append(weights_list)
+        layers_dims.append(dims_list)
 
     return layers_weights, layers_dims
 
 
+def _collect_vit_weights(
+    model: torch.nn.Module,
+) -> List[Tuple[str, torch.Tensor]]:
+    """
+    Get weights and biases in the order of the state dict.
+    Split the projections of the queries, keys and values of the
+    attention layers, interleaving their weights and biases.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+        The module to get the weights and biases from.
+
+    Returns
+    -------
+    _: [(str, torch.Tensor)]
+        The named weights and biases.
+    """
+    named_weights: List[Tuple[str, torch.Tensor]] = []
+
+    cur_item = 0
+    list_items = list(model.state_dict().items())
+
+    while cur_item < len(list_items):
+        name, layer_weights = list_items[cur_item]
+
+        if "in_proj" in name:
+            bias_name, biases = list_items[cur_item + 1]
+            nb_partial = int(len(layer_weights) / 3)
+
+            for i in range(3):
+                start, end = i * nb_partial, (i + 1) * nb_partial
+                named_weights.append(
+                    (f"{name}[{i}]", layer_weights[start: end])
+                )
+                named_weights.append(
+                    (f"{bias_name}[{i}]", biases[start: end])
+                )
+            cur_item += 2
+
+        else:
+            named_weights.append((name, layer_weights))
+            cur_item += 1
+
+    return named_weights
+
+
 def _extract_vit_weights(
     model: torch.nn.Module,
+    arena: bool = False,
 ) -> Tuple[List[np.ndarray], List[List[int]]]:
     """
     Get weights and biases.
@@ -136,120 +231,136 @@ def _extract_vit_weights(
     ----------
     model: torch.nn.Module
         The module to get the weights and biases from.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     (_, _): List[np.ndarray], List[List[int]]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
-    model_weights = model.state_dict()
+    named_weights = _collect_vit_weights(model)
+    if arena:
+        return _pack_weights(named_weights)
 
     layers_weights: List[np.ndarray] = []
     layers_dims: List[List[int]] = []
-
-    cur_item = 0
-    list_items = list(model_weights.items())
-
-    while cur_item < len(list_items):
-        name, layer_weights = list_items[cur_item]
+    for name, layer_weights in named_weights:
         print(f"Extracting weigths {name}.")
+        weights_list, dims_list = _flatten_weights(
+            layer_weights.data.cpu().numpy()
+        )
 
-        if "in_proj" in name:
-            weights = layer_weights.data.cpu().numpy()
-            nb_partial = int(len(weights) / 3)
+        layers_weights.append(weights_list)
+        layers_dims.append(dims_list)
 
-            weights1 = weights[0: nb_partial]
-            weights2 = weights[nb_partial: 2*nb_partial]
-            weights3 = weights[2*nb_partial: 3*nb_partial]
+    return layers_weights, layers_dims
 
-            cur_item += 1
-            name, layer_weights = list_items[cur_item]
-            print(f"Extracting weigths {name}.")
-            biases = layer_weights.data.cpu().numpy()
-
-            biases1 = biases[0: nb_partial]
-            biases2 = biases[nb_partial: 2 * nb_partial]
-            biases3 = biases[2 * nb_partial: 3 * nb_partial]
-
-            weights_list, dims_list = _flatten_weights(
-                weights=weights1
-            )
-            layers_weights.append(weights_list)
-            layers_dims.append(dims_list)
-            weights_list, dims_list = _flatten_weights(
-                weights=biases1
-            )
-            layers_weights.append(weights_list)
-            layers_dims.append(dims_list)
-
-            weights_list, dims_list = _flatten_weights(
-                weights=weights2
-            )
-            layers_weights.append(weights_list)
-            layers_dims.append(dims_list)
-            weights_list, dims_list = _flatten_weights(
-                weights=biases2
-            )
-            layers_weights.append(weights_list)
-            layers_dims.append(dims_list)
-
-            weights_list, dims_list = _flatten_weights(
-                weights=weights3
-            )
-            layers_weights.append(weights_list)
-            layers_dims.append(dims_list)
-            weights_list, dims_list = _flatten_weights(
-                weights=biases3
-            )
-            layers_weights.append(weights_list)
-            layers_dims.append(dims_list)
 
-            cur_item += 1
+# Kept identical to the copy in the python_lib of GrAIExamples, which is
+# installed as a separate package.
+def _pack_weights(
+    named_weights: List[Tuple[str, torch.Tensor]],
+    max_workers: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pack weights and biases in one contiguous float32 arena.
 
-        else:
-            weights_list, dims_list = _flatten_weights(
-                layer_weights.data.cpu().numpy()
-            )
+    The tensors are converted and copied concurrently, each one in its
+    own slice of the arena.
 
-            layers_weights.append(weights_list)
-            layers_dims.append(dims_list)
+    Parameters
+    ----------
+    named_weights: [(str, torch.Tensor)]
+        The weights and biases, in order.
+    max_workers: int
+        Number of threads copying the tensors.
 
-            cur_item += 1
+    Returns
+    -------
+    (arena, table): np.ndarray, np.ndarray
+        arena: the flattened weights, one after the other
+        table: for each tensor, its offset in the arena, its size, its
+        rank and its shape padded with 0 up to the maximal rank
+    """
+    shapes = [list(weights.shape) for _, weights in named_weights]
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    offsets = np.cumsum([0] + sizes)
+    max_rank = max([len(shape) for shape in shapes], default=0)
+
+    table = np.zeros((len(shapes), 3 + max_rank), dtype=np.int64)
+    for i, shape in enumerate(shapes):
+        table[i, :3] = [offsets[i], sizes[i], len(shape)]
+        table[i, 3:3 + len(shape)] = shape
+
+    arena = np.empty(offsets[-1], dtype=np.float32)
+    arena_tensor = torch.from_numpy(arena)
+
+    def copy(i: int):
+        weights = named_weights[i][1].detach()
+        arena_tensor[offsets[i]:offsets[i + 1]].view(weights.shape).copy_(
+            weights
+        )
 
-    return layers_weights, layers_dims
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(copy, range(len(named_weights))))
+    return arena, table
 
 
-def load_conv1_weights() -> Tuple[List[np.ndarray], List[List[int]]]:
+def load_conv1_weights(
+    arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestConv1.
 
+    Parameters
+    ----------
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
+
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestConv1()
-    return _extract_weights(model)
+    return _extract_weights(model, arena=arena)
 
 
-def load_conv2_weights() -> Tuple[List[np.ndarray], List[List[int]]]:
+def load_conv2_weights(
+    arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestConv2.
 
+    Parameters
+    ----------
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
+
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestConv2()
-    return _extract_weights(model)
+    return _extract_weights(model, arena=arena)
 
 
 def load_conv_sk_weights(
-    stride: int, kernel: int
-) -> Tuple[List[np.ndarray], List[List[int]]]:
+    stride: int, kernel: int, arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestConvSK.
 
@@ -259,20 +370,25 @@ def load_conv_sk_weights(
         The stride of the model.
     kernel: int
         The kernel size of the model.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestConvSK(stride=stride, kernel=kernel)
-    return _extract_weights(model)
+    return _extract_weights(model, arena=arena)
 
 
 def load_deconv_sk_weights(
-    stride: int, kernel: int
-) -> Tuple[List[np.ndarray], List[List[int]]]:
+    stride: int, kernel: int, arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestDeConvSK.
 
@@ -282,32 +398,49 @@ def load_deconv_sk_weights(
         The stride of the model.
     kernel: int
         The kernel size of the model.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestDeConvSK(stride=stride, kernel=kernel)
-    return _extract_and_transpose_weights(list(model.children()))
+    return _extract_and_transpose_weights(list(model.children()), arena=arena)
 
 
-def load_cat_weights() -> Tuple[List[np.ndarray], List[List[int]]]:
+def load_cat_weights(
+    arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestCat.
 
+    Parameters
+    ----------
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
+
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestCat()
-    return _extract_weights(model)
+    return _extract_weights(model, arena=arena)
 
 
-def load_resize_weights(size: int) -> Tuple[List[np.ndarray], List[List[int]]]:
+def load_resize_weights(
+    size: int, arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestResize.
 
@@ -315,20 +448,25 @@ def load_resize_weights(size: int) -> Tuple[List[np.ndarray], List[List[int]]]:
     ----------
     size: int
         The output size of the resize operation.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestResize(size)
-    return _extract_weights(model)
+    return _extract_weights(model, arena=arena)
 
 
 def load_patch_conv_weights(
-    size: int, patch: int
-) -> Tuple[List[np.ndarray], List[List[int]]]:
+    size: int, patch: int, arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestPatchConv.
 
@@ -338,20 +476,25 @@ def load_patch_conv_weights(
         The size of the input data.
     patch: int
         kernel split size of the input data.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestPatchConv(size=size, patch=patch)
-    return _extract_weights(model)
+    return _extract_weights(model, arena=arena)
 
 
 def load_attention1_weights(
-    size: int, patch: int
-) -> Tuple[List[np.ndarray], List[List[int]]]:
+    size: int, patch: int, arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestAttention1.
 
@@ -361,20 +504,25 @@ def load_attention1_weights(
         The size of the input data.
     patch: int
         kernel split size of the input data.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestAttention1(size=size, patch=patch)
-    return _extract_vit_weights(model=model)
+    return _extract_vit_weights(model=model, arena=arena)
 
 
 def load_attention1_bis_weights(
-    size: int, patch: int
-) -> Tuple[List[np.ndarray], List[List[int]]]:
+    size: int, patch: int, arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestAttention1.
 
@@ -384,20 +532,25 @@ def load_attention1_bis_weights(
         The size of the input data.
     patch: int
         kernel split size of the input data.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestAttention1(size=size, patch=patch)
-    return _extract_weights(model=model)
+    return _extract_weights(model=model, arena=arena)
 
 
 def load_attention2_weights(
-    size: int, patch: int
-) -> Tuple[List[np.ndarray], List[List[int]]]:
+    size: int, patch: int, arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestAttention2.
 
@@ -407,20 +560,25 @@ def load_attention2_weights(
         The size of the input data.
     patch: int
         kernel split size of the input data.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestAttention2(size=size, patch=patch)
-    return _extract_vit_weights(model=model)
+    return _extract_vit_weights(model=model, arena=arena)
 
 
 def load_attention2_bis_weights(
-    size: int, patch: int
-) -> Tuple[List[np.ndarray], List[List[int]]]:
+    size: int, patch: int, arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestAttention2.
 
@@ -430,20 +588,25 @@ def load_attention2_bis_weights(
         The size of the input data.
     patch: int
         kernel split size of the input data.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestAttention2(size=size, patch=patch)
-    return _extract_weights(model=model)
+    return _extract_weights(model=model, arena=arena)
 
 
 def load_layer_norm_weights(
-    size: int, patch: int
-) -> Tuple[List[np.ndarray], List[List[int]]]:
+    size: int, patch: int, arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestLayerNorm.
 
@@ -453,40 +616,63 @@ def load_layer_norm_weights(
         The size of the input data.
     patch: int
         kernel split size of the input data.
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
 
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestLayerNorm(size=size, patch=patch)
-    return _extract_weights(model)
+    return _extract_weights(model, arena=arena)
 
 
-def load_auto_encoder1_weights() -> Tuple[List[np.ndarray], List[List[int]]]:
+def load_auto_encoder1_weights(
+    arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestAutoEncoder1.
 
+    Parameters
+    ----------
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
+
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestAutoEncoder1()
-    return _extract_and_transpose_weights(list(model.children()))
+    return _extract_and_transpose_weights(list(model.children()), arena=arena)
 
 
-def load_gram_weights() -> Tuple[List[np.ndarray], List[List[int]]]:
+def load_gram_weights(
+    arena: bool = False
+) -> Union[
+    Tuple[List[np.ndarray], List[List[int]]], Tuple[np.ndarray, np.ndarray]
+]:
     """
     Get weights and biases for ModelTestGram.
 
+    Parameters
+    ----------
+    arena: bool
+        Whether to pack the weights in one contiguous arena.
+
     Returns
     -------
     (_, _): List[np.ndarray], List[int]
         The flattened weights, their shape.
+        When `arena` is True: the arena and its offset and shape table.
     """
     torch.manual_seed(42)
     model = ModelTestGram()
-    return _extract_weights(model)
+    return _extract_weights(model, arena=arena)